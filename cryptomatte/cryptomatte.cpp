@@ -21,3 +21,5 @@ const AtString CRYPTO_MATERIAL_OFFSET_UDATA("crypto_material_offset");
 uint8_t g_pointcloud_instance_verbosity = 0; // to do: remove this.
 
 CryptomatteCache CRYPTOMATTE_CACHE[AI_MAX_THREADS];
+
+RenderStats g_render_stats;
@@ -42,6 +42,19 @@ getting global
         // set option for sidecar manifest (optional)
         data->set_manifest_sidecar(sidecar);
 
+        // set whether sidecars include a binary manifest (optional)
+        data->set_option_binary_manifests(binary);
+
+        // set whether rank filters share one ranking per pixel (optional)
+        data->set_option_single_pass_filter(single_pass);
+
+        // set the transparency below which filters stop accumulating (optional)
+        data->set_option_transparency_epsilon(epsilon);
+
+        // set whether render statistics are collected and logged, and a JSON
+        // file to also write them to (optional)
+        data->set_option_render_stats(render_stats, render_stats_file);
+
         AtArray* uc_aov_array = AiArray(
             4, 1, AI_TYPE_STRING, AiNodeGetStr(node, "user_crypto_aov_0").c_str(),
             AiNodeGetStr(node, "user_crypto_aov_1").c_str(),
@@ -54,7 +67,9 @@ getting global
             AiNodeGetStr(node, "user_crypto_src_3").c_str());
 
         // does all the setup work. User cryptomatte arrays are optional (can be
-        // nulls).
+        // nulls), and may be of any length. Entries with an empty AOV or source
+        // are skipped, and up to MAX_USER_CRYPTOMATTES of the rest are used.
+        // setup_all does not take ownership of them.
         // The three arguments are the names of the cryptomatte AOVs. If the
         // AOVs are active (connected to EXR drivers), this does all the
         // complicated setup work of creating multiple AOVs if necessary,
@@ -85,16 +100,20 @@ getting global
 */
 
 #include "MurmurHash3.h"
+#include "manifest_writer.h"
+#include "render_stats.h"
 #include <ai.h>
 #include <algorithm>
+#include <atomic>
 #include <cstdio>
 #include <cstring>
 #include <ctime>
-#include <fstream>
 #include <iostream>
 #include <limits>
 #include <map>
+#include <memory>
 #include <string>
+#include <thread>
 #include <unordered_set>
 #include <vector>
 
@@ -119,9 +138,17 @@ using StringVector = std::vector<String>;
 #define CRYPTO_ICEPCLOUDVERB_DEFAULT 1
 #define CRYPTO_SIDECARMANIFESTS_DEFAULT false
 #define CRYPTO_PREVIEWINEXR_DEFAULT false
+#define CRYPTO_SINGLEPASSFILTER_DEFAULT true
+#define CRYPTO_BINARYMANIFESTS_DEFAULT false
+#define CRYPTO_TRANSPARENCYEPSILON_DEFAULT 0.0f
+#define CRYPTO_RENDERSTATS_DEFAULT false
 
 // System values
 #define MAX_STRING_LENGTH 2048
+// Memory budget of the shared node name-hash cache, per Cryptomatte shader
+#define CRYPTO_NODE_CACHE_MAX_MB 32
+// Shape nodes per chunk of manifest compilation work
+#define CRYPTO_MANIFEST_CHUNK_SIZE 1024
 #define MAX_CRYPTOMATTE_DEPTH 99
 #define MAX_USER_CRYPTOMATTES 16
 
@@ -142,9 +169,14 @@ extern const AtString CRYPTO_MATERIAL_OFFSET_UDATA;
 extern AtCritSec g_critsec;
 extern bool g_critsec_active;
 
+// Shared by all Cryptomatte shaders and filters of the plugin
+extern RenderStats g_render_stats;
+
 // Some static AtStrings to cache
 const AtString aStr_shader("shader");
 const AtString aStr_list_aggregate("list_aggregate");
+const AtString aStr_ginstance("ginstance");
+const AtString aStr_node("node");
 
 // Name processing flags
 using CryptoNameFlag = uint8_t;
@@ -573,6 +605,36 @@ inline bool get_material_name(const AtShaderGlobals* sg, const AtNode* node, con
     return cachable;
 }
 
+static const AtString* const NAME_OVERRIDE_UDATA_NAMES[] = {
+    &CRYPTO_ASSET_UDATA,        &CRYPTO_OBJECT_UDATA,        &CRYPTO_MATERIAL_UDATA,
+    &CRYPTO_ASSET_OFFSET_UDATA, &CRYPTO_OBJECT_OFFSET_UDATA, &CRYPTO_MATERIAL_OFFSET_UDATA};
+
+inline bool has_name_overrides(const AtNode* node) {
+    // True if the node has any name or offset user data
+    for (const AtString* udata_name : NAME_OVERRIDE_UDATA_NAMES) {
+        if (AiNodeLookUpUserParameter(node, *udata_name))
+            return true;
+    }
+    return false;
+}
+
+inline bool has_varying_overrides(const AtNode* node) {
+    // True if the names of a node may differ between its samples, though get_object_names and
+    // get_material_name find them cachable without shader globals: name or offset user data on
+    // the node that is not constant, or any on the procedurals it is in, which its samples
+    // inherit. Overrides on ginstances are found by get_instance_overridden_nodes.
+    for (const AtString* udata_name : NAME_OVERRIDE_UDATA_NAMES) {
+        const AtUserParamEntry* pentry = AiNodeLookUpUserParameter(node, *udata_name);
+        if (pentry && AiUserParamGetCategory(pentry) != AI_USERDEF_CONSTANT)
+            return true;
+    }
+    for (const AtNode* parent = AiNodeGetParent(node); parent; parent = AiNodeGetParent(parent)) {
+        if (has_name_overrides(parent))
+            return true;
+    }
+    return false;
+}
+
 ///////////////////////////////////////////////
 //
 //      Metadata Writing
@@ -580,7 +642,7 @@ inline bool get_material_name(const AtShaderGlobals* sg, const AtNode* node, con
 ///////////////////////////////////////////////
 
 inline void write_manifest_to_string(const ManifestMap& map, String& manf_string) {
-    ManifestMap::const_iterator map_it = map.begin();
+    // Appends the JSON manifest of the map.
     const size_t map_entries = map.size();
     const size_t max_entries = 100000;
     size_t metadata_entries = map_entries;
@@ -589,51 +651,157 @@ inline void write_manifest_to_string(const ManifestMap& map, String& manf_string
                      map_entries, max_entries);
         metadata_entries = max_entries;
     }
+    encode_manifest(map, metadata_entries, manf_string);
+}
 
-    manf_string.append("{");
-    String pair;
-    pair.reserve(MAX_STRING_LENGTH);
-    for (uint32_t i = 0; i < metadata_entries; i++) {
-        String name = map_it->first;
-        float hash_value = map_it->second;
-        ++map_it;
+/*
+Encoded manifest metadata of each stream, shared by all drivers the stream is written to (cameras,
+stereo, multiple files), so a manifest is encoded once however many drivers there are. Entries are
+keyed by stream and manifest contents, and kept for one more setup, so an IPR update that leaves a
+manifest unchanged reuses it too.
 
+Within a setup, each stream passes the same map for all its drivers, so the content hash of a map
+is computed once per setup, keyed by stream and map address. Only reuse across setups needs it.
+*/
+
+using EncodedManifest = std::shared_ptr<const String>;
+
+inline uint64_t manifest_content_hash(const ManifestMap& map) {
+    // IDs are hashes of the names, so in name order they identify the contents without the names
+    // being read.
+    uint64_t hash = 0xcbf29ce484222325ull ^ map.size();
+    for (const auto& entry : map) {
         uint32_t float_bits;
-        std::memcpy(&float_bits, &hash_value, 4);
-        char hex_chars[9];
-        sprintf(hex_chars, "%08x", float_bits);
-
-        pair.clear();
-        pair.append("\"");
-        for (size_t j = 0; j < name.length(); j++) {
-            // append the name, char by char
-            const char c = name.at(j);
-            if (c == '"' || c == '\\' || c == '/')
-                pair += "\\";
-            pair += c;
+        std::memcpy(&float_bits, &entry.second, 4);
+        hash ^= float_bits | (uint64_t)entry.first.size() << 32;
+        hash *= 0x100000001b3ull;
+        hash ^= hash >> 29;
+    }
+    return hash;
+}
+
+class EncodedManifestCache {
+public:
+    EncodedManifest get(const String& prefix, const ManifestMap& map) {
+        // Returns "<prefix>manifest <manifest>", encoding it only if not cached. The map must not
+        // change until the next setup.
+        const Key key(prefix, content_hash(prefix, map));
+        auto found = current.find(key);
+        if (found != current.end())
+            return found->second;
+
+        EncodedManifest encoded;
+        found = previous.find(key);
+        if (found != previous.end()) {
+            encoded = found->second;
+        } else {
+            String metadata_manf = prefix + String("manifest ");
+            write_manifest_to_string(map, metadata_manf);
+            encoded = std::make_shared<const String>(std::move(metadata_manf));
         }
-        pair.append("\":\"");
-        pair.append(hex_chars);
-        pair.append("\"");
-        if (i < map_entries - 1)
-            pair.append(",");
-        manf_string.append(pair);
-    }
-    manf_string.append("}");
+        current[key] = encoded;
+        return encoded;
+    }
+
+    void start_setup() {
+        // Entries not used since the last setup are dropped.
+        previous.swap(current);
+        current.clear();
+        setup_hashes.clear();
+    }
+
+    // maps hashed, once per stream and setup
+    uint64_t content_hashes = 0;
+
+private:
+    using Key = std::pair<String, uint64_t>;
+    std::map<Key, EncodedManifest> current;
+    std::map<Key, EncodedManifest> previous;
+    std::map<std::pair<String, const ManifestMap*>, uint64_t> setup_hashes;
+
+    uint64_t content_hash(const String& prefix, const ManifestMap& map) {
+        const auto inserted = setup_hashes.emplace(std::make_pair(prefix, &map), 0);
+        if (inserted.second) {
+            inserted.first->second = manifest_content_hash(map);
+            content_hashes++;
+        }
+        return inserted.first->second;
+    }
+};
+
+inline String binary_manifest_path(const String& manifest_path) {
+    // path of the binary manifest written next to a .json sidecar manifest
+    const size_t json_found = manifest_path.rfind(".json");
+    if (json_found != String::npos && json_found + 5 == manifest_path.size())
+        return manifest_path.substr(0, json_found) + ".bin";
+    return manifest_path + ".bin";
 }
 
 inline void write_manifest_sidecar_file(const ManifestMap& map_md_asset,
-                                        StringVector manifest_paths) {
-    String encoded_manifest = "";
+                                        const StringVector& manifest_paths, bool binary) {
+    String encoded_manifest;
     write_manifest_to_string(map_md_asset, encoded_manifest);
     for (const auto& manifest_path : manifest_paths) {
-        std::ofstream out(manifest_path.c_str());
         AiMsgInfo("[Cryptomatte] writing file, %s", manifest_path.c_str());
-        out << encoded_manifest.c_str();
-        out.close();
+        if (!write_file_atomic(manifest_path.c_str(), encoded_manifest))
+            AiMsgWarning("[Cryptomatte] Unable to write manifest file, %s", manifest_path.c_str());
+    }
+    if (!binary || manifest_paths.empty())
+        return;
+
+    if (!encode_binary_manifest(map_md_asset, encoded_manifest)) {
+        AiMsgWarning("Cryptomatte: %lu entries in manifest, too large for a binary manifest",
+                     map_md_asset.size());
+        return;
+    }
+    for (const auto& manifest_path : manifest_paths) {
+        const String binary_path = binary_manifest_path(manifest_path);
+        AiMsgInfo("[Cryptomatte] writing file, %s", binary_path.c_str());
+        if (!write_file_atomic(binary_path.c_str(), encoded_manifest, true))
+            AiMsgWarning("[Cryptomatte] Unable to write manifest file, %s", binary_path.c_str());
     }
 }
 
+/*
+Sidecar manifests are written on a background thread, so that closing the render does not wait on
+encoding and (often networked) file writes. Manifests are compiled first, as that reads the scene,
+and handed to the thread. It is joined before the next sidecars are written, and when the
+Cryptomatte shader is destroyed.
+*/
+
+struct SidecarJob {
+    ManifestMap map;
+    StringVector paths;
+};
+
+class SidecarWriter {
+public:
+    void start(std::vector<SidecarJob>& jobs, bool binary) {
+        // Takes the jobs, and writes them in the background.
+        wait();
+        if (jobs.empty())
+            return;
+        pending.swap(jobs);
+        jobs.clear();
+        thread = std::thread([this, binary]() {
+            for (const auto& job : pending)
+                write_manifest_sidecar_file(job.map, job.paths, binary);
+            pending.clear();
+        });
+    }
+
+    void wait() {
+        if (thread.joinable())
+            thread.join();
+    }
+
+    ~SidecarWriter() { wait(); }
+
+private:
+    std::thread thread;
+    std::vector<SidecarJob> pending;
+};
+
 inline void add_hash_to_map(const char* c_str, ManifestMap& md_map) {
     if (cstr_empty(c_str))
         return;
@@ -728,21 +896,362 @@ struct CACHE_ALIGN CryptomatteCache {
 
 extern CryptomatteCache CRYPTOMATTE_CACHE[AI_MAX_THREADS];
 
+///////////////////////////////////////////////
+//
+//      NodeHashCache
+//
+///////////////////////////////////////////////
+
+/*
+Name hashes of shape nodes, shared by all threads.
+
+CRYPTOMATTE_CACHE only remembers the last node of each thread, so with many interleaved nodes
+(such as instances) each thread keeps recomputing names and hashes. Behind it, this remembers every
+node, up to a memory budget. Reads take no locks. An entry is claimed by compare-and-swap, filled,
+then published with a release store, and never changes after that. Entries are only cleared by
+reset(), when the scene is updated and no threads are rendering.
+
+Only values valid for the whole node (see get_object_names and get_material_name) are stored.
+Nodes instanced by ginstances with name or offset user data are never stored, nor is anything in
+them: their samples only see those overrides through AiUDataGet*, so their names may differ from
+the node's own.
+*/
+
+struct NodeHashEntry {
+    static const uint32_t EMPTY = 0, WRITING = 1, READY = 2;
+    std::atomic<uint32_t> state{EMPTY};
+    bool has_obj = false;
+    bool has_mat = false;
+    const AtNode* node = nullptr;
+    AtRGB nsp_hash_clr = AI_RGB_BLACK;
+    AtRGB obj_hash_clr = AI_RGB_BLACK;
+    AtRGB mat_hash_clr = AI_RGB_BLACK;
+};
+
+struct NodeHashCounters {
+    // Lookups answered by CRYPTOMATTE_CACHE, by the shared cache, or computed.
+    uint64_t thread_hits = 0;
+    uint64_t shared_hits = 0;
+    uint64_t misses = 0;
+    // Padded rather than CACHE_ALIGN, as these are heap allocated and C++11 new does not align
+    // to more than 16 bytes. Keeps threads' counters mostly off each other's cache lines.
+    char padding[CACHE_LINE - 3 * sizeof(uint64_t)];
+};
+
+class NodeHashCache {
+public:
+    static const uint32_t MAX_PROBES = 16;
+
+    void reset(size_t num_nodes, std::unordered_set<const AtNode*> uncachable_nodes = {}) {
+        // Clears the cache, sized for num_nodes within the memory budget. The uncachable nodes,
+        // and nodes in them, are never inserted.
+        log_stats();
+        uncachable = std::move(uncachable_nodes);
+        const size_t max_entries = (CRYPTO_NODE_CACHE_MAX_MB << 20) / sizeof(NodeHashEntry);
+        size_t capacity = 1024;
+        while (capacity < num_nodes * 2 && capacity * 2 <= max_entries)
+            capacity *= 2;
+        entries.reset(new NodeHashEntry[capacity]);
+        mask = capacity - 1;
+        used = 0;
+        if (!counters)
+            counters.reset(new NodeHashCounters[AI_MAX_THREADS]);
+        for (uint32_t i = 0; i < AI_MAX_THREADS; i++)
+            counters[i] = NodeHashCounters();
+    }
+
+    NodeHashCounters& thread_counters(uint16_t tid) { return counters[tid]; }
+
+    const NodeHashEntry* find(const AtNode* node) const {
+        if (!entries)
+            return nullptr;
+        size_t slot = slot_of(node);
+        for (uint32_t i = 0; i < MAX_PROBES; i++, slot = (slot + 1) & mask) {
+            const NodeHashEntry& entry = entries[slot];
+            const uint32_t state = entry.state.load(std::memory_order_acquire);
+            if (state == NodeHashEntry::EMPTY)
+                return nullptr;
+            if (state == NodeHashEntry::READY && entry.node == node)
+                return &entry;
+        }
+        return nullptr;
+    }
+
+    void insert(const AtNode* node, bool has_obj, const AtRGB& nsp_hash_clr,
+                const AtRGB& obj_hash_clr, bool has_mat, const AtRGB& mat_hash_clr) {
+        // Adds an entry, unless the node is already present or the cache is full around it.
+        if (!entries || (!has_obj && !has_mat) || used.load(std::memory_order_relaxed) > mask / 2)
+            return;
+        if (is_uncachable(node))
+            return;
+        size_t slot = slot_of(node);
+        for (uint32_t i = 0; i < MAX_PROBES; i++, slot = (slot + 1) & mask) {
+            NodeHashEntry& entry = entries[slot];
+            uint32_t state = entry.state.load(std::memory_order_acquire);
+            if (state == NodeHashEntry::READY && entry.node == node)
+                return;
+            if (state != NodeHashEntry::EMPTY ||
+                !entry.state.compare_exchange_strong(state, NodeHashEntry::WRITING,
+                                                     std::memory_order_acquire))
+                continue;
+            entry.node = node;
+            entry.has_obj = has_obj;
+            entry.nsp_hash_clr = nsp_hash_clr;
+            entry.obj_hash_clr = obj_hash_clr;
+            entry.has_mat = has_mat;
+            entry.mat_hash_clr = mat_hash_clr;
+            entry.state.store(NodeHashEntry::READY, std::memory_order_release);
+            used.fetch_add(1, std::memory_order_relaxed);
+            return;
+        }
+    }
+
+    NodeHashCounters totals() const {
+        // Counts since the last reset. Not thread safe, call when not rendering.
+        NodeHashCounters total;
+        if (!counters)
+            return total;
+        for (uint32_t i = 0; i < AI_MAX_THREADS; i++) {
+            total.thread_hits += counters[i].thread_hits;
+            total.shared_hits += counters[i].shared_hits;
+            total.misses += counters[i].misses;
+        }
+        return total;
+    }
+
+    void log_stats() const {
+        // Logs hit rates since the last reset. Not thread safe, call when not rendering.
+        const NodeHashCounters total = totals();
+        const uint64_t lookups = total.thread_hits + total.shared_hits + total.misses;
+        if (lookups == 0)
+            return;
+        AiMsgInfo("[Cryptomatte] Name hash cache: %llu lookups, %.1f%% per-thread hits, %.1f%% "
+                  "shared hits, %.1f%% computed. %lu of %lu entries used.",
+                  (unsigned long long)lookups, 100.0 * total.thread_hits / lookups,
+                  100.0 * total.shared_hits / lookups, 100.0 * total.misses / lookups,
+                  (unsigned long)used.load(), (unsigned long)(mask + 1));
+    }
+
+private:
+    std::unique_ptr<NodeHashEntry[]> entries;
+    std::unique_ptr<NodeHashCounters[]> counters;
+    size_t mask = 0;
+    std::atomic<size_t> used{0};
+    std::unordered_set<const AtNode*> uncachable;
+
+    bool is_uncachable(const AtNode* node) const {
+        if (uncachable.empty())
+            return false;
+        for (; node; node = AiNodeGetParent(node)) {
+            if (uncachable.count(node))
+                return true;
+        }
+        return false;
+    }
+
+    size_t slot_of(const AtNode* node) const {
+        const uint64_t bits = (uint64_t)(uintptr_t)node >> 4;
+        return (size_t)((bits * 0x9e3779b97f4a7c15ull) >> 32) & mask;
+    }
+};
+
+///////////////////////////////////////////////
+//
+//      UserHashMemo
+//
+///////////////////////////////////////////////
+
+/*
+Hashes of user Cryptomatte values, per thread.
+
+User Cryptomattes hash a user data string on every camera sample. The strings are AtStrings, which
+are interned, so a value is identified by its address alone. Each thread remembers the hashes of
+the last values it saw in a small direct mapped table. Values never change hashes, so entries are
+only replaced, never invalidated.
+*/
+
+struct UserHashMemo {
+    static const size_t NUM_SLOTS = 256;
+
+    struct Slot {
+        const char* value = nullptr;
+        AtRGB hash = AI_RGB_BLACK;
+    };
+
+    Slot slots[NUM_SLOTS];
+    uint64_t hits = 0;
+    uint64_t misses = 0;
+
+    AtRGB hash(const AtString value) {
+        const char* key = value.c_str();
+        const uint64_t bits = (uint64_t)(uintptr_t)key >> 3;
+        Slot& slot = slots[((bits * 0x9e3779b97f4a7c15ull) >> 32) & (NUM_SLOTS - 1)];
+        if (slot.value == key) {
+            hits++;
+        } else {
+            misses++;
+            slot.value = key;
+            slot.hash = hash_name_rgb(key);
+        }
+        return slot.hash;
+    }
+};
+
+class UserHashMemos {
+public:
+    void reset(bool enabled) {
+        // Clears the memos, which are only allocated while user Cryptomattes are enabled.
+        log_stats();
+        memos.reset(enabled ? new UserHashMemo[AI_MAX_THREADS] : nullptr);
+    }
+
+    UserHashMemo& thread_memo(uint16_t tid) { return memos[tid]; }
+
+    void totals(uint64_t& hits, uint64_t& misses) const {
+        // Counts since the last reset. Not thread safe, call when not rendering.
+        hits = misses = 0;
+        if (!memos)
+            return;
+        for (uint32_t i = 0; i < AI_MAX_THREADS; i++) {
+            hits += memos[i].hits;
+            misses += memos[i].misses;
+        }
+    }
+
+    void log_stats() const {
+        // Logs hit rates since the last reset. Not thread safe, call when not rendering.
+        uint64_t hits, misses;
+        totals(hits, misses);
+        if (hits + misses == 0)
+            return;
+        AiMsgInfo("[Cryptomatte] User Cryptomatte hash memo: %llu lookups, %.1f%% hits, %llu "
+                  "misses.",
+                  (unsigned long long)(hits + misses), 100.0 * hits / (hits + misses),
+                  (unsigned long long)misses);
+    }
+
+private:
+    std::unique_ptr<UserHashMemo[]> memos;
+};
+
+///////////////////////////////////////////////
+//
+//      Parallel manifest compilation
+//
+///////////////////////////////////////////////
+
+/*
+Manifests are compiled when a render starts, while render threads are idle, so shape nodes are
+split into chunks compiled on a pool of worker threads, each into its own maps. A name always has
+the same hash, so merging the maps gives the same manifest whichever worker compiled which node.
+*/
+
+inline std::vector<AtNode*> get_manifest_shapes(AtUniverse* universe) {
+    // enabled shape nodes, in iterator order
+    std::vector<AtNode*> shapes;
+    AtNodeIterator* shape_iterator = AiUniverseGetNodeIterator(universe, AI_NODE_SHAPE);
+    while (!AiNodeIteratorFinished(shape_iterator)) {
+        AtNode* node = AiNodeIteratorGetNext(shape_iterator);
+        if (node && !AiNodeIsDisabled(node))
+            shapes.push_back(node);
+    }
+    AiNodeIteratorDestroy(shape_iterator);
+    return shapes;
+}
+
+inline std::unordered_set<const AtNode*> get_instance_overridden_nodes(AtUniverse* universe) {
+    // Nodes instanced by ginstances with name or offset user data, through any ginstances of
+    // ginstances. Their samples see that user data, though the nodes do not have it.
+    std::unordered_set<const AtNode*> nodes;
+    AtNodeIterator* shape_iterator = AiUniverseGetNodeIterator(universe, AI_NODE_SHAPE);
+    while (!AiNodeIteratorFinished(shape_iterator)) {
+        const AtNode* node = AiNodeIteratorGetNext(shape_iterator);
+        if (!node || !AiNodeIs(node, aStr_ginstance) || !has_name_overrides(node))
+            continue;
+        const AtNode* target = static_cast<const AtNode*>(AiNodeGetPtr(node, aStr_node));
+        while (target && nodes.insert(target).second && AiNodeIs(target, aStr_ginstance))
+            target = static_cast<const AtNode*>(AiNodeGetPtr(target, aStr_node));
+    }
+    AiNodeIteratorDestroy(shape_iterator);
+    return nodes;
+}
+
+inline size_t get_manifest_worker_count(AtUniverse* universe, size_t num_shapes) {
+    // As many workers as the render would use threads, and no more than there are chunks.
+    const int hardware_threads = (int)std::max(1u, std::thread::hardware_concurrency());
+    const AtNode* options = AiUniverseGetOptions(universe);
+    int threads = options ? AiNodeGetInt(options, "threads") : 0;
+    if (threads <= 0)
+        threads = std::max(1, hardware_threads + threads);
+    const size_t num_chunks =
+        (num_shapes + CRYPTO_MANIFEST_CHUNK_SIZE - 1) / CRYPTO_MANIFEST_CHUNK_SIZE;
+    return std::max((size_t)1, std::min((size_t)threads, num_chunks));
+}
+
+template <typename ChunkFunc>
+inline void run_manifest_chunks(size_t num_items, size_t num_workers, ChunkFunc chunk_func) {
+    // Calls chunk_func(worker, begin, end) on chunks of items, taken in turn by num_workers
+    // workers. Worker 0 is the calling thread.
+    std::atomic<size_t> next_chunk{0};
+    auto work = [&](size_t worker) {
+        for (;;) {
+            const size_t begin = next_chunk.fetch_add(CRYPTO_MANIFEST_CHUNK_SIZE);
+            if (begin >= num_items)
+                return;
+            chunk_func(worker, begin, std::min(begin + CRYPTO_MANIFEST_CHUNK_SIZE, num_items));
+        }
+    };
+    std::vector<std::thread> threads;
+    for (size_t worker = 1; worker < num_workers; worker++)
+        threads.push_back(std::thread(work, worker));
+    work(0);
+    for (auto& thread : threads)
+        thread.join();
+}
+
+inline void merge_manifest(const ManifestMap& from, ManifestMap& into) {
+    if (into.empty())
+        into = from;
+    else
+        into.insert(from.begin(), from.end());
+}
+
 ///////////////////////////////////////////////
 //
 //      UserCryptomatte and CryptomatteData
 //
 ///////////////////////////////////////////////
 
+/*
+User Cryptomattes, each an AOV whose IDs are hashed from a string user data source.
+
+They are kept as a table of descriptors in parameter order, each holding the names of its rank
+AOVs once they have been set up. Only the descriptors of AOVs which are outputs are copied to the
+enabled table, which is all that is looked at during sampling, so declared but unused user
+Cryptomattes cost nothing per sample.
+*/
+
+struct UserCryptomatte {
+    AtString aov;
+    AtString source;
+    // names of the rank AOVs (crypto_xxx00, ...), set if the AOV is an output
+    AtArray* aov_array = nullptr;
+};
+
 struct UserCryptomattes {
     size_t count = 0;
-    std::vector<AtArray*> aov_arrays;
-    std::vector<AtString> aovs;
-    std::vector<AtString> sources;
+    // in parameter order, indexed like driver and manifest vectors
+    std::vector<UserCryptomatte> streams;
+    // streams with AOV arrays, in the same order
+    std::vector<UserCryptomatte> enabled;
 
     UserCryptomattes() {}
 
-    UserCryptomattes(const AtArray* aov_input, const AtArray* src_input) {
+    UserCryptomattes(const UserCryptomattes&) = delete;
+    UserCryptomattes& operator=(const UserCryptomattes&) = delete;
+
+    void setup(const AtArray* aov_input, const AtArray* src_input) {
+        clear();
         if (!aov_input || !src_input)
             return;
 
@@ -750,27 +1259,57 @@ struct UserCryptomattes {
             std::min(AiArrayGetNumElements(aov_input), AiArrayGetNumElements(src_input));
 
         for (uint32_t i = 0; i < num_inputs; i++) {
-            const AtString aov = AiArrayGetStr(aov_input, i);
-            const AtString src = AiArrayGetStr(src_input, i);
-            if (!aov.empty() && !src.empty()) {
-                AiMsgInfo("Adding user-Cryptomatte %lu: AOV: %s Source user data: %s", aovs.size(),
-                          aov.c_str(), src.c_str());
-                aovs.push_back(aov);
-                sources.push_back(src);
+            UserCryptomatte stream;
+            stream.aov = AiArrayGetStr(aov_input, i);
+            stream.source = AiArrayGetStr(src_input, i);
+            if (stream.aov.empty() || stream.source.empty())
+                continue;
+            if (find(stream.aov)) {
+                AiMsgWarning("[Cryptomatte] User Cryptomatte AOV %s is defined more than once, "
+                             "ignoring source user data %s",
+                             stream.aov.c_str(), stream.source.c_str());
+                continue;
+            }
+            if (streams.size() == MAX_USER_CRYPTOMATTES) {
+                AiMsgWarning("[Cryptomatte] Only %d user Cryptomattes are supported, ignoring %s",
+                             MAX_USER_CRYPTOMATTES, stream.aov.c_str());
+                continue;
             }
+            AiMsgInfo("Adding user-Cryptomatte %lu: AOV: %s Source user data: %s",
+                      (unsigned long)streams.size(), stream.aov.c_str(), stream.source.c_str());
+            streams.push_back(stream);
         }
-        aov_arrays.resize(aovs.size());
-        for (auto& aov_array : aov_arrays)
-            aov_array = nullptr;
+        count = streams.size();
+    }
 
-        count = aovs.size();
+    const UserCryptomatte* find(const AtString aov) const {
+        for (const auto& stream : streams) {
+            if (stream.aov == aov)
+                return &stream;
+        }
+        return nullptr;
     }
 
-    ~UserCryptomattes() {
-        for (auto& aov_array : aov_arrays) {
-            AiArrayDestroy(aov_array);
+    void collect_enabled() {
+        // Call once the AOV arrays of streams are set up.
+        enabled.clear();
+        for (const auto& stream : streams) {
+            if (stream.aov_array)
+                enabled.push_back(stream);
         }
     }
+
+    void clear() {
+        for (auto& stream : streams) {
+            if (stream.aov_array)
+                AiArrayDestroy(stream.aov_array);
+        }
+        streams.clear();
+        enabled.clear();
+        count = 0;
+    }
+
+    ~UserCryptomattes() { clear(); }
 };
 
 struct CryptomatteData {
@@ -783,6 +1322,10 @@ struct CryptomatteData {
     AtArray* aov_array_cryptoobject = nullptr;
     AtArray* aov_array_cryptomaterial = nullptr;
     UserCryptomattes user_cryptomattes;
+    NodeHashCache node_hash_cache;
+    SidecarWriter sidecar_writer;
+    EncodedManifestCache encoded_manifests;
+    UserHashMemos user_hash_memos;
     // Custom output drivers need to be considered as if they 
     // were a driver_exr
     bool custom_output_driver = false;
@@ -798,6 +1341,14 @@ struct CryptomatteData {
     CryptoNameFlag option_mat_flags;
     uint8_t option_pcloud_ice_verbosity;
     bool option_sidecar_manifests;
+    bool option_single_pass_filter;
+    bool option_binary_manifests;
+    float option_transparency_epsilon;
+    bool option_render_stats;
+    String option_render_stats_file;
+    // Whether this shader enabled g_render_stats, and so reports them. Other Cryptomatte shaders
+    // in the scene leave them alone.
+    bool reporting_render_stats = false;
 
     // Vector of paths for each of the cryptomattes. Vector because each
     // cryptomatte can write to multiple drivers (stereo, multi-camera)
@@ -812,6 +1363,10 @@ public:
         set_option_channels(CRYPTO_DEPTH_DEFAULT, CRYPTO_PREVIEWINEXR_DEFAULT);
         set_option_namespace_stripping(CRYPTO_NAME_ALL, CRYPTO_NAME_ALL);
         set_option_ice_pcloud_verbosity(CRYPTO_ICEPCLOUDVERB_DEFAULT);
+        set_option_single_pass_filter(CRYPTO_SINGLEPASSFILTER_DEFAULT);
+        set_option_binary_manifests(CRYPTO_BINARYMANIFESTS_DEFAULT);
+        set_option_transparency_epsilon(CRYPTO_TRANSPARENCYEPSILON_DEFAULT);
+        set_option_render_stats(CRYPTO_RENDERSTATS_DEFAULT, "");
         if (!g_critsec_active)
             AiMsgError("[Cryptomatte] Critical section was not initialized. ");
     }
@@ -831,11 +1386,24 @@ public:
         create_depth_outputs = create_depth_outputs_;
         destroy_arrays();
 
-        user_cryptomattes = UserCryptomattes(uc_aov_array, uc_src_array);
+        // stats of the previous render (IPR), before the caches they include are reset
+        report_render_stats();
+        reporting_render_stats = option_render_stats;
+        if (option_render_stats)
+            g_render_stats.set_enabled(true);
+
+        user_cryptomattes.setup(uc_aov_array, uc_src_array);
 
         crypto_crit_sec_enter();
+        // names and flags may have changed (IPR), so hashes are recomputed. Reset before
+        // setup_outputs, as compiling manifests fills the cache.
+        node_hash_cache.reset(count_shapes(universe), get_instance_overridden_nodes(universe));
+        encoded_manifests.start_setup();
         setup_outputs(universe);
         crypto_crit_sec_leave();
+
+        user_cryptomattes.collect_enabled();
+        user_hash_memos.reset(!user_cryptomattes.enabled.empty());
     }
 
     void set_option_channels(int depth, bool exr_preview_channels) {
@@ -861,21 +1429,74 @@ public:
 
     void set_option_sidecar_manifests(bool sidecar) { option_sidecar_manifests = sidecar; }
 
+    void set_option_single_pass_filter(bool single_pass) {
+        option_single_pass_filter = single_pass;
+    }
+
+    void set_option_binary_manifests(bool binary) { option_binary_manifests = binary; }
+
+    void set_option_transparency_epsilon(float epsilon) {
+        option_transparency_epsilon = std::min(std::max(epsilon, 0.0f), 1.0f);
+    }
+
+    void set_option_render_stats(bool render_stats, const String& render_stats_file) {
+        // Writing a stats file implies collecting stats.
+        option_render_stats = render_stats || !render_stats_file.empty();
+        option_render_stats_file = render_stats_file;
+    }
+
     void do_cryptomattes(AtShaderGlobals* sg) {
         if (sg->Rt & AI_RAY_CAMERA && sg->sc == AI_CONTEXT_SURFACE) {
+            RenderStats::ScopedTimer timer(g_render_stats, STAT_DO_CRYPTOMATTES);
             do_standard_cryptomattes(sg);
             do_user_cryptomattes(sg);
         }
     }
 
     void write_sidecar_manifests(AtUniverse *universe) {
-        write_standard_sidecar_manifests(universe);
-        write_user_sidecar_manifests(universe);
+        std::vector<SidecarJob> jobs;
+        write_standard_sidecar_manifests(universe, jobs);
+        write_user_sidecar_manifests(universe, jobs);
+        sidecar_writer.start(jobs, option_binary_manifests);
     }
 
-    ~CryptomatteData() { destroy_arrays(); }
+    ~CryptomatteData() {
+        sidecar_writer.wait();
+        report_render_stats();
+        node_hash_cache.log_stats();
+        user_hash_memos.log_stats();
+        destroy_arrays();
+    }
 
 private:
+    void report_render_stats() {
+        // Logs the stats collected since the last report, writes them to the stats file if set,
+        // and disables them until the next setup. Not thread safe, call when not rendering.
+        if (!reporting_render_stats)
+            return;
+        reporting_render_stats = false;
+        g_render_stats.set_enabled(false);
+        if (g_render_stats.empty())
+            return;
+        const NodeHashCounters name_hashes = node_hash_cache.totals();
+        g_render_stats.set_counter("name_hash_thread_hits", name_hashes.thread_hits);
+        g_render_stats.set_counter("name_hash_shared_hits", name_hashes.shared_hits);
+        g_render_stats.set_counter("name_hash_misses", name_hashes.misses);
+        uint64_t user_hash_hits, user_hash_misses;
+        user_hash_memos.totals(user_hash_hits, user_hash_misses);
+        g_render_stats.set_counter("user_hash_hits", user_hash_hits);
+        g_render_stats.set_counter("user_hash_misses", user_hash_misses);
+
+        AiMsgInfo("[Cryptomatte] Render statistics:");
+        for (const auto& line : g_render_stats.summary_lines())
+            AiMsgInfo("[Cryptomatte] %s", line.c_str());
+        if (!option_render_stats_file.empty() &&
+            !write_file_atomic(option_render_stats_file.c_str(), g_render_stats.to_json()))
+            AiMsgWarning("[Cryptomatte] Could not write render statistics to %s",
+                         option_render_stats_file.c_str());
+        g_render_stats.reset();
+    }
+
     void do_standard_cryptomattes(AtShaderGlobals* sg) {
         if (!aov_array_cryptoasset && !aov_array_cryptoobject && !aov_array_cryptomaterial)
             return;
@@ -898,66 +1519,91 @@ private:
     }
 
     void do_user_cryptomattes(AtShaderGlobals* sg) {
-        for (uint32_t i = 0; i < user_cryptomattes.count; i++) {
-            AtArray* aovArray = user_cryptomattes.aov_arrays[i];
-            if (aovArray) {
-                AtString aov_name = user_cryptomattes.aovs[i];
-                AtString src_data_name = user_cryptomattes.sources[i];
-                AtRGB hash = AI_RGB_BLACK;
-                AtString result;
-
-                AiUDataGetStr(src_data_name, result);
-                if (!result.empty())
-                    hash = hash_name_rgb(result.c_str());
-
-                aov_array_set_flt(sg, aovArray, hash.r);
-                hash.r = 0.0f;
-                AiAOVSetRGBA(sg, aov_name, hash);
-            }
+        if (user_cryptomattes.enabled.empty())
+            return;
+        UserHashMemo& memo = user_hash_memos.thread_memo(sg->tid);
+        for (const auto& stream : user_cryptomattes.enabled) {
+            AtRGB hash = AI_RGB_BLACK;
+            AtString result;
+
+            AiUDataGetStr(stream.source, result);
+            if (!result.empty())
+                hash = memo.hash(result);
+
+            aov_array_set_flt(sg, stream.aov_array, hash.r);
+            hash.r = 0.0f;
+            AiAOVSetRGBA(sg, stream.aov, hash);
         }
     }
 
     void hash_object_rgb(AtShaderGlobals* sg, AtRGB& nsp_hash_clr, AtRGB& obj_hash_clr,
                          AtRGB& mat_hash_clr) {
-        if (CRYPTOMATTE_CACHE[sg->tid].object == sg->Op) {
-            nsp_hash_clr = CRYPTOMATTE_CACHE[sg->tid].nsp_hash_clr;
-            obj_hash_clr = CRYPTOMATTE_CACHE[sg->tid].obj_hash_clr;
+        // Looks in this thread's last node, then in the shared cache, before computing.
+        CryptomatteCache& thread_cache = CRYPTOMATTE_CACHE[sg->tid];
+        NodeHashCounters& counters = node_hash_cache.thread_counters(sg->tid);
+        const bool obj_in_thread = thread_cache.object == sg->Op;
+        const bool mat_in_thread = thread_cache.shader_object == sg->Op;
+        const NodeHashEntry* shared =
+            obj_in_thread && mat_in_thread ? nullptr : node_hash_cache.find(sg->Op);
+
+        bool obj_cachable = true;
+        if (obj_in_thread) {
+            nsp_hash_clr = thread_cache.nsp_hash_clr;
+            obj_hash_clr = thread_cache.obj_hash_clr;
+            counters.thread_hits++;
+        } else if (shared && shared->has_obj) {
+            nsp_hash_clr = thread_cache.nsp_hash_clr = shared->nsp_hash_clr;
+            obj_hash_clr = thread_cache.obj_hash_clr = shared->obj_hash_clr;
+            thread_cache.object = sg->Op;
+            counters.shared_hits++;
         } else {
             char nsp_name[MAX_STRING_LENGTH] = "";
             char obj_name[MAX_STRING_LENGTH] = "";
-            bool cachable = get_object_names(sg, sg->Op, option_obj_flags, nsp_name, obj_name);
+            obj_cachable = get_object_names(sg, sg->Op, option_obj_flags, nsp_name, obj_name);
             nsp_hash_clr = hash_name_rgb(nsp_name);
             obj_hash_clr = hash_name_rgb(obj_name);
-            if (cachable) {
+            if (obj_cachable) {
                 // only values that will be valid for the whole node, sg->Op,
                 // are cachable.
                 // the source of manually overriden values is not known and may
                 // therefore not be cached.
-                CRYPTOMATTE_CACHE[sg->tid].object = sg->Op;
-                CRYPTOMATTE_CACHE[sg->tid].obj_hash_clr = obj_hash_clr;
-                CRYPTOMATTE_CACHE[sg->tid].nsp_hash_clr = nsp_hash_clr;
+                thread_cache.object = sg->Op;
+                thread_cache.obj_hash_clr = obj_hash_clr;
+                thread_cache.nsp_hash_clr = nsp_hash_clr;
             }
+            counters.misses++;
         }
 
-        AtNode* shader = AiShaderGlobalsGetShader(sg);
-        if (CRYPTOMATTE_CACHE[sg->tid].shader_object == sg->Op) {
-            mat_hash_clr = CRYPTOMATTE_CACHE[sg->tid].mat_hash_clr;
+        bool mat_cachable = true;
+        if (mat_in_thread) {
+            mat_hash_clr = thread_cache.mat_hash_clr;
+            counters.thread_hits++;
+        } else if (shared && shared->has_mat) {
+            mat_hash_clr = thread_cache.mat_hash_clr = shared->mat_hash_clr;
+            thread_cache.shader_object = sg->Op;
+            counters.shared_hits++;
         } else {
+            AtNode* shader = AiShaderGlobalsGetShader(sg);
             AtArray* shaders = AiNodeGetArray(sg->Op, aStr_shader);
-            bool cachable = shaders ? AiArrayGetNumElements(shaders) == 1 : false;
+            mat_cachable = shaders ? AiArrayGetNumElements(shaders) == 1 : false;
 
             char mat_name[MAX_STRING_LENGTH] = "";
-            cachable =
-                get_material_name(sg, sg->Op, shader, option_mat_flags, mat_name) && cachable;
+            mat_cachable =
+                get_material_name(sg, sg->Op, shader, option_mat_flags, mat_name) && mat_cachable;
             mat_hash_clr = hash_name_rgb(mat_name);
 
-            if (cachable) {
+            if (mat_cachable) {
                 // only values that will be valid for the whole node, sg->Op,
                 // are cachable.
-                CRYPTOMATTE_CACHE[sg->tid].shader_object = sg->Op;
-                CRYPTOMATTE_CACHE[sg->tid].mat_hash_clr = mat_hash_clr;
+                thread_cache.shader_object = sg->Op;
+                thread_cache.mat_hash_clr = mat_hash_clr;
             }
+            counters.misses++;
         }
+
+        if (!shared && !(obj_in_thread && mat_in_thread))
+            node_hash_cache.insert(sg->Op, obj_cachable, nsp_hash_clr, obj_hash_clr, mat_cachable,
+                                   mat_hash_clr);
     }
 
     void aov_array_set_flt(AtShaderGlobals* sg, const AtArray* aov_names, float id) const {
@@ -1096,8 +1742,11 @@ private:
                 driver_material.push_back(driver);
             } else {
                 for (size_t j = 0; j < user_cryptomattes.count; j++) {
-                    if (t_output.aov_matches(user_cryptomattes.aovs[j])) {
-                        crypto_aovs = user_cryptomattes.aov_arrays[j] = allocate_aov_names();
+                    UserCryptomatte& stream = user_cryptomattes.streams[j];
+                    if (t_output.aov_matches(stream.aov)) {
+                        if (!stream.aov_array)
+                            stream.aov_array = allocate_aov_names();
+                        crypto_aovs = stream.aov_array;
                         tmp_uc_drivers[j].push_back(driver);
                         break;
                     }
@@ -1191,7 +1840,8 @@ private:
             const String aov_rank_name = t_output.aov_name_tok + rank_num;
             if (create_depth_outputs) {
                 if (AiNodeLookUpByName(universe, filter_rank_name.c_str()) == nullptr)
-                    AtNode* filter = create_filter(universe, orig_filter, filter_rank_name, i);
+                    AtNode* filter = create_filter(universe, orig_filter, filter_rank_name,
+                                                   t_output.aov_name_tok, i);
 
                 TokenizedOutput new_t_output = t_output;
                 new_t_output.aov_name_tok = aov_rank_name;
@@ -1217,7 +1867,8 @@ private:
         }
     }
 
-    AtNode* create_filter(AtUniverse *universe, const AtNode* orig_filter, const String filter_name, int aovindex) const {
+    AtNode* create_filter(AtUniverse *universe, const AtNode* orig_filter, const String filter_name,
+                          const String rank_group, int aovindex) const {
         const AtNodeEntry* filter_nentry = AiNodeGetNodeEntry(orig_filter);
         const auto width = AiNodeEntryLookUpParameter(filter_nentry, "width")
                                ? AiNodeGetFlt(orig_filter, "width")
@@ -1229,6 +1880,13 @@ private:
         AiNodeSetStr(filter, "filter", filter_param.c_str());
         AiNodeSetInt(filter, "rank", aovindex * 2);
         AiNodeSetFlt(filter, "width", width);
+        if (option_single_pass_filter) {
+            // All rank filters of the Cryptomatte filter the same samples, so can share the
+            // ranking of each pixel instead of each computing it.
+            AiNodeSetStr(filter, "rank_group", rank_group.c_str());
+            AiNodeSetInt(filter, "rank_group_size", option_aov_depth);
+        }
+        AiNodeSetFlt(filter, "transparency_epsilon", option_transparency_epsilon);
         return filter;
     }
 
@@ -1242,6 +1900,17 @@ private:
         return filter;
     }
 
+    size_t count_shapes(AtUniverse* universe) const {
+        size_t num_shapes = 0;
+        AtNodeIterator* shape_iterator = AiUniverseGetNodeIterator(universe, AI_NODE_SHAPE);
+        while (!AiNodeIteratorFinished(shape_iterator)) {
+            AiNodeIteratorGetNext(shape_iterator);
+            num_shapes++;
+        }
+        AiNodeIteratorDestroy(shape_iterator);
+        return num_shapes;
+    }
+
     AtArray* allocate_aov_names() const {
         // allocates and blanks an AOV array
         AtArray* aovs = AiArrayAllocate(option_aov_depth, 1, AI_TYPE_STRING);
@@ -1285,7 +1954,16 @@ private:
         }
     }
 
-    void write_standard_sidecar_manifests(AtUniverse *universe) {
+    void add_sidecar_job(const AtString cryptomatte_name, ManifestMap& map,
+                         const StringVector& paths, std::vector<SidecarJob>& jobs) const {
+        if (g_render_stats.enabled())
+            g_render_stats.record_stream(cryptomatte_name.c_str(), map.size(), 0, true);
+        jobs.push_back(SidecarJob());
+        jobs.back().map.swap(map);
+        jobs.back().paths = paths;
+    }
+
+    void write_standard_sidecar_manifests(AtUniverse *universe, std::vector<SidecarJob>& jobs) {
         const bool do_md_asset = manif_asset_paths.size() > 0;
         const bool do_md_object = manif_object_paths.size() > 0;
         const bool do_md_material = manif_material_paths.size() > 0;
@@ -1298,11 +1976,12 @@ private:
                                    map_md_object, map_md_material);
 
         if (do_md_asset)
-            write_manifest_sidecar_file(map_md_asset, manif_asset_paths);
+            add_sidecar_job(aov_cryptoasset, map_md_asset, manif_asset_paths, jobs);
         if (do_md_object)
-            write_manifest_sidecar_file(map_md_object, manif_object_paths);
+            add_sidecar_job(aov_cryptoobject, map_md_object, manif_object_paths, jobs);
         if (do_md_material)
-            write_manifest_sidecar_file(map_md_material, manif_material_paths);
+            add_sidecar_job(aov_cryptomaterial, map_md_material, manif_material_paths,
+                            jobs);
 
         // reset sidecar writers
         manif_asset_paths = StringVector();
@@ -1313,48 +1992,82 @@ private:
     void compile_standard_manifests(AtUniverse *universe, bool do_md_asset, bool do_md_object, 
                                     bool do_md_material, ManifestMap& map_md_asset, 
                                     ManifestMap& map_md_object, ManifestMap& map_md_material) {
-        AtNodeIterator* shape_iterator = AiUniverseGetNodeIterator(universe, AI_NODE_SHAPE);
-        while (!AiNodeIteratorFinished(shape_iterator)) {
-            AtNode* node = AiNodeIteratorGetNext(shape_iterator);
-            if (!node || AiNodeIsDisabled(node))
-                continue;
+        RenderStats::ScopedTimer timer(g_render_stats, STAT_COMPILE_STANDARD_MANIFESTS);
+        const std::vector<AtNode*> shapes = get_manifest_shapes(universe);
+        const size_t num_workers = get_manifest_worker_count(universe, shapes.size());
+        // maps of workers other than the calling thread, which compiles into the outputs
+        std::vector<ManifestMap> worker_maps(3 * (num_workers - 1));
+        run_manifest_chunks(shapes.size(), num_workers, [&](size_t worker, size_t begin,
+                                                            size_t end) {
+            ManifestMap& asset_map = worker ? worker_maps[3 * worker - 3] : map_md_asset;
+            ManifestMap& object_map = worker ? worker_maps[3 * worker - 2] : map_md_object;
+            ManifestMap& material_map = worker ? worker_maps[3 * worker - 1] : map_md_material;
+            for (size_t i = begin; i < end; i++)
+                compile_shape_manifests(shapes[i], do_md_asset, do_md_object, do_md_material,
+                                        asset_map, object_map, material_map);
+        });
+        for (size_t worker = 1; worker < num_workers; worker++) {
+            merge_manifest(worker_maps[3 * worker - 3], map_md_asset);
+            merge_manifest(worker_maps[3 * worker - 2], map_md_object);
+            merge_manifest(worker_maps[3 * worker - 1], map_md_material);
+        }
+    }
 
-            // skip any list aggregate nodes
-            if (AiNodeIs(node, aStr_list_aggregate))
-                continue;
+    void compile_shape_manifests(AtNode* node, bool do_md_asset, bool do_md_object,
+                                 bool do_md_material, ManifestMap& map_md_asset,
+                                 ManifestMap& map_md_object, ManifestMap& map_md_material) {
+        // Adds the names of one shape to the manifests. Called from several threads at once.
 
-            char nsp_name[MAX_STRING_LENGTH] = "";
-            char obj_name[MAX_STRING_LENGTH] = "";
+        // skip any list aggregate nodes
+        if (AiNodeIs(node, aStr_list_aggregate))
+            return;
 
-            get_object_names(nullptr, node, option_obj_flags, nsp_name, obj_name);
+        char nsp_name[MAX_STRING_LENGTH] = "";
+        char obj_name[MAX_STRING_LENGTH] = "";
 
-            if (do_md_asset || do_md_object) {
-                add_obj_to_manifest(node, nsp_name, CRYPTO_ASSET_UDATA, CRYPTO_ASSET_OFFSET_UDATA,
-                                    map_md_asset);
-                add_obj_to_manifest(node, obj_name, CRYPTO_OBJECT_UDATA, CRYPTO_OBJECT_OFFSET_UDATA,
-                                    map_md_object);
-            }
-            if (do_md_material) {
-                // Process all shaders from the objects into the manifest.
-                // This includes cluster materials.
-                AtArray* shaders = AiNodeGetArray(node, "shader");
-                if (!shaders)
+        // Names of the whole node are hashed into the name hash cache, so that shading
+        // finds them there instead of building them again.
+        const bool whole_node = !has_varying_overrides(node);
+        const bool obj_cachable =
+            get_object_names(nullptr, node, option_obj_flags, nsp_name, obj_name) && whole_node;
+
+        if (do_md_asset || do_md_object) {
+            add_obj_to_manifest(node, nsp_name, CRYPTO_ASSET_UDATA, CRYPTO_ASSET_OFFSET_UDATA,
+                                map_md_asset);
+            add_obj_to_manifest(node, obj_name, CRYPTO_OBJECT_UDATA, CRYPTO_OBJECT_OFFSET_UDATA,
+                                map_md_object);
+        }
+
+        // Process all shaders from the objects into the manifest.
+        // This includes cluster materials.
+        AtArray* shaders = AiNodeGetArray(node, aStr_shader);
+        const uint32_t num_shaders = shaders ? AiArrayGetNumElements(shaders) : 0;
+        bool mat_cachable = false;
+        AtRGB mat_hash_clr = AI_RGB_BLACK;
+        if (do_md_material || num_shaders == 1) {
+            for (uint32_t i = 0; i < num_shaders; i++) {
+                char mat_name[MAX_STRING_LENGTH] = "";
+                AtNode* shader = static_cast<AtNode*>(AiArrayGetPtr(shaders, i));
+                if (!shader)
                     continue;
-                for (uint32_t i = 0; i < AiArrayGetNumElements(shaders); i++) {
-                    char mat_name[MAX_STRING_LENGTH] = "";
-                    AtNode* shader = static_cast<AtNode*>(AiArrayGetPtr(shaders, i));
-                    if (!shader)
-                        continue;
-                    get_material_name(nullptr, node, shader, option_mat_flags, mat_name);
+                // as in hash_object_rgb, only a single material is valid for the whole node
+                mat_cachable =
+                    get_material_name(nullptr, node, shader, option_mat_flags, mat_name) &&
+                    whole_node && num_shaders == 1;
+                if (mat_cachable)
+                    mat_hash_clr = hash_name_rgb(mat_name);
+                if (do_md_material)
                     add_obj_to_manifest(node, mat_name, CRYPTO_MATERIAL_UDATA,
                                         CRYPTO_MATERIAL_OFFSET_UDATA, map_md_material);
-                }
             }
         }
-        AiNodeIteratorDestroy(shape_iterator);
+
+        if (obj_cachable || mat_cachable)
+            node_hash_cache.insert(node, obj_cachable, hash_name_rgb(nsp_name),
+                                   hash_name_rgb(obj_name), mat_cachable, mat_hash_clr);
     }
 
-    void write_user_sidecar_manifests(AtUniverse *universe) {
+    void write_user_sidecar_manifests(AtUniverse *universe, std::vector<SidecarJob>& jobs) {
         std::vector<bool> do_metadata;
         do_metadata.resize(user_cryptomattes.count);
         std::vector<ManifestMap> manf_maps;
@@ -1369,27 +2082,36 @@ private:
 
         for (size_t i = 0; i < manifs_user_paths.size(); i++)
             if (do_metadata[i])
-                write_manifest_sidecar_file(manf_maps[i], manifs_user_paths[i]);
+                add_sidecar_job(user_cryptomattes.streams[i].aov, manf_maps[i],
+                                manifs_user_paths[i], jobs);
 
         manifs_user_paths = std::vector<StringVector>();
     }
 
     void compile_user_manifests(AtUniverse *universe, std::vector<bool>& do_metadata,
                                 std::vector<ManifestMap>& manf_maps) {
-        if (user_cryptomattes.count == 0)
+        const size_t count = user_cryptomattes.count;
+        if (count == 0)
             return;
-        AtNodeIterator* shape_iterator = AiUniverseGetNodeIterator(universe, AI_NODE_SHAPE);
-        while (!AiNodeIteratorFinished(shape_iterator)) {
-            AtNode* node = AiNodeIteratorGetNext(shape_iterator);
-            if (!node || AiNodeIsDisabled(node))
-                continue;
-            for (uint32_t i = 0; i < user_cryptomattes.count; i++) {
-                if (do_metadata[i])
-                    add_override_udata_to_manifest(node, user_cryptomattes.sources[i],
-                                                   manf_maps[i]);
+        const std::vector<AtNode*> shapes = get_manifest_shapes(universe);
+        const size_t num_workers = get_manifest_worker_count(universe, shapes.size());
+        // maps of workers other than the calling thread, which compiles into manf_maps
+        std::vector<ManifestMap> worker_maps(count * (num_workers - 1));
+        run_manifest_chunks(shapes.size(), num_workers, [&](size_t worker, size_t begin,
+                                                            size_t end) {
+            ManifestMap* maps = worker ? &worker_maps[count * (worker - 1)] : manf_maps.data();
+            for (size_t j = begin; j < end; j++) {
+                for (uint32_t i = 0; i < count; i++) {
+                    if (do_metadata[i])
+                        add_override_udata_to_manifest(
+                            shapes[j], user_cryptomattes.streams[i].source, maps[i]);
+                }
             }
+        });
+        for (size_t worker = 1; worker < num_workers; worker++) {
+            for (uint32_t i = 0; i < count; i++)
+                merge_manifest(worker_maps[count * (worker - 1) + i], manf_maps[i]);
         }
-        AiNodeIteratorDestroy(shape_iterator);
     }
 
     void build_standard_metadata(AtUniverse *universe, 
@@ -1462,7 +2184,7 @@ private:
             do_metadata[i] = false;
             for (size_t j = 0; j < drivers_vv[i].size(); j++) {
                 AtNode* driver = drivers_vv[i][j];
-                AtString user_aov = user_cryptomattes.aovs[i];
+                AtString user_aov = user_cryptomattes.streams[i].aov;
                 do_metadata[i] = do_metadata[i] || metadata_needed(driver, user_aov);
                 do_anything = do_anything || do_metadata[i];
 
@@ -1485,7 +2207,7 @@ private:
         for (uint32_t i = 0; i < drivers_vv.size(); i++) {
             if (!do_metadata[i])
                 continue;
-            AtString aov_name = user_cryptomattes.aovs[i];
+            AtString aov_name = user_cryptomattes.streams[i].aov;
             for (size_t j = 0; j < drivers_vv[i].size(); j++) {
                 AtNode* driver = drivers_vv[i][j];
                 if (driver) {
@@ -1499,9 +2221,10 @@ private:
     }
 
     void write_metadata_to_driver(AtNode* driver, const AtString cryptomatte_name,
-                                  const ManifestMap& map, const String sidecar_manif_file) const {
+                                  const ManifestMap& map, const String sidecar_manif_file) {
         if (!check_driver(driver))
             return;
+        RenderStats::ScopedTimer timer(g_render_stats, STAT_WRITE_METADATA_TO_DRIVER);
 
         if (!AiNodeEntryLookUpParameter(AiNodeGetNodeEntry(driver), "custom_attributes") &&
             !AiNodeLookUpUserParameter(driver, "custom_attributes")) {
@@ -1525,21 +2248,34 @@ private:
         const String metadata_hash = prefix + String("hash MurmurHash3_32");
         const String metadata_conv = prefix + String("conversion uint32_to_float32");
         const String metadata_name = prefix + String("name ") + cryptomatte_name.c_str();
-        String metadata_manf;
+        EncodedManifest metadata_manf;
+        String metadata_bin_manf;
         if (sidecar_manif_file.empty()) {
-            metadata_manf = prefix + String("manifest ");
-            write_manifest_to_string(map, metadata_manf);
+            metadata_manf = encoded_manifests.get(prefix, map);
+            if (g_render_stats.enabled()) {
+                const size_t header_size = prefix.size() + strlen("manifest ");
+                g_render_stats.record_stream(cryptomatte_name.c_str(), map.size(),
+                                             metadata_manf->size() - header_size, false);
+            }
         } else {
-            metadata_manf = prefix + String("manif_file ") + sidecar_manif_file;
+            metadata_manf = std::make_shared<const String>(prefix + String("manif_file ") +
+                                                           sidecar_manif_file);
+            if (option_binary_manifests)
+                metadata_bin_manf =
+                    prefix + String("manif_bin_file ") + binary_manifest_path(sidecar_manif_file);
         }
+        const uint32_t num_entries = metadata_bin_manf.empty() ? 4 : 5;
 
-        AtArray* combined_md = AiArrayAllocate(orig_num_entries + 4, 1, AI_TYPE_STRING);
+        AtArray* combined_md =
+            AiArrayAllocate(orig_num_entries + num_entries, 1, AI_TYPE_STRING);
         for (uint32_t i = 0; i < orig_num_entries; i++)
             AiArraySetStr(combined_md, i, AiArrayGetStr(orig_md, i));
-        AiArraySetStr(combined_md, orig_num_entries + 0, metadata_manf.c_str());
+        AiArraySetStr(combined_md, orig_num_entries + 0, metadata_manf->c_str());
         AiArraySetStr(combined_md, orig_num_entries + 1, metadata_hash.c_str());
         AiArraySetStr(combined_md, orig_num_entries + 2, metadata_conv.c_str());
         AiArraySetStr(combined_md, orig_num_entries + 3, metadata_name.c_str());
+        if (!metadata_bin_manf.empty())
+            AiArraySetStr(combined_md, orig_num_entries + 4, metadata_bin_manf.c_str());
 
         AiNodeSetArray(driver, "custom_attributes", combined_md);
     }
@@ -1594,6 +2330,6 @@ private:
         aov_array_cryptoasset = nullptr;
         aov_array_cryptoobject = nullptr;
         aov_array_cryptomaterial = nullptr;
-        user_cryptomattes = UserCryptomattes();
+        user_cryptomattes.clear();
     }
 };
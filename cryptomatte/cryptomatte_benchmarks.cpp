@@ -0,0 +1,196 @@
+/*
+
+Micro-benchmarks of Cryptomatte internals, run outside of Arnold.
+
+Built when CMake is configured with -DBUILD_BENCHMARKS=ON, as cryptomatte_benchmarks:
+
+    cryptomatte_benchmarks [samples]
+
+*/
+
+#include "filters.h"
+#include "manifest_writer.h"
+#include <chrono>
+#include <cstdio>
+#include <cstdlib>
+#include <fstream>
+#include <map>
+#include <random>
+#include <string>
+#include <vector>
+
+using Clock = std::chrono::steady_clock;
+
+static double seconds_since(Clock::time_point start) {
+    return std::chrono::duration<double>(Clock::now() - start).count();
+}
+
+///////////////////////////////////////////////
+//
+//    Filter weights
+//
+///////////////////////////////////////////////
+
+// Called through a pointer the compiler cannot see through, as filter_pixel used to.
+static float (*volatile g_filter_func)(AtVector2, float) = nullptr;
+
+template <typename Weight>
+static double time_kernel(const Weight& weight, const std::vector<AtVector2>& offsets,
+                          float& sum) {
+    const Clock::time_point start = Clock::now();
+    for (const auto& offset : offsets)
+        sum += weight(offset);
+    return seconds_since(start);
+}
+
+static double time_pointer(float (*filter_func)(AtVector2, float), float width,
+                           const std::vector<AtVector2>& offsets, float& sum) {
+    g_filter_func = filter_func;
+    const Clock::time_point start = Clock::now();
+    for (const auto& offset : offsets)
+        sum += g_filter_func(offset, width);
+    return seconds_since(start);
+}
+
+template <float (*filter_func)(AtVector2, float)>
+static void benchmark_filter(const char* name, float width, const std::vector<AtVector2>& offsets,
+                             bool tabulate) {
+    float sum_pointer = 0.0f, sum_kernel = 0.0f;
+    const double pointer_seconds = time_pointer(filter_func, width, offsets, sum_pointer);
+
+    double kernel_seconds = 0.0;
+    float max_error = 0.0f;
+    if (tabulate) {
+        RadialWeightTable table;
+        table.build(filter_func, width);
+        kernel_seconds = time_kernel(table, offsets, sum_kernel);
+        for (const auto& offset : offsets)
+            max_error = std::max(max_error, std::abs(table(offset) - filter_func(offset, width)));
+    } else {
+        kernel_seconds = time_kernel(AnalyticWeight<filter_func>{width}, offsets, sum_kernel);
+    }
+
+    const double ns = 1e9 / offsets.size();
+    printf("%-16s %-10s %12.2f %12.2f %10.2fx %12g\n", name, tabulate ? "table" : "inline",
+           pointer_seconds * ns, kernel_seconds * ns, pointer_seconds / kernel_seconds,
+           max_error);
+    // keeps the sums, and so the loops, from being optimized away
+    if (sum_pointer == -1.0f || sum_kernel == -1.0f)
+        printf("\n");
+}
+
+static void benchmark_filter_weights(size_t num_samples) {
+    const float width = 2.0f;
+    std::mt19937 rng(0);
+    std::uniform_real_distribution<float> offset_dist(-width * 0.5f, width * 0.5f);
+    std::vector<AtVector2> offsets(num_samples);
+    for (auto& offset : offsets)
+        offset = AtVector2(offset_dist(rng), offset_dist(rng));
+
+    printf("Filter weights, %lu samples, width %g\n", (unsigned long)num_samples, width);
+    printf("%-16s %-10s %12s %12s %11s %12s\n", "filter", "kernel", "pointer ns", "kernel ns",
+           "speedup", "max error");
+    benchmark_filter<gaussian>("gaussian", width, offsets, true);
+    benchmark_filter<blackman_harris>("blackman_harris", width, offsets, true);
+    benchmark_filter<triangle>("triangle", width, offsets, false);
+    benchmark_filter<box>("box", width, offsets, false);
+    benchmark_filter<disk>("disk", width, offsets, false);
+    benchmark_filter<cone>("cone", width, offsets, false);
+}
+
+///////////////////////////////////////////////
+//
+//    Manifest writing
+//
+///////////////////////////////////////////////
+
+using ManifestMap = std::map<std::string, float>;
+
+// write_manifest_to_string and write_manifest_sidecar_file as they were before encode_manifest.
+static void legacy_write_manifest_to_string(const ManifestMap& map, std::string& manf_string) {
+    ManifestMap::const_iterator map_it = map.begin();
+    const size_t map_entries = map.size();
+    manf_string.append("{");
+    std::string pair;
+    pair.reserve(1024);
+    for (uint32_t i = 0; i < map_entries; i++) {
+        std::string name = map_it->first;
+        float hash_value = map_it->second;
+        ++map_it;
+
+        uint32_t float_bits;
+        std::memcpy(&float_bits, &hash_value, 4);
+        char hex_chars[9];
+        sprintf(hex_chars, "%08x", float_bits);
+
+        pair.clear();
+        pair.append("\"");
+        for (size_t j = 0; j < name.length(); j++) {
+            const char c = name.at(j);
+            if (c == '"' || c == '\\' || c == '/')
+                pair += "\\";
+            pair += c;
+        }
+        pair.append("\":\"");
+        pair.append(hex_chars);
+        pair.append("\"");
+        if (i < map_entries - 1)
+            pair.append(",");
+        manf_string.append(pair);
+    }
+    manf_string.append("}");
+}
+
+static void legacy_write_file(const char* path, const std::string& contents) {
+    std::ofstream out(path);
+    out << contents.c_str();
+    out.close();
+}
+
+static void benchmark_manifest_writing(size_t num_entries, const char* path) {
+    std::mt19937 rng(0);
+    std::uniform_int_distribution<uint32_t> bits_dist;
+    ManifestMap map;
+    char name[64];
+    while (map.size() < num_entries) {
+        // names as crowds and instancers produce them, a few with characters to escape
+        const uint32_t bits = bits_dist(rng);
+        sprintf(name, "/crowd/agent_%u/geo/body%s", bits, bits % 16 == 0 ? "_\"v2\"" : "");
+        float id;
+        std::memcpy(&id, &bits, 4);
+        map[name] = id;
+    }
+
+    std::string legacy, encoded;
+    Clock::time_point start = Clock::now();
+    legacy_write_manifest_to_string(map, legacy);
+    const double legacy_seconds = seconds_since(start);
+    start = Clock::now();
+    encode_manifest(map, map.size(), encoded);
+    const double encode_seconds = seconds_since(start);
+
+    start = Clock::now();
+    legacy_write_file(path, legacy);
+    const double legacy_write_seconds = seconds_since(start);
+    start = Clock::now();
+    const bool written = write_file(path, encoded);
+    const double write_seconds = seconds_since(start);
+    std::remove(path);
+
+    printf("\nManifest writing, %lu entries, %lu bytes, %s\n", (unsigned long)map.size(),
+           (unsigned long)encoded.size(), encoded == legacy ? "identical" : "DIFFERENT");
+    printf("%-16s %12s %12s %11s\n", "step", "legacy ms", "ms", "speedup");
+    printf("%-16s %12.2f %12.2f %10.2fx\n", "encode", legacy_seconds * 1e3, encode_seconds * 1e3,
+           legacy_seconds / encode_seconds);
+    printf("%-16s %12.2f %12.2f %10.2fx\n", "write sidecar", legacy_write_seconds * 1e3,
+           write_seconds * 1e3, legacy_write_seconds / write_seconds);
+    if (!written)
+        printf("Could not write %s\n", path);
+}
+
+int main(int argc, char** argv) {
+    const size_t num_samples = argc > 1 ? (size_t)atol(argv[1]) : 10000000;
+    benchmark_filter_weights(num_samples);
+    benchmark_manifest_writing(100000, "cryptomatte_benchmark_manifest.json");
+    return 0;
+}
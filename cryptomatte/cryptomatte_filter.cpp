@@ -1,11 +1,10 @@
 #include "cryptomatte.h"
 #include "filters.h"
+#include "sample_weights.h"
 #include <ai.h>
 #include <algorithm>
 #include <cstring>
-#include <map>
 #include <string>
-#include <vector>
 
 ///////////////////////////////////////////////
 //
@@ -23,6 +22,16 @@ struct CryptomatteFilterData {
     int rank = -1;
     int filter = 0;
     bool noop = false;
+    // Use the analytic filter functions, instead of weight_table for gaussian and
+    // blackman_harris.
+    bool exact_weights = false;
+    bool use_weight_table = false;
+    RadialWeightTable weight_table;
+    // Rank filters of one Cryptomatte with the same rank group share the ranking of each pixel.
+    AtString rank_group;
+    int rank_group_size = 0;
+    // Sub-samples behind less than this much transparency are not accumulated. 0 for all.
+    float transparency_epsilon = 0.0f;
 };
 
 node_parameters {
@@ -34,6 +43,10 @@ node_parameters {
     AiParameterInt("rank", -1);
     AiParameterEnum("filter", p_filter_gaussian, filterEnumNames);
     AiParameterBool("noop", false);
+    AiParameterBool("exact_weights", false);
+    AiParameterStr("rank_group", "");
+    AiParameterInt("rank_group_size", 0);
+    AiParameterFlt("transparency_epsilon", 0.0f);
 }
 
 void registerCryptomatteFilter(AtNodeLib* node) {
@@ -64,12 +77,26 @@ void node_update_content(AtNode* node) {
     data->rank = AiNodeGetInt(node, "rank");
     data->filter = AiNodeGetInt(node, "filter");
     data->noop = AiNodeGetBool(node, "noop");
+    data->exact_weights = AiNodeGetBool(node, "exact_weights");
+    data->rank_group = AiNodeGetStr(node, "rank_group");
+    data->rank_group_size = AiNodeGetInt(node, "rank_group_size");
+    data->transparency_epsilon = std::max(AiNodeGetFlt(node, "transparency_epsilon"), 0.0f);
 
     if (data->noop)
         return;
     else if (data->rank < 0)
         AiMsgError("Cryptomatte Filter: %s rank not set", AiNodeGetName(node));
 
+    if (!data->rank_group.empty() &&
+        (data->rank < 0 || data->rank / 2 >= std::min(data->rank_group_size, 64))) {
+        AiMsgWarning("Cryptomatte Filter: %s rank %d is outside its rank group of %d, not sharing "
+                     "rankings",
+                     AiNodeGetName(node), data->rank, data->rank_group_size);
+        data->rank_group = AtString();
+    } else if (data->rank_group_size < 2) {
+        data->rank_group = AtString();
+    }
+
     switch (data->filter) {
     case p_filter_triangle:
         data->filter_func = &triangle;
@@ -88,10 +115,16 @@ void node_update_content(AtNode* node) {
         break;
     case p_filter_gaussian:
     default:
+        data->filter = p_filter_gaussian;
         data->filter_func = &gaussian;
         break;
     }
 
+    data->use_weight_table = !data->exact_weights && (data->filter == p_filter_gaussian ||
+                                                      data->filter == p_filter_blackman_harris);
+    if (data->use_weight_table)
+        data->weight_table.build(data->filter_func, data->width);
+
     if (data->filter == p_filter_box) {
         AiFilterUpdate(node, 1.0f);
     } else {
@@ -117,84 +150,40 @@ filter_output_type {
 
 ///////////////////////////////////////////////
 //
-//    Sample-Weight map Class and type definitions
-//
-///////////////////////////////////////////////
-
-class compareTail {
-public:
-    bool operator()(const std::pair<float, float> x, const std::pair<float, float> y) {
-        return x.second > y.second;
-    }
-};
-
-typedef std::map<float, float> sw_map_t;
-typedef std::map<float, float>::iterator sw_map_iterator_t;
-
-void write_to_samples_map(sw_map_t* vals, float hash, float sample_weight) {
-    (*vals)[hash] += sample_weight;
-}
-
-///////////////////////////////////////////////
-//
-//    Filter proper
+//    Per-thread sample-weight scratch
 //
 ///////////////////////////////////////////////
 
-filter_pixel {
-    CryptomatteFilterData* data = (CryptomatteFilterData*)AiNodeGetLocalData(node);
-    if (data->noop)
-        return;
-
-    AtRGBA* out_value = (AtRGBA*)data_out;
-    *out_value = AI_RGBA_ZERO;
-
-    ///////////////////////////////////////////////
-    //
-    //    early out for black pixels
-    //
-    ///////////////////////////////////////////////
-
-    bool early_out = true;
+// Filters have no shader globals, so no thread index for a per-thread array as with
+// CRYPTOMATTE_CACHE. Reused for every pixel a thread filters, so it only allocates while growing.
+static thread_local SampleWeights tls_sample_weights;
+static thread_local RankingCache tls_ranking_cache;
+
+template <typename Weight>
+static bool accumulate_weighted_samples(const Weight& filter_weight, float transparency_epsilon,
+                                        AtAOVSampleIterator* iterator, SampleWeights& vals,
+                                        float& total_weight, ThreadRenderStats* stats) {
+    // Accumulates the weight of each ID in the pixel into vals, in a single pass over the
+    // samples. Returns false if no sample has a value.
+    vals.clear();
+    total_weight = 0.0f;
+
+    // Samples up to the first one with a value, which a separate early-out pass would have
+    // iterated before starting over.
+    uint64_t num_samples = 0, early_out_samples = 0;
+    uint64_t stopped_samples = 0;
 
     while (AiAOVSampleIteratorGetNext(iterator)) {
-        while (AiAOVSampleIteratorGetNextDepth(iterator)) {
-            if (AiAOVSampleIteratorHasValue(iterator)) {
-                early_out = false;
-                break;
+        num_samples++;
+        float sample_weight = filter_weight(AiAOVSampleIteratorGetOffset(iterator));
+        if (sample_weight == 0.0f) {
+            // contributes no weight, but may still be the one sample with a value
+            while (!early_out_samples && AiAOVSampleIteratorGetNextDepth(iterator)) {
+                if (AiAOVSampleIteratorHasValue(iterator))
+                    early_out_samples = num_samples;
             }
-        }
-        if (!early_out)
-            break;
-    }
-
-    if (early_out) {
-        if (data->rank == 0)
-            out_value->g = 1.0f;
-        return;
-    }
-    AiAOVSampleIteratorReset(iterator);
-
-    ///////////////////////////////////////////////
-    //
-    //    Set up sample-weight maps and friends
-    //
-    ///////////////////////////////////////////////
-
-    sw_map_t vals;
-    float total_weight = 0.0f;
-
-    ///////////////////////////////////////////////
-    //
-    //    Iterate samples
-    //
-    ///////////////////////////////////////////////
-
-    while (AiAOVSampleIteratorGetNext(iterator)) {
-        float sample_weight =
-            data->filter_func(AiAOVSampleIteratorGetOffset(iterator), data->width);
-        if (sample_weight == 0.0f)
             continue;
+        }
         sample_weight *= AiAOVSampleIteratorGetInvDensity(iterator);
 
         float iterative_transparency_weight = 1.0f;
@@ -203,6 +192,8 @@ filter_pixel {
         total_weight += quota;
 
         while (AiAOVSampleIteratorGetNextDepth(iterator)) {
+            if (!early_out_samples && AiAOVSampleIteratorHasValue(iterator))
+                early_out_samples = num_samples;
             const float sub_sample_opacity =
                 AiColorToGrey(AiAOVSampleIteratorGetAOVRGB(iterator, ats_opacity));
             sample_value = AiAOVSampleIteratorGetFlt(iterator);
@@ -214,47 +205,130 @@ filter_pixel {
             iterative_transparency_weight *= (1.0f - sub_sample_opacity);
 
             quota -= sub_sample_weight;
-            write_to_samples_map(&vals, sample_value, sub_sample_weight);
+            vals.add(sample_value, sub_sample_weight);
+
+            if (iterative_transparency_weight < transparency_epsilon) {
+                // what little is left behind goes to this sub sample, as below
+                stopped_samples++;
+                break;
+            }
         }
 
         if (quota > 0.0) {
             // the remaining values gets allocated to the last sample
-            write_to_samples_map(&vals, sample_value, quota);
+            vals.add(sample_value, quota);
         }
     }
 
-    ///////////////////////////////////////////////
-    //
-    //    Rank samples and make pixels
-    //
-    ///////////////////////////////////////////////
+    if (!early_out_samples) {
+        vals.clear();
+        total_weight = 0.0f;
+        return false;
+    }
+    if (stats) {
+        stats->counters[STAT_FILTER_PIXELS]++;
+        stats->counters[STAT_FILTER_SAVED_ITERATIONS] += early_out_samples;
+        stats->counters[STAT_FILTER_STOPPED_SAMPLES] += stopped_samples;
+    }
+    return true;
+}
+
+static bool accumulate_samples(const CryptomatteFilterData* data, AtAOVSampleIterator* iterator,
+                               SampleWeights& vals, float& total_weight) {
+    // Picks the weight kernel once per pixel, rather than once per sample.
+    const float epsilon = data->transparency_epsilon;
+    ThreadRenderStats* stats = g_render_stats.enabled() ? &g_render_stats.thread() : nullptr;
+    if (data->use_weight_table)
+        return accumulate_weighted_samples(data->weight_table, epsilon, iterator, vals,
+                                           total_weight, stats);
+
+    const float width = data->width;
+    switch (data->filter) {
+    case p_filter_triangle:
+        return accumulate_weighted_samples(AnalyticWeight<triangle>{width}, epsilon, iterator,
+                                           vals, total_weight, stats);
+    case p_filter_blackman_harris:
+        return accumulate_weighted_samples(AnalyticWeight<blackman_harris>{width}, epsilon,
+                                           iterator, vals, total_weight, stats);
+    case p_filter_box:
+        return accumulate_weighted_samples(AnalyticWeight<box>{width}, epsilon, iterator, vals,
+                                           total_weight, stats);
+    case p_filter_disk:
+        return accumulate_weighted_samples(AnalyticWeight<disk>{width}, epsilon, iterator, vals,
+                                           total_weight, stats);
+    case p_filter_cone:
+        return accumulate_weighted_samples(AnalyticWeight<cone>{width}, epsilon, iterator, vals,
+                                           total_weight, stats);
+    case p_filter_gaussian:
+    default:
+        return accumulate_weighted_samples(AnalyticWeight<gaussian>{width}, epsilon, iterator,
+                                           vals, total_weight, stats);
+    }
+}
 
-    // rank 0 means if vals.size() does not contain 0, we can stop
-    // rank 2 means if vals.size() does not contain 2, we can stop
-    if (vals.size() <= data->rank)
+static void write_rank(int rank, bool has_values, const IdWeight* ranked, size_t num_ranked,
+                       float total_weight, AtRGBA* out_value) {
+    // Writes the IDs and coverages at rank and rank + 1 of a pixel's ranking.
+    if (!has_values) {
+        if (rank == 0)
+            out_value->g = 1.0f;
         return;
+    }
 
-    sw_map_iterator_t vals_iter;
+    // rank 0 means if num_ranked does not contain 0, we can stop
+    // rank 2 means if num_ranked does not contain 2, we can stop
+    if (num_ranked <= (size_t)rank)
+        return;
 
-    std::vector<std::pair<float, float>> all_vals;
-    std::vector<std::pair<float, float>>::iterator all_vals_iter;
+    out_value->r = ranked[rank].id;
+    out_value->g = ranked[rank].weight / total_weight;
+    if (num_ranked > (size_t)rank + 1) {
+        out_value->b = ranked[rank + 1].id;
+        out_value->a = ranked[rank + 1].weight / total_weight;
+    }
+}
 
-    all_vals.reserve(vals.size());
-    for (vals_iter = vals.begin(); vals_iter != vals.end(); ++vals_iter)
-        all_vals.push_back(*vals_iter);
+///////////////////////////////////////////////
+//
+//    Filter proper
+//
+///////////////////////////////////////////////
 
-    std::sort(all_vals.begin(), all_vals.end(), compareTail());
+filter_pixel {
+    CryptomatteFilterData* data = (CryptomatteFilterData*)AiNodeGetLocalData(node);
+    if (data->noop)
+        return;
+    RenderStats::ScopedTimer timer(g_render_stats, STAT_FILTER_PIXEL);
 
-    int iter = 0;
-    for (all_vals_iter = all_vals.begin(); all_vals_iter != all_vals.end(); ++all_vals_iter) {
-        if (iter == data->rank) {
-            out_value->r = all_vals_iter->first;
-            out_value->g = (all_vals_iter->second / total_weight);
-        } else if (iter == data->rank + 1) {
-            out_value->b = all_vals_iter->first;
-            out_value->a = (all_vals_iter->second / total_weight);
-            return;
-        }
-        iter++;
+    AtRGBA* out_value = (AtRGBA*)data_out;
+    *out_value = AI_RGBA_ZERO;
+
+    SampleWeights& vals = tls_sample_weights;
+
+    if (data->rank_group.empty()) {
+        // only the entries at rank and rank + 1 are needed, so only those are sorted
+        float total_weight = 0.0f;
+        const bool has_values = accumulate_samples(data, iterator, vals, total_weight);
+        const size_t num_ranked = has_values ? vals.rank(data->rank + 2) : 0;
+        write_rank(data->rank, has_values, vals.data(), num_ranked, total_weight, out_value);
+        return;
+    }
+
+    // Rankings are shared by the group, so include every rank of the group.
+    int x = 0, y = 0;
+    AiAOVSampleIteratorGetPixel(iterator, x, y);
+    const void* group = data->rank_group.c_str();
+    const int rank_idx = data->rank / 2;
+
+    const PixelRanking* ranking =
+        tls_ranking_cache.find(group, x, y, rank_idx, data->rank_group_size);
+    if (!ranking) {
+        PixelRanking& entry = tls_ranking_cache.insert(group, x, y, rank_idx);
+        entry.has_values = accumulate_samples(data, iterator, vals, entry.total_weight);
+        const size_t num_ranked = entry.has_values ? vals.rank(data->rank_group_size * 2) : 0;
+        entry.ranked.assign(vals.data(), vals.data() + num_ranked);
+        ranking = &entry;
     }
+    write_rank(data->rank, ranking->has_values, ranking->ranked.data(), ranking->ranked.size(),
+               ranking->total_weight, out_value);
 }
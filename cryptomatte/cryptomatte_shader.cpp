@@ -1,6 +1,7 @@
 #include "cryptomatte.h"
 #include "cryptomatte_tests.h"
 #include <ai.h>
+#include <cstdio>
 #include <cstring>
 #include <string>
 
@@ -22,6 +23,11 @@ enum cryptomatteParams {
     p_process_obj_path_pipes,
     p_process_mat_path_pipes,
     p_process_legacy,
+    p_single_pass_filter,
+    p_binary_manifests,
+    p_transparency_epsilon,
+    p_render_stats,
+    p_render_stats_file,
     p_user_crypto_aov_0,
     p_user_crypto_src_0,
     p_user_crypto_aov_1,
@@ -30,6 +36,8 @@ enum cryptomatteParams {
     p_user_crypto_src_2,
     p_user_crypto_aov_3,
     p_user_crypto_src_3,
+    p_user_crypto_aovs,
+    p_user_crypto_srcs,
 };
 
 node_parameters {
@@ -48,6 +56,11 @@ node_parameters {
     AiParameterBool("process_obj_path_pipes", true);
     AiParameterBool("process_mat_path_pipes", true);
     AiParameterBool("process_legacy", true);
+    AiParameterBool("single_pass_filter", CRYPTO_SINGLEPASSFILTER_DEFAULT);
+    AiParameterBool("binary_manifests", CRYPTO_BINARYMANIFESTS_DEFAULT);
+    AiParameterFlt("transparency_epsilon", CRYPTO_TRANSPARENCYEPSILON_DEFAULT);
+    AiParameterBool("render_stats", CRYPTO_RENDERSTATS_DEFAULT);
+    AiParameterStr("render_stats_file", "");
     AiParameterStr("user_crypto_aov_0", "");
     AiParameterStr("user_crypto_src_0", "");
     AiParameterStr("user_crypto_aov_1", "");
@@ -56,6 +69,24 @@ node_parameters {
     AiParameterStr("user_crypto_src_2", "");
     AiParameterStr("user_crypto_aov_3", "");
     AiParameterStr("user_crypto_src_3", "");
+    AiParameterArray("user_crypto_aovs", AiArray(0, 1, AI_TYPE_STRING));
+    AiParameterArray("user_crypto_srcs", AiArray(0, 1, AI_TYPE_STRING));
+}
+
+static AtArray* get_user_cryptomatte_params(const AtNode* node, const char* param_prefix,
+                                            const char* array_param) {
+    // The four numbered parameters, followed by the array parameter.
+    const AtArray* extra = AiNodeGetArray(node, array_param);
+    const uint32_t num_extra = extra ? AiArrayGetNumElements(extra) : 0;
+    AtArray* params = AiArrayAllocate(4 + num_extra, 1, AI_TYPE_STRING);
+    char param_name[64];
+    for (uint32_t i = 0; i < 4; i++) {
+        sprintf(param_name, "%s%u", param_prefix, i);
+        AiArraySetStr(params, i, AiNodeGetStr(node, param_name));
+    }
+    for (uint32_t i = 0; i < num_extra; i++)
+        AiArraySetStr(params, 4 + i, AiArrayGetStr(extra, i));
+    return params;
 }
 
 node_plugin_initialize { return crypto_crit_sec_init(); }
@@ -80,6 +111,11 @@ node_update {
     data->set_option_sidecar_manifests(AiNodeGetBool(node, "sidecar_manifests"));
     data->set_option_channels(AiNodeGetInt(node, "cryptomatte_depth"),
                               AiNodeGetBool(node, "preview_in_exr"));
+    data->set_option_single_pass_filter(AiNodeGetBool(node, "single_pass_filter"));
+    data->set_option_binary_manifests(AiNodeGetBool(node, "binary_manifests"));
+    data->set_option_transparency_epsilon(AiNodeGetFlt(node, "transparency_epsilon"));
+    data->set_option_render_stats(AiNodeGetBool(node, "render_stats"),
+                                  AiNodeGetStr(node, "render_stats_file").c_str());
 
     CryptoNameFlag flags = CRYPTO_NAME_ALL;
     if (!AiNodeGetBool(node, "process_maya"))
@@ -101,16 +137,10 @@ node_update {
 
     data->set_option_namespace_stripping(obj_flags, mat_flags);
 
-    AtArray* uc_aov_array = AiArray(4, 1, AI_TYPE_STRING, //
-                                    AiNodeGetStr(node, "user_crypto_aov_0").c_str(),
-                                    AiNodeGetStr(node, "user_crypto_aov_1").c_str(),
-                                    AiNodeGetStr(node, "user_crypto_aov_2").c_str(),
-                                    AiNodeGetStr(node, "user_crypto_aov_3").c_str());
-    AtArray* uc_src_array = AiArray(4, 1, AI_TYPE_STRING, //
-                                    AiNodeGetStr(node, "user_crypto_src_0").c_str(),
-                                    AiNodeGetStr(node, "user_crypto_src_1").c_str(),
-                                    AiNodeGetStr(node, "user_crypto_src_2").c_str(),
-                                    AiNodeGetStr(node, "user_crypto_src_3").c_str());
+    AtArray* uc_aov_array =
+        get_user_cryptomatte_params(node, "user_crypto_aov_", "user_crypto_aovs");
+    AtArray* uc_src_array =
+        get_user_cryptomatte_params(node, "user_crypto_src_", "user_crypto_srcs");
 
     data->setup_all(universe, 
                     AiNodeGetStr(node, "aov_crypto_asset"), 
@@ -120,6 +150,8 @@ node_update {
                     uc_src_array, 
                     AiNodeGetBool(node, "custom_output_driver"), 
                     AiNodeGetBool(node, "create_depth_outputs"));
+    AiArrayDestroy(uc_aov_array);
+    AiArrayDestroy(uc_src_array);
 }
 
 shader_evaluate {
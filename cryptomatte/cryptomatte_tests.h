@@ -18,6 +18,10 @@ In this test suite, an assertion failure results in an AiMsgError.
 
 */
 
+#include "filters.h"
+#include "manifest_writer.h"
+#include "sample_weights.h"
+
 #define CRYPTO_TEST_FLAG "run_unit_tests"
 
 ///////////////////////////////////////////////
@@ -336,6 +340,387 @@ inline void run() {
 }
 
 } // namespace HashingTests
+namespace SampleWeightsTests {
+inline void assert_ranked(const char* msg, SampleWeights& weights, size_t count,
+                          const std::vector<IdWeight>& expected) {
+    const size_t ranked = weights.rank(count);
+    if (ranked != expected.size()) {
+        AiMsgError("SampleWeights: ((%s)) Expected %lu ranked entries, was %lu", msg,
+                   expected.size(), ranked);
+        return;
+    }
+    for (size_t i = 0; i < ranked; i++) {
+        if (weights[i].id != expected[i].id || weights[i].weight != expected[i].weight)
+            AiMsgError("SampleWeights: ((%s)) Rank %lu expected (%g, %g), was (%g, %g)", msg, i,
+                       expected[i].id, expected[i].weight, weights[i].id, weights[i].weight);
+    }
+}
+
+inline void few_ids() {
+    SampleWeights weights;
+    weights.add(3.0f, 0.25f);
+    weights.add(1.0f, 0.5f);
+    weights.add(3.0f, 0.5f);
+    weights.add(2.0f, 0.5f);
+    weights.add(0.0f, 0.125f);
+    // 1.0 and 2.0 tie, so go by ID
+    assert_ranked("few-1", weights, 3, {{3.0f, 0.75f}, {1.0f, 0.5f}, {2.0f, 0.5f}});
+    assert_ranked("few-2", weights, 10,
+                  {{3.0f, 0.75f}, {1.0f, 0.5f}, {2.0f, 0.5f}, {0.0f, 0.125f}});
+
+    weights.clear();
+    if (weights.size() != 0)
+        AiMsgError("SampleWeights: ((few-3)) Not empty after clear");
+    weights.add(-0.0f, 1.0f);
+    weights.add(0.0f, 1.0f);
+    assert_ranked("few-4", weights, 2, {{-0.0f, 2.0f}});
+}
+
+inline void many_ids() {
+    // enough IDs to go past the flat array and use the index, then add to all of them again
+    const int num_ids = (int)SampleWeights::FLAT_CAPACITY * 10;
+    SampleWeights weights;
+    for (int round = 0; round < 2; round++) {
+        for (int i = 0; i < num_ids; i++)
+            weights.add(hash_to_float((uint32_t)i * 2654435761u), (float)i);
+    }
+    if (weights.size() != (size_t)num_ids)
+        AiMsgError("SampleWeights: ((many-1)) Expected %d IDs, was %lu", num_ids, weights.size());
+    assert_ranked("many-2", weights, 2,
+                  {{hash_to_float((uint32_t)(num_ids - 1) * 2654435761u), 2.0f * (num_ids - 1)},
+                   {hash_to_float((uint32_t)(num_ids - 2) * 2654435761u), 2.0f * (num_ids - 2)}});
+}
+
+inline void ranking_cache() {
+    static const char group_a[] = "crypto_asset", group_b[] = "crypto_object";
+    RankingCache cache;
+    if (cache.find(group_a, 1, 2, 1, 3))
+        AiMsgError("RankingCache: ((cache-1)) Found a pixel in an empty cache");
+
+    PixelRanking& entry = cache.insert(group_a, 1, 2, 0);
+    entry.has_values = true;
+    entry.ranked.push_back({1.0f, 1.0f});
+    if (!cache.find(group_a, 1, 2, 1, 3))
+        AiMsgError("RankingCache: ((cache-2)) Rank 1 did not find the pixel rank 0 computed");
+    if (cache.find(group_b, 1, 2, 1, 3) || cache.find(group_a, 2, 1, 1, 3))
+        AiMsgError("RankingCache: ((cache-3)) Found a pixel of another group or position");
+    if (cache.find(group_a, 1, 2, 0, 3) || cache.find(group_a, 1, 2, 1, 3))
+        AiMsgError("RankingCache: ((cache-4)) A rank read the same pixel twice");
+
+    cache.insert(group_a, 1, 2, 0);
+    cache.find(group_a, 1, 2, 1, 3);
+    const PixelRanking* last = cache.find(group_a, 1, 2, 2, 3);
+    if (!last || last->has_values)
+        AiMsgError("RankingCache: ((cache-5)) Last rank did not find the recomputed pixel");
+    if (cache.find(group_a, 1, 2, 1, 3))
+        AiMsgError("RankingCache: ((cache-6)) Pixel was kept after all ranks read it");
+}
+
+inline void run() {
+    few_ids();
+    many_ids();
+    ranking_cache();
+}
+} // namespace SampleWeightsTests
+
+namespace FilterWeightTests {
+inline void assert_table_matches(const char* msg, float (*filter_func)(AtVector2, float)) {
+    const float widths[] = {1.0f, 2.0f, 3.0f, 4.0f, 6.0f};
+    for (const float width : widths) {
+        RadialWeightTable table;
+        table.build(filter_func, width);
+        const float radius = width * 0.5f;
+        for (int i = 0; i <= 100; i++) {
+            for (int j = 0; j <= 100; j++) {
+                const AtVector2 p((i / 50.0f - 1.0f) * radius * 1.1f,
+                                  (j / 50.0f - 1.0f) * radius * 1.1f);
+                // at the edge, the two can round to different sides
+                const float dist_squared = (p.x * p.x + p.y * p.y) / (radius * radius);
+                if (std::abs(dist_squared - 1.0f) < 1e-4f)
+                    continue;
+                const float error = std::abs(table(p) - filter_func(p, width));
+                if (error > FILTER_WEIGHT_TABLE_TOLERANCE) {
+                    AiMsgError("RadialWeightTable: ((%s)) width %g at (%g, %g) was off by %g", msg,
+                               width, p.x, p.y, error);
+                    return;
+                }
+            }
+        }
+    }
+}
+
+inline void run() {
+    assert_table_matches("gaussian", &gaussian);
+    assert_table_matches("blackman_harris", &blackman_harris);
+}
+} // namespace FilterWeightTests
+
+namespace NodeHashCacheTests {
+inline const AtNode* fake_node(size_t i) { return reinterpret_cast<const AtNode*>((i + 1) * 64); }
+
+inline AtRGB fake_hash(size_t i) {
+    AtRGB hash = AI_RGB_BLACK;
+    hash.r = (float)i;
+    return hash;
+}
+
+inline void find_inserted() {
+    NodeHashCache cache;
+    if (cache.find(fake_node(0)))
+        AiMsgError("NodeHashCache: ((cache-1)) Found a node before reset");
+    cache.reset(100);
+    for (size_t i = 0; i < 100; i++)
+        cache.insert(fake_node(i), true, fake_hash(i), fake_hash(i + 1), i % 2 == 0, fake_hash(i));
+    for (size_t i = 0; i < 100; i++) {
+        const NodeHashEntry* entry = cache.find(fake_node(i));
+        if (!entry || entry->node != fake_node(i) || entry->obj_hash_clr.r != (float)(i + 1) ||
+            entry->has_mat != (i % 2 == 0))
+            AiMsgError("NodeHashCache: ((cache-2)) Node %lu not found as inserted", i);
+    }
+    if (cache.find(fake_node(100)))
+        AiMsgError("NodeHashCache: ((cache-3)) Found a node never inserted");
+    cache.reset(100);
+    if (cache.find(fake_node(0)))
+        AiMsgError("NodeHashCache: ((cache-4)) Found a node after reset");
+}
+
+inline void bounded() {
+    // more nodes than the memory budget allows: some are not cached, none are wrong
+    NodeHashCache cache;
+    const size_t num_nodes = (CRYPTO_NODE_CACHE_MAX_MB << 20) / sizeof(NodeHashEntry) * 2;
+    cache.reset(num_nodes);
+    for (size_t i = 0; i < num_nodes; i++)
+        cache.insert(fake_node(i), true, fake_hash(i), fake_hash(i), true, fake_hash(i));
+    for (size_t i = 0; i < num_nodes; i++) {
+        const NodeHashEntry* entry = cache.find(fake_node(i));
+        if (entry && entry->nsp_hash_clr.r != (float)i) {
+            AiMsgError("NodeHashCache: ((cache-5)) Node %lu has another node's hash", i);
+            return;
+        }
+    }
+}
+
+inline void run() {
+    find_inserted();
+    bounded();
+}
+} // namespace NodeHashCacheTests
+
+namespace UserHashMemoTests {
+inline void run() {
+    std::unique_ptr<UserHashMemo> memo(new UserHashMemo());
+    const AtString names[] = {AtString("cube"), AtString("sphere"), AtString("cube")};
+    for (const AtString& name : names) {
+        if (memo->hash(name).r != hash_name_rgb(name.c_str()).r)
+            AiMsgError("User hash memo: ((memo-1)) Wrong hash for %s", name.c_str());
+    }
+    if (memo->hits != 1 || memo->misses != 2)
+        AiMsgError("User hash memo: ((memo-2)) %llu hits and %llu misses, not 1 and 2",
+                   (unsigned long long)memo->hits, (unsigned long long)memo->misses);
+
+    // more values than slots: evicted ones are hashed again, none are wrong
+    char name[32];
+    for (int pass = 0; pass < 2; pass++) {
+        for (size_t i = 0; i < 4 * UserHashMemo::NUM_SLOTS; i++) {
+            sprintf(name, "tag_%lu", (unsigned long)i);
+            const AtString value(name);
+            if (memo->hash(value).r != hash_name_rgb(name).r) {
+                AiMsgError("User hash memo: ((memo-3)) Wrong hash for %s", name);
+                return;
+            }
+        }
+    }
+}
+} // namespace UserHashMemoTests
+
+namespace UserCryptomattesTests {
+inline void run() {
+    // numbered like user_crypto_aov_N, with a blank, a duplicate, and more than the maximum
+    const uint32_t num_inputs = MAX_USER_CRYPTOMATTES + 6;
+    AtArray* aovs = AiArrayAllocate(num_inputs, 1, AI_TYPE_STRING);
+    AtArray* srcs = AiArrayAllocate(num_inputs, 1, AI_TYPE_STRING);
+    char name[32];
+    for (uint32_t i = 0; i < num_inputs; i++) {
+        sprintf(name, "user_aov_%u", i == 3 ? 2 : i);
+        AiArraySetStr(aovs, i, name);
+        sprintf(name, "user_src_%u", i);
+        AiArraySetStr(srcs, i, i == 1 ? "" : name);
+    }
+
+    UserCryptomattes user_cryptomattes;
+    user_cryptomattes.setup(aovs, srcs);
+    AiArrayDestroy(aovs);
+    AiArrayDestroy(srcs);
+    if (user_cryptomattes.count != MAX_USER_CRYPTOMATTES)
+        AiMsgError("User Cryptomattes: ((user-1)) %lu streams, not %d",
+                   (unsigned long)user_cryptomattes.count, MAX_USER_CRYPTOMATTES);
+    if (user_cryptomattes.count < 3 ||
+        user_cryptomattes.streams[1].aov != AtString("user_aov_2") ||
+        user_cryptomattes.streams[1].source != AtString("user_src_2") ||
+        user_cryptomattes.streams[2].aov != AtString("user_aov_4")) {
+        AiMsgError("User Cryptomattes: ((user-2)) Blank or duplicate entry not skipped");
+        return;
+    }
+
+    // only streams with AOV arrays are looked at while sampling
+    user_cryptomattes.collect_enabled();
+    if (!user_cryptomattes.enabled.empty())
+        AiMsgError("User Cryptomattes: ((user-3)) Streams enabled without outputs");
+    user_cryptomattes.streams[2].aov_array = AiArrayAllocate(1, 1, AI_TYPE_STRING);
+    user_cryptomattes.collect_enabled();
+    if (user_cryptomattes.enabled.size() != 1 ||
+        user_cryptomattes.enabled[0].aov != AtString("user_aov_4"))
+        AiMsgError("User Cryptomattes: ((user-4)) Wrong streams enabled");
+}
+} // namespace UserCryptomattesTests
+
+namespace ManifestWriterTests {
+inline void assert_encoded(const char* msg, const ManifestMap& map, size_t num_entries,
+                           const char* expected) {
+    String encoded = "prefix ";
+    encode_manifest(map, num_entries, encoded);
+    if (encoded != String("prefix ") + expected)
+        AiMsgError("Manifest encoding: ((%s)) %s, not %s", msg, encoded.c_str(), expected);
+}
+
+inline void binary() {
+    ManifestMap map;
+    map["cube"] = 1.0f;   // 3f800000
+    map["sphere"] = 0.5f; // 3f000000, so first by hash
+    const char expected[] = "CRYPTMNF\x01\0\0\0\x02\0\0\0"
+                            "\0\0\0\x3f\0\0\x80\x3f"
+                            "\0\0\0\0\x06\0\0\0\x0a\0\0\0"
+                            "spherecube";
+    String encoded;
+    if (!encode_binary_manifest(map, encoded) ||
+        encoded != String(expected, sizeof(expected) - 1))
+        AiMsgError("Manifest encoding: ((binary-1)) Binary manifest not as expected");
+}
+
+inline void run() {
+    ManifestMap map;
+    assert_encoded("manifest-1", map, 0, "{}");
+    map["heroCharacter"] = 0.5f;
+    assert_encoded("manifest-2", map, 1, "{\"heroCharacter\":\"3f000000\"}");
+    map["a/b\\c\"d"] = -2.0f;
+    assert_encoded("manifest-3", map, 2,
+                   "{\"a\\/b\\\\c\\\"d\":\"c0000000\",\"heroCharacter\":\"3f000000\"}");
+    // truncated manifests keep the trailing comma they always had
+    assert_encoded("manifest-4", map, 1, "{\"a\\/b\\\\c\\\"d\":\"c0000000\",}");
+    binary();
+}
+} // namespace ManifestWriterTests
+
+namespace EncodedManifestTests {
+inline void run() {
+    EncodedManifestCache cache;
+    ManifestMap map;
+    add_hash_to_map("cube", map);
+    add_hash_to_map("sphere", map);
+    const EncodedManifest first = cache.get("STRING cryptomatte/f834d0a/", map);
+    if (*first !=
+        "STRING cryptomatte/f834d0a/manifest {\"cube\":\"d9682f08\",\"sphere\":\"591e9a8d\"}")
+        AiMsgError("Encoded manifests: ((encoded-1)) Wrong manifest: %s", first->c_str());
+    if (cache.get("STRING cryptomatte/f834d0a/", map) != first)
+        AiMsgError("Encoded manifests: ((encoded-2)) Same manifest encoded again");
+    if (cache.content_hashes != 1)
+        AiMsgError("Encoded manifests: ((encoded-7)) Same map hashed %llu times in a setup",
+                   (unsigned long long)cache.content_hashes);
+    if (cache.get("STRING cryptomatte/9af1a45/", map) == first)
+        AiMsgError("Encoded manifests: ((encoded-3)) Manifest shared between streams");
+
+    ManifestMap changed = map;
+    add_hash_to_map("plane", changed);
+    if (cache.get("STRING cryptomatte/f834d0a/", changed) == first)
+        AiMsgError("Encoded manifests: ((encoded-4)) Changed manifest not encoded again");
+
+    cache.start_setup();
+    if (cache.get("STRING cryptomatte/f834d0a/", map) != first)
+        AiMsgError("Encoded manifests: ((encoded-5)) Manifest not kept for the next setup");
+    cache.start_setup();
+    cache.start_setup();
+    if (cache.get("STRING cryptomatte/f834d0a/", map) == first)
+        AiMsgError("Encoded manifests: ((encoded-6)) Unused manifest kept");
+}
+} // namespace EncodedManifestTests
+
+namespace ParallelManifestTests {
+inline void chunks_match_serial() {
+    // names repeat across chunks, as shared materials do
+    StringVector names;
+    for (size_t i = 0; i < 10 * CRYPTO_MANIFEST_CHUNK_SIZE + 7; i++)
+        names.push_back("shape_" + std::to_string(i % (3 * CRYPTO_MANIFEST_CHUNK_SIZE)));
+    ManifestMap serial;
+    for (const auto& name : names)
+        add_hash_to_map(name.c_str(), serial);
+
+    for (size_t num_workers = 1; num_workers <= 8; num_workers *= 2) {
+        ManifestMap merged;
+        std::vector<ManifestMap> worker_maps(num_workers - 1);
+        run_manifest_chunks(names.size(), num_workers, [&](size_t worker, size_t begin,
+                                                           size_t end) {
+            ManifestMap& map = worker ? worker_maps[worker - 1] : merged;
+            for (size_t i = begin; i < end; i++)
+                add_hash_to_map(names[i].c_str(), map);
+        });
+        for (const auto& worker_map : worker_maps)
+            merge_manifest(worker_map, merged);
+        if (merged != serial)
+            AiMsgError("Parallel manifests: ((parallel-1)) %lu workers differ from serial",
+                       num_workers);
+    }
+}
+
+inline void run() { chunks_match_serial(); }
+} // namespace ParallelManifestTests
+
+namespace RenderStatsTests {
+inline void run() {
+    RenderStats stats;
+    {
+        RenderStats::ScopedTimer timer(stats, STAT_FILTER_PIXEL);
+    }
+    if (!stats.empty())
+        AiMsgError("Render stats: ((stats-1)) Recorded while disabled");
+
+    stats.set_enabled(true);
+    auto record = [&stats]() {
+        for (int i = 0; i < 1000; i++) {
+            RenderStats::ScopedTimer timer(stats, STAT_DO_CRYPTOMATTES);
+            stats.thread().counters[STAT_FILTER_PIXELS]++;
+        }
+    };
+    std::thread other_thread(record);
+    record();
+    other_thread.join();
+    stats.record_stream("crypto_\"asset\"", 12, 345, false);
+    stats.set_counter("name_hash_misses", 7);
+
+    const ThreadRenderStats total = stats.totals();
+    if (total.timer_calls[STAT_DO_CRYPTOMATTES] != 2000 ||
+        total.counters[STAT_FILTER_PIXELS] != 2000 || total.timer_calls[STAT_FILTER_PIXEL] != 0)
+        AiMsgError("Render stats: ((stats-2)) Threads' stats not summed");
+
+    const std::string json = stats.to_json();
+    const char* expected[] = {"\"version\": 1", "\"do_cryptomattes\": {\"calls\": 2000",
+                              "\"filter_pixels\": 2000", "\"name_hash_misses\": 7",
+                              "\"crypto_\\\"asset\\\"\": {\"manifest_entries\": 12, "
+                              "\"manifest_bytes\": 345, \"sidecar\": false}"};
+    for (const char* entry : expected) {
+        if (json.find(entry) == std::string::npos)
+            AiMsgError("Render stats: ((stats-3)) %s not in %s", entry, json.c_str());
+    }
+    const size_t num_lines = NUM_STAT_TIMERS + NUM_STAT_COUNTERS + 2;
+    if (stats.summary_lines().size() != num_lines)
+        AiMsgError("Render stats: ((stats-4)) Summary has %lu lines, not %lu",
+                   (unsigned long)stats.summary_lines().size(), (unsigned long)num_lines);
+
+    stats.reset();
+    if (!stats.empty() || stats.totals().counters[STAT_FILTER_PIXELS] != 0)
+        AiMsgError("Render stats: ((stats-5)) Not cleared by reset");
+}
+} // namespace RenderStatsTests
+
 namespace SystemTests {
 inline void critical_section() {
     if (!g_critsec_active)
@@ -352,6 +737,15 @@ inline void run_all_unit_tests(AtNode* node) {
         NameParsingTests::run();
         HashingTests::run();
         MaterialNameTests::run();
+        SampleWeightsTests::run();
+        FilterWeightTests::run();
+        NodeHashCacheTests::run();
+        UserHashMemoTests::run();
+        UserCryptomattesTests::run();
+        ManifestWriterTests::run();
+        ParallelManifestTests::run();
+        EncodedManifestTests::run();
+        RenderStatsTests::run();
         SystemTests::run();
         AiMsgWarning("Cryptomatte unit tests: Complete");
     }
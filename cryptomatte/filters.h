@@ -1,5 +1,8 @@
+#pragma once
+
 #include <ai.h>
 #include <algorithm>
+#include <cmath>
 #include <map>
 #include <string>
 #include <vector>
@@ -16,7 +19,7 @@ enum filterEnum {
 static const char* filterEnumNames[] = {
     "gaussian", "blackman_harris", "triangle", "box", "disk", "cone", NULL};
 
-float gaussian(AtVector2 p, float width) {
+inline float gaussian(AtVector2 p, float width) {
     /* matches Arnold's exactly. */
     /* Sharpness=2 is good for width 2, sigma=1/sqrt(8) for the width=4,sharpness=4 case */
     // const float sigma = 0.5f;
@@ -40,7 +43,7 @@ float gaussian(AtVector2 p, float width) {
     }
 }
 
-float blackman_harris(AtVector2 p, float width) {
+inline float blackman_harris(AtVector2 p, float width) {
     // Close to matching Arnolds, but not exact.
     p /= (width * 0.5f);
 
@@ -61,13 +64,13 @@ float blackman_harris(AtVector2 p, float width) {
     return weight;
 }
 
-float box(AtVector2 p, float width) {
+inline float box(AtVector2 p, float width) {
     // The trick with matching arnold's filter here is making sure you give a value of 1.0 in the
     // filter update .
     return 1.0f;
 }
 
-float box_strict(AtVector2 p, float width) {
+inline float box_strict(AtVector2 p, float width) {
     // The trick with matching arnold's filter here is making sure you give a value of 1.0 in the
     // filter update.
     if (std::abs(p.x) > 1.0 || std::abs(p.y) > 1.0)
@@ -76,14 +79,14 @@ float box_strict(AtVector2 p, float width) {
         return 0.0f;
 }
 
-float triangle(AtVector2 p, float width) {
+inline float triangle(AtVector2 p, float width) {
     // Still does not match arnold's
     p /= (width * 0.5f);
     float weight = std::abs(p.x) + std::abs(p.y);
     return 2.0f - weight;
 }
 
-float disk(AtVector2 p, float width) {
+inline float disk(AtVector2 p, float width) {
     // Is now extremely close to arnold's
 
     p /= (width * 0.5f);
@@ -95,7 +98,7 @@ float disk(AtVector2 p, float width) {
     }
 }
 
-float cone(AtVector2 p, float width) {
+inline float cone(AtVector2 p, float width) {
     // Is now extremely close to arnold's
 
     p /= (width * 0.5f);
@@ -106,3 +109,59 @@ float cone(AtVector2 p, float width) {
         return 1.0f - distance;
     }
 }
+
+///////////////////////////////////////////////
+//
+//    Weight kernels
+//
+///////////////////////////////////////////////
+
+/*
+Kernels give the weight of a sample at an offset from the pixel center. The filter loop takes the
+kernel as a template parameter, so they inline into it instead of being called through a pointer
+per sample.
+*/
+
+template <float (*filter_func)(AtVector2, float)> struct AnalyticWeight {
+    float width;
+    float operator()(AtVector2 p) const { return filter_func(p, width); }
+};
+
+#define FILTER_WEIGHT_TABLE_SIZE 1024
+// Largest difference between RadialWeightTable and the analytic gaussian and blackman_harris,
+// away from the filter edge where the two may round to opposite sides. Checked by unit tests.
+#define FILTER_WEIGHT_TABLE_TOLERANCE 1e-5f
+
+struct RadialWeightTable {
+    /*
+    A radial filter tabulated over squared distance from the pixel center, normalized to [0, 1],
+    and linearly interpolated. Gaussian and Blackman-Harris are smooth in squared distance, so
+    this needs no square root, exp or cos per sample. (Cone is not, and is left analytic.)
+    */
+    float inv_radius_sq = 0.0f;
+    // weight at exactly the edge. Blackman-Harris drops to zero there, so the last table entry is
+    // the limit from inside.
+    float edge_weight = 0.0f;
+    float table[FILTER_WEIGHT_TABLE_SIZE + 1];
+
+    void build(float (*filter_func)(AtVector2, float), float width) {
+        const float radius = width * 0.5f;
+        inv_radius_sq = 1.0f / (radius * radius);
+        edge_weight = filter_func(AtVector2(radius, 0.0f), width);
+        for (int i = 0; i <= FILTER_WEIGHT_TABLE_SIZE; i++) {
+            float dist_squared = (float)i / FILTER_WEIGHT_TABLE_SIZE;
+            if (i == FILTER_WEIGHT_TABLE_SIZE)
+                dist_squared = std::nextafter(1.0f, 0.0f);
+            table[i] = filter_func(AtVector2(std::sqrt(dist_squared) * radius, 0.0f), width);
+        }
+    }
+
+    float operator()(AtVector2 p) const {
+        const float dist_squared = (p.x * p.x + p.y * p.y) * inv_radius_sq;
+        if (dist_squared >= 1.0f)
+            return dist_squared > 1.0f ? 0.0f : edge_weight;
+        const float pos = dist_squared * FILTER_WEIGHT_TABLE_SIZE;
+        const int i = (int)pos;
+        return table[i] + (table[i + 1] - table[i]) * (pos - (float)i);
+    }
+};
@@ -0,0 +1,187 @@
+#pragma once
+
+#include <algorithm>
+#include <cstdint>
+#include <cstdio>
+#include <cstring>
+#include <map>
+#include <string>
+#include <utility>
+#include <vector>
+
+///////////////////////////////////////////////
+//
+//    Manifest encoding
+//
+///////////////////////////////////////////////
+
+/*
+JSON encoding of a manifest, {"name":"<hex of float ID>",...}, with names in map order.
+
+Entries are written straight into the output string, escaping names and hex encoding IDs from
+lookup tables, rather than through sprintf and an intermediate string per entry. The output is
+sized for the whole manifest up front and grown geometrically if names run longer.
+*/
+
+struct ManifestEncoding {
+    // Characters escaped with a backslash in names.
+    bool escaped[256];
+    char hex_digits[17];
+
+    ManifestEncoding() : hex_digits("0123456789abcdef") {
+        std::memset(escaped, 0, sizeof(escaped));
+        escaped[(unsigned char)'"'] = true;
+        escaped[(unsigned char)'\\'] = true;
+        escaped[(unsigned char)'/'] = true;
+    }
+
+    static const ManifestEncoding& get() {
+        static const ManifestEncoding encoding;
+        return encoding;
+    }
+};
+
+// Bytes per encoded entry that the output is first sized for, "name":"01234567", plus a comma.
+static const size_t MANIFEST_ENTRY_SIZE_ESTIMATE = 48;
+
+template <typename Map>
+inline void encode_manifest(const Map& map, size_t num_entries, std::string& out) {
+    // Appends the first num_entries entries of the map to out. Entries are followed by a comma
+    // unless last in the map, so a truncated manifest ends with one.
+    const ManifestEncoding& encoding = ManifestEncoding::get();
+    size_t pos = out.size();
+    out.resize(pos + 2 + num_entries * MANIFEST_ENTRY_SIZE_ESTIMATE);
+
+    out[pos++] = '{';
+    typename Map::const_iterator map_it = map.begin();
+    for (size_t i = 0; i < num_entries; i++, ++map_it) {
+        const std::string& name = map_it->first;
+        // grown geometrically, so appending stays linear
+        const size_t needed = pos + 2 * name.size() + 15;
+        if (needed > out.size())
+            out.resize(std::max(needed, out.size() * 2));
+        char* p = &out[pos];
+
+        *p++ = '"';
+        for (const char c : name) {
+            if (encoding.escaped[(unsigned char)c])
+                *p++ = '\\';
+            *p++ = c;
+        }
+        *p++ = '"';
+        *p++ = ':';
+        *p++ = '"';
+
+        const float hash_value = map_it->second;
+        uint32_t float_bits;
+        std::memcpy(&float_bits, &hash_value, 4);
+        for (int shift = 28; shift >= 0; shift -= 4)
+            *p++ = encoding.hex_digits[(float_bits >> shift) & 0xf];
+
+        *p++ = '"';
+        if (i + 1 < map.size())
+            *p++ = ',';
+        pos = p - out.data();
+    }
+    out.resize(pos + 1);
+    out[pos] = '}';
+}
+
+///////////////////////////////////////////////
+//
+//    Binary manifests
+//
+///////////////////////////////////////////////
+
+/*
+Binary manifest, written as a sidecar next to the JSON one. It is never truncated, and is laid out
+to be memory mapped and searched in place. Integers are little endian uint32:
+
+    magic                   "CRYPTMNF", 8 bytes
+    version                 BINARY_MANIFEST_VERSION
+    count                   number of entries
+    hashes[count]           float ID bits, ascending (ties by name)
+    offsets[count + 1]      start of each name in names, then the end of the last one
+    names                   UTF-8 names in the order of hashes, not terminated
+
+Readers must reject other versions. Fields are only ever appended after names in a new version.
+*/
+
+static const char BINARY_MANIFEST_MAGIC[] = "CRYPTMNF";
+static const uint32_t BINARY_MANIFEST_VERSION = 1;
+static const size_t BINARY_MANIFEST_HEADER_SIZE = 16;
+
+inline char* put_uint32_le(char* p, uint32_t value) {
+    for (int i = 0; i < 4; i++)
+        *p++ = (char)((value >> (8 * i)) & 0xff);
+    return p;
+}
+
+template <typename Map>
+inline bool encode_binary_manifest(const Map& map, std::string& out) {
+    // Replaces out with the binary manifest of all entries of the map. Returns false if the
+    // manifest is too large for 32 bit offsets.
+    using HashedName = std::pair<uint32_t, const std::string*>;
+    std::vector<HashedName> entries;
+    entries.reserve(map.size());
+    uint64_t names_size = 0;
+    for (const auto& entry : map) {
+        uint32_t float_bits;
+        std::memcpy(&float_bits, &entry.second, 4);
+        entries.push_back(HashedName(float_bits, &entry.first));
+        names_size += entry.first.size();
+    }
+    if (names_size > UINT32_MAX || entries.size() >= UINT32_MAX)
+        return false;
+    std::sort(entries.begin(), entries.end(), [](const HashedName& x, const HashedName& y) {
+        return x.first < y.first || (x.first == y.first && *x.second < *y.second);
+    });
+
+    const size_t count = entries.size();
+    out.resize(BINARY_MANIFEST_HEADER_SIZE + 4 * count + 4 * (count + 1) + (size_t)names_size);
+    char* p = &out[0];
+    std::memcpy(p, BINARY_MANIFEST_MAGIC, 8);
+    p = put_uint32_le(p + 8, BINARY_MANIFEST_VERSION);
+    p = put_uint32_le(p, (uint32_t)count);
+    for (const auto& entry : entries)
+        p = put_uint32_le(p, entry.first);
+    uint32_t offset = 0;
+    for (const auto& entry : entries) {
+        p = put_uint32_le(p, offset);
+        offset += (uint32_t)entry.second->size();
+    }
+    p = put_uint32_le(p, offset);
+    for (const auto& entry : entries) {
+        std::memcpy(p, entry.second->data(), entry.second->size());
+        p += entry.second->size();
+    }
+    return true;
+}
+
+inline bool write_file(const char* path, const std::string& contents, bool binary = false) {
+    // Writes contents in one buffered write. Returns false if the file could not be written.
+    FILE* file = std::fopen(path, binary ? "wb" : "w");
+    if (!file)
+        return false;
+    const bool written = std::fwrite(contents.data(), 1, contents.size(), file) == contents.size();
+    return std::fclose(file) == 0 && written;
+}
+
+inline bool write_file_atomic(const char* path, const std::string& contents, bool binary = false) {
+    // Writes contents to a temporary file next to path, then renames it over path, so readers
+    // never see a partly written file.
+    const std::string temp_path = std::string(path) + ".tmp";
+    if (!write_file(temp_path.c_str(), contents, binary)) {
+        std::remove(temp_path.c_str());
+        return false;
+    }
+    if (std::rename(temp_path.c_str(), path) != 0) {
+        // rename does not replace existing files on Windows
+        std::remove(path);
+        if (std::rename(temp_path.c_str(), path) != 0) {
+            std::remove(temp_path.c_str());
+            return false;
+        }
+    }
+    return true;
+}
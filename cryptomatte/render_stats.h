@@ -0,0 +1,291 @@
+#pragma once
+
+#include "manifest_writer.h"
+#include <atomic>
+#include <chrono>
+#include <cstdint>
+#include <cstdio>
+#include <cstring>
+#include <map>
+#include <memory>
+#include <mutex>
+#include <string>
+#include <vector>
+
+///////////////////////////////////////////////
+//
+//    RenderStats
+//
+///////////////////////////////////////////////
+
+/*
+Render statistics of the plugin: where the shader, filters and manifest work spend their time,
+how well the caches do, and how large each stream's manifest is.
+
+Nothing is recorded unless enabled, as reading the clock on every sample is not free. Timers and
+counters are kept per thread, so recording takes no locks or atomics. A thread's are allocated the
+first time it records, and all threads' are summed when reporting, which must not happen while
+rendering. Counters kept elsewhere, such as cache hit counts, are set just before reporting.
+*/
+
+enum RenderStatTimer {
+    STAT_DO_CRYPTOMATTES,
+    STAT_FILTER_PIXEL,
+    STAT_COMPILE_STANDARD_MANIFESTS,
+    STAT_WRITE_METADATA_TO_DRIVER,
+    NUM_STAT_TIMERS
+};
+
+static const char* const RENDER_STAT_TIMER_NAMES[NUM_STAT_TIMERS] = {
+    "do_cryptomattes", "filter_pixel", "compile_standard_manifests", "write_metadata_to_driver"};
+
+enum RenderStatCounter {
+    // pixels with values
+    STAT_FILTER_PIXELS,
+    // sample iterations a separate early-out pass would have made
+    STAT_FILTER_SAVED_ITERATIONS,
+    // samples whose layers were cut short by transparency_epsilon
+    STAT_FILTER_STOPPED_SAMPLES,
+    NUM_STAT_COUNTERS
+};
+
+static const char* const RENDER_STAT_COUNTER_NAMES[NUM_STAT_COUNTERS] = {
+    "filter_pixels", "filter_saved_iterations", "filter_stopped_samples"};
+
+static const int RENDER_STATS_JSON_VERSION = 1;
+
+struct ThreadRenderStats {
+    uint64_t timer_calls[NUM_STAT_TIMERS];
+    uint64_t timer_nanoseconds[NUM_STAT_TIMERS];
+    uint64_t counters[NUM_STAT_COUNTERS];
+    // Keeps threads' stats off each other's cache lines, as they are allocated one by one.
+    char padding[64];
+
+    ThreadRenderStats() { clear(); }
+
+    void clear() {
+        std::memset(timer_calls, 0, sizeof(timer_calls));
+        std::memset(timer_nanoseconds, 0, sizeof(timer_nanoseconds));
+        std::memset(counters, 0, sizeof(counters));
+    }
+};
+
+struct StreamRenderStats {
+    uint64_t manifest_entries = 0;
+    // size of the embedded JSON manifest, 0 for sidecars
+    uint64_t manifest_bytes = 0;
+    bool sidecar = false;
+};
+
+class RenderStats {
+public:
+    using Clock = std::chrono::steady_clock;
+
+    class ScopedTimer {
+    public:
+        // Times the enclosing scope, if stats are enabled.
+        ScopedTimer(RenderStats& render_stats, RenderStatTimer timer)
+            : stats(render_stats.enabled() ? &render_stats.thread() : nullptr), timer(timer) {
+            if (stats)
+                start = Clock::now();
+        }
+
+        ~ScopedTimer() {
+            if (!stats)
+                return;
+            const auto elapsed = Clock::now() - start;
+            stats->timer_calls[timer]++;
+            stats->timer_nanoseconds[timer] +=
+                std::chrono::duration_cast<std::chrono::nanoseconds>(elapsed).count();
+        }
+
+        ScopedTimer(const ScopedTimer&) = delete;
+        ScopedTimer& operator=(const ScopedTimer&) = delete;
+
+    private:
+        ThreadRenderStats* stats;
+        RenderStatTimer timer;
+        Clock::time_point start;
+    };
+
+    RenderStats() : id(next_id().fetch_add(1)) {}
+
+    RenderStats(const RenderStats&) = delete;
+    RenderStats& operator=(const RenderStats&) = delete;
+
+    bool enabled() const { return is_enabled.load(std::memory_order_relaxed); }
+
+    void set_enabled(bool enabled) { is_enabled.store(enabled, std::memory_order_relaxed); }
+
+    ThreadRenderStats& thread() {
+        // Keyed by id rather than address, so a new RenderStats at the address of a destroyed one
+        // does not pick up its threads' stats.
+        static thread_local uint64_t owner_id = 0;
+        static thread_local ThreadRenderStats* stats = nullptr;
+        if (owner_id != id) {
+            std::lock_guard<std::mutex> lock(mutex);
+            threads.emplace_back(new ThreadRenderStats());
+            stats = threads.back().get();
+            owner_id = id;
+        }
+        return *stats;
+    }
+
+    void set_counter(const std::string& name, uint64_t value) {
+        std::lock_guard<std::mutex> lock(mutex);
+        extra_counters[name] = value;
+    }
+
+    void record_stream(const std::string& name, uint64_t manifest_entries,
+                       uint64_t manifest_bytes, bool sidecar) {
+        // Streams written to several drivers are recorded once per driver, with the same
+        // manifest.
+        std::lock_guard<std::mutex> lock(mutex);
+        StreamRenderStats& stream = streams[name];
+        stream.manifest_entries = manifest_entries;
+        stream.manifest_bytes = manifest_bytes;
+        stream.sidecar = sidecar;
+    }
+
+    ThreadRenderStats totals() const {
+        std::lock_guard<std::mutex> lock(mutex);
+        ThreadRenderStats total;
+        for (const auto& stats : threads) {
+            for (int i = 0; i < NUM_STAT_TIMERS; i++) {
+                total.timer_calls[i] += stats->timer_calls[i];
+                total.timer_nanoseconds[i] += stats->timer_nanoseconds[i];
+            }
+            for (int i = 0; i < NUM_STAT_COUNTERS; i++)
+                total.counters[i] += stats->counters[i];
+        }
+        return total;
+    }
+
+    bool empty() const {
+        const ThreadRenderStats total = totals();
+        for (int i = 0; i < NUM_STAT_TIMERS; i++) {
+            if (total.timer_calls[i])
+                return false;
+        }
+        std::lock_guard<std::mutex> lock(mutex);
+        return streams.empty();
+    }
+
+    std::vector<std::string> summary_lines() const {
+        // One line per timer, counter and stream, as "stats <kind> <name>: <values>".
+        const ThreadRenderStats total = totals();
+        std::lock_guard<std::mutex> lock(mutex);
+        std::vector<std::string> lines;
+        char line[512];
+        for (int i = 0; i < NUM_STAT_TIMERS; i++) {
+            const uint64_t calls = total.timer_calls[i];
+            snprintf(line, sizeof(line), "stats timer %s: %llu calls, %.6f seconds, %.1f ns/call",
+                     RENDER_STAT_TIMER_NAMES[i], (unsigned long long)calls,
+                     total.timer_nanoseconds[i] * 1e-9,
+                     calls ? double(total.timer_nanoseconds[i]) / calls : 0.0);
+            lines.push_back(line);
+        }
+        for (int i = 0; i < NUM_STAT_COUNTERS; i++) {
+            snprintf(line, sizeof(line), "stats counter %s: %llu", RENDER_STAT_COUNTER_NAMES[i],
+                     (unsigned long long)total.counters[i]);
+            lines.push_back(line);
+        }
+        for (const auto& counter : extra_counters) {
+            snprintf(line, sizeof(line), "stats counter %s: %llu", counter.first.c_str(),
+                     (unsigned long long)counter.second);
+            lines.push_back(line);
+        }
+        for (const auto& stream : streams) {
+            snprintf(line, sizeof(line), "stats stream %s: %llu manifest entries, %llu bytes, %s",
+                     stream.first.c_str(), (unsigned long long)stream.second.manifest_entries,
+                     (unsigned long long)stream.second.manifest_bytes,
+                     stream.second.sidecar ? "sidecar" : "embedded");
+            lines.push_back(line);
+        }
+        return lines;
+    }
+
+    std::string to_json() const {
+        // {"version": 1, "timers": {name: {"calls": n, "seconds": s}}, "counters": {name: n},
+        //  "streams": {name: {"manifest_entries": n, "manifest_bytes": n, "sidecar": b}}}
+        const ThreadRenderStats total = totals();
+        std::lock_guard<std::mutex> lock(mutex);
+        std::string json;
+        char value[128];
+        snprintf(value, sizeof(value), "{\n  \"version\": %d,\n  \"timers\": {",
+                 RENDER_STATS_JSON_VERSION);
+        json += value;
+        for (int i = 0; i < NUM_STAT_TIMERS; i++) {
+            json += i ? ",\n    " : "\n    ";
+            append_json_string(RENDER_STAT_TIMER_NAMES[i], json);
+            snprintf(value, sizeof(value), ": {\"calls\": %llu, \"seconds\": %.9f}",
+                     (unsigned long long)total.timer_calls[i], total.timer_nanoseconds[i] * 1e-9);
+            json += value;
+        }
+        json += "\n  },\n  \"counters\": {";
+        bool first = true;
+        for (int i = 0; i < NUM_STAT_COUNTERS; i++) {
+            append_json_counter(RENDER_STAT_COUNTER_NAMES[i], total.counters[i], first, json);
+            first = false;
+        }
+        for (const auto& counter : extra_counters)
+            append_json_counter(counter.first, counter.second, false, json);
+        json += "\n  },\n  \"streams\": {";
+        first = true;
+        for (const auto& stream : streams) {
+            json += first ? "\n    " : ",\n    ";
+            first = false;
+            append_json_string(stream.first, json);
+            snprintf(value, sizeof(value),
+                     ": {\"manifest_entries\": %llu, \"manifest_bytes\": %llu, \"sidecar\": %s}",
+                     (unsigned long long)stream.second.manifest_entries,
+                     (unsigned long long)stream.second.manifest_bytes,
+                     stream.second.sidecar ? "true" : "false");
+            json += value;
+        }
+        json += streams.empty() ? "}\n}\n" : "\n  }\n}\n";
+        return json;
+    }
+
+    void reset() {
+        // Clears all stats. Not thread safe, call when not rendering.
+        std::lock_guard<std::mutex> lock(mutex);
+        for (auto& stats : threads)
+            stats->clear();
+        extra_counters.clear();
+        streams.clear();
+    }
+
+private:
+    const uint64_t id;
+    std::atomic<bool> is_enabled{false};
+    mutable std::mutex mutex;
+    std::vector<std::unique_ptr<ThreadRenderStats>> threads;
+    std::map<std::string, uint64_t> extra_counters;
+    std::map<std::string, StreamRenderStats> streams;
+
+    static std::atomic<uint64_t>& next_id() {
+        static std::atomic<uint64_t> id{1};
+        return id;
+    }
+
+    static void append_json_string(const std::string& str, std::string& json) {
+        json += '"';
+        for (const char c : str) {
+            if (c == '"' || c == '\\')
+                json += '\\';
+            if ((unsigned char)c >= 0x20)
+                json += c;
+        }
+        json += '"';
+    }
+
+    static void append_json_counter(const std::string& name, uint64_t count, bool first,
+                                    std::string& json) {
+        json += first ? "\n    " : ",\n    ";
+        append_json_string(name, json);
+        char value[32];
+        snprintf(value, sizeof(value), ": %llu", (unsigned long long)count);
+        json += value;
+    }
+};
@@ -0,0 +1,198 @@
+#pragma once
+
+#include <algorithm>
+#include <cstdint>
+#include <cstring>
+#include <vector>
+
+///////////////////////////////////////////////
+//
+//    SampleWeights
+//
+///////////////////////////////////////////////
+
+/*
+Accumulated weight of each ID in a pixel, as used by the Cryptomatte filter.
+
+IDs are kept in a flat array in insertion order. Up to FLAT_CAPACITY IDs are found by a linear
+scan, which is faster than any tree or hash for the handful of IDs most pixels have. Past that, an
+open-addressed index into the array is built and used instead.
+
+The storage is meant to be reused between pixels (cleared, not freed), so that once it has grown
+to the largest pixel seen, accumulating a pixel does not allocate.
+*/
+
+struct IdWeight {
+    float id;
+    float weight;
+};
+
+class SampleWeights {
+public:
+    static const size_t FLAT_CAPACITY = 32;
+
+    void clear() {
+        entries.clear();
+        index.clear();
+    }
+
+    size_t size() const { return entries.size(); }
+
+    const IdWeight& operator[](size_t i) const { return entries[i]; }
+
+    const IdWeight* data() const { return entries.data(); }
+
+    void add(float id, float weight) {
+        if (index.empty()) {
+            for (auto& entry : entries) {
+                if (entry.id == id) {
+                    entry.weight += weight;
+                    return;
+                }
+            }
+            entries.push_back({id, weight});
+            if (entries.size() > FLAT_CAPACITY)
+                build_index();
+            return;
+        }
+
+        const uint32_t mask = (uint32_t)index.size() - 1;
+        for (uint32_t slot = slot_of(id) & mask;; slot = (slot + 1) & mask) {
+            const uint32_t i = index[slot];
+            if (i == 0) {
+                entries.push_back({id, weight});
+                index[slot] = (uint32_t)entries.size();
+                if (entries.size() * 2 > index.size())
+                    build_index();
+                return;
+            } else if (entries[i - 1].id == id) {
+                entries[i - 1].weight += weight;
+                return;
+            }
+        }
+    }
+
+    size_t rank(size_t count) {
+        // Moves the count heaviest entries to the front, heaviest first, and returns how many
+        // there are. The rest are left unordered. Ties go to the lower ID, as they did when
+        // entries came sorted by ID out of a std::map and were sorted by weight.
+        count = std::min(count, entries.size());
+        std::partial_sort(entries.begin(), entries.begin() + count, entries.end(),
+                          [](const IdWeight& x, const IdWeight& y) {
+                              return x.weight > y.weight || (x.weight == y.weight && x.id < y.id);
+                          });
+        // The index refers to positions which have just moved.
+        index.clear();
+        return count;
+    }
+
+private:
+    std::vector<IdWeight> entries;
+    // Open-addressed table of entry index + 1, or 0 for an empty slot. Size is a power of two.
+    std::vector<uint32_t> index;
+
+    static uint32_t slot_of(float id) {
+        // IDs are hashes already, so their bits only need folding. 0.0 and -0.0 are the same ID.
+        uint32_t bits = 0;
+        if (id != 0.0f)
+            std::memcpy(&bits, &id, 4);
+        return bits ^ (bits >> 16);
+    }
+
+    void build_index() {
+        size_t index_size = 64;
+        while (index_size < entries.size() * 4)
+            index_size *= 2;
+        index.assign(index_size, 0);
+
+        const uint32_t mask = (uint32_t)index_size - 1;
+        for (uint32_t i = 0; i < entries.size(); i++) {
+            uint32_t slot = slot_of(entries[i].id) & mask;
+            while (index[slot] != 0)
+                slot = (slot + 1) & mask;
+            index[slot] = i + 1;
+        }
+    }
+};
+
+///////////////////////////////////////////////
+//
+//    RankingCache
+//
+///////////////////////////////////////////////
+
+/*
+Rankings of pixels, shared between the rank filters of a Cryptomatte.
+
+Every rank AOV of a Cryptomatte (crypto_asset00, crypto_asset01, ...) receives the same samples,
+so every rank filter would compute the same ranking of a pixel. Filters of a group instead look
+up the pixel here, and only the first of them to get to it computes the ranking.
+
+Each entry records which ranks of its group have read it. It is dropped once all have, and is
+recomputed if a rank that already read it asks again, which happens when a pixel is filtered
+again in a later progressive or IPR pass. Entries are direct mapped by pixel, with one slot per
+pixel of a 64x64 bucket, so a clashing pixel only costs a recompute.
+
+One cache per thread, as a pixel's outputs are all filtered by the thread that rendered it.
+*/
+
+struct PixelRanking {
+    const void* group = nullptr;
+    int x = 0;
+    int y = 0;
+    uint64_t read_ranks = 0;
+    bool has_values = false;
+    float total_weight = 0.0f;
+    // heaviest first
+    std::vector<IdWeight> ranked;
+};
+
+class RankingCache {
+public:
+    static const int SLOT_BITS = 6;
+    static const size_t NUM_SLOTS = 1 << (2 * SLOT_BITS);
+
+    const PixelRanking* find(const void* group, int x, int y, int rank_idx, int group_size) {
+        // Returns the ranking of a pixel, if another rank of the group has computed it and this
+        // rank has not read it yet.
+        if (slots.empty())
+            return nullptr;
+        PixelRanking& entry = slots[slot_of(group, x, y)];
+        const uint64_t rank_bit = uint64_t(1) << rank_idx;
+        if (entry.group != group || entry.x != x || entry.y != y || (entry.read_ranks & rank_bit))
+            return nullptr;
+
+        entry.read_ranks |= rank_bit;
+        const uint64_t all_ranks =
+            group_size >= 64 ? ~uint64_t(0) : (uint64_t(1) << group_size) - 1;
+        if ((entry.read_ranks & all_ranks) == all_ranks)
+            entry.group = nullptr; // still valid until the slot is next inserted into
+        return &entry;
+    }
+
+    PixelRanking& insert(const void* group, int x, int y, int rank_idx) {
+        // Returns a cleared entry for a pixel, already marked as read by rank_idx.
+        if (slots.empty())
+            slots.resize(NUM_SLOTS);
+        PixelRanking& entry = slots[slot_of(group, x, y)];
+        entry.group = group;
+        entry.x = x;
+        entry.y = y;
+        entry.read_ranks = uint64_t(1) << rank_idx;
+        entry.has_values = false;
+        entry.total_weight = 0.0f;
+        entry.ranked.clear();
+        return entry;
+    }
+
+private:
+    std::vector<PixelRanking> slots;
+
+    static size_t slot_of(const void* group, int x, int y) {
+        // Unique within a bucket for a group. Groups are offset from one another by their address.
+        const size_t mask = (1 << SLOT_BITS) - 1;
+        const size_t group_bits = (size_t)((uintptr_t)group >> 4) * 2654435761u;
+        const size_t pixel_bits = ((size_t)y & mask) << SLOT_BITS | ((size_t)x & mask);
+        return pixel_bits ^ (group_bits & (NUM_SLOTS - 1));
+    }
+};
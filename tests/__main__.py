@@ -10,9 +10,59 @@ parser.add_argument(
     type=str,
     help="Wildcard enabled filter for test names (class or method names). Example: Cryptomatte*")
 
+parser.add_argument(
+    "-j",
+    "--jobs",
+    dest="jobs",
+    default=0,
+    type=int,
+    help="Number of kick renders to run at once. Default (0) uses one per core, 1 renders serially.")
+
+parser.add_argument(
+    "--fresh-render",
+    dest="fresh_render",
+    action="store_true",
+    help="Render every test case, even if a cached render with the same inputs exists.")
+
+parser.add_argument(
+    "--no-render-cache",
+    dest="use_render_cache",
+    action="store_false",
+    help="Do not read or write the render cache.")
+
+parser.add_argument(
+    "--render-cache-size",
+    dest="render_cache_mb",
+    default=None,
+    type=int,
+    help="Size limit of the render cache in MB. Least recently used renders are evicted.")
+
+parser.add_argument(
+    "--metadata-cache",
+    dest="persist_metadata",
+    action="store_true",
+    help="Keep parsed image metadata in tests/.metadata_cache between runs.")
+
+parser.add_argument(
+    "--timings",
+    dest="timings_file",
+    default=None,
+    type=str,
+    help="Write render, test and assertion timings to this JSON file, and print a summary.")
+
+parser.add_argument(
+    "--profile",
+    dest="profile_dir",
+    default=None,
+    type=str,
+    help="Write a cProfile dump of each test method to this directory.")
+
 args = parser.parse_args()
 
 if __name__ == '__main__':
     import tests
-    if tests.run_arnold_tests(args.filter):  # means it returned the results, i.e. failure
+    # returning the results means failure
+    if tests.run_arnold_tests(args.filter, args.jobs, args.use_render_cache, args.fresh_render,
+                              args.render_cache_mb, args.persist_metadata, args.timings_file,
+                              args.profile_dir):
         sys.exit()
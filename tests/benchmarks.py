@@ -0,0 +1,468 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+"""
+Benchmarks of the Cryptomatte plugin on large synthetic scenes.
+
+The scenes in tests/cryptomatte are small renders for checking results. These generate .ass
+scenes with a configurable number of nodes, render each with kick over a grid of resolutions,
+AA samples and cryptomatte_depth values, and write the timings and memory of every render to a
+JSON file. The scenes are:
+
+    instances       ginstances of one quad, each with its own name and asset override
+    materials       ginstances with a material each
+    transparency    stacks of TRANSPARENCY_LAYERS transparent quads, one material per layer
+    face_overrides  one grid polymesh with per-face crypto_object and crypto_material arrays
+    user_data       ginstances with string user data, read by two user Cryptomattes
+
+Scene size is the number of ginstances, quads or faces. Scenes are written to the output
+directory, and regenerated only if missing. Each render is recorded with its wall time, the
+timings and memory from its Arnold log (see timing.parse_arnold_log), and the plugin's render
+statistics (see render_stats.py):
+
+    {"version": 1, "arnold": "...", "host": "...", "build_dir": "...",
+     "runs": [{"scene": "instances", "size": 10000, "xres": 960, "yres": 540, "aa": 3,
+               "depth": 6, "wall_seconds": [...], "arnold": {...}, "cryptomatte_stats": {...}},
+              ...]}
+
+--compare reports runs that got slower than in an earlier results file.
+
+Usage:
+    python tests/benchmarks.py -o benchmark_results
+    python tests/benchmarks.py -s instances --sizes 1000000 --aa 1 --depth 6 12 -o results
+    python tests/benchmarks.py -o new --compare old/benchmarks.json
+"""
+import itertools
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import render_stats
+import timing
+
+BENCHMARKS_VERSION = 1
+TRANSPARENCY_LAYERS = 32
+# distinct values of the "shot" user data, so the second user Cryptomatte has a small manifest
+USER_DATA_SHOTS = 16
+
+DEFAULT_RESOLUTIONS = ("960x540", "1920x1080")
+DEFAULT_AA = (3, 6)
+DEFAULT_DEPTHS = (6, 12)
+
+#############################################
+# Scene generation
+#############################################
+
+_OPTIONS = """options
+{{
+ AA_samples 3
+ xres 960
+ yres 540
+ camera "camera"
+ outputs {num_outputs} 1 STRING
+{outputs}
+ aov_shaders 1 1 NODE
+  "cryptomatte"
+ GI_diffuse_depth 0
+ GI_specular_depth 0
+ GI_transmission_depth {transmission_depth}
+ auto_transparency_depth {transparency_depth}
+}}
+
+ortho_camera
+{{
+ name camera
+ matrix
+ 1 0 0 0
+ 0 1 0 0
+ 0 0 1 0
+ {center} {center} 100 1
+ screen_window_min -{half_width} -{half_width}
+ screen_window_max {half_width} {half_width}
+}}
+
+gaussian_filter
+{{
+ name filter
+ width 2
+}}
+
+driver_exr
+{{
+ name driver
+ filename "render.exr"
+ half_precision on
+}}
+
+cryptomatte
+{{
+ name cryptomatte
+ render_stats on
+{user_cryptomattes}}}
+
+"""
+
+_QUAD = """polymesh
+{{
+ name {name}
+ visibility {visibility}
+ nsides 1 1 UINT
+ 4
+ vidxs 4 1 UINT
+ 0 1 2 3
+ vlist 4 1 VECTOR
+ 0 0 0 0.9 0 0 0.9 0.9 0 0 0.9 0
+{extra}}}
+
+"""
+
+_INSTANCE = """ginstance
+{{
+ name {name}
+ node "quad"
+ visibility 255
+ matrix
+ 1 0 0 0
+ 0 1 0 0
+ 0 0 1 0
+ {x} {y} {z} 1
+ shader "{shader}"
+{extra}}}
+
+"""
+
+_MATERIAL = """standard_surface
+{{
+ name {name}
+ base_color {r} {g} {b}
+ opacity {opacity} {opacity} {opacity}
+}}
+
+"""
+
+
+def _grid_side(count):
+    return int(math.ceil(math.sqrt(max(count, 1))))
+
+
+def _write_header(f, side, user_cryptomattes=(), transparency_depth=10):
+    aovs = ["crypto_asset", "crypto_object", "crypto_material"]
+    aovs += [aov for aov, _ in user_cryptomattes]
+    outputs = ['  "RGBA RGBA filter driver"']
+    outputs += ['  "%s RGB filter driver"' % aov for aov in aovs]
+    user_params = "".join(' user_crypto_aov_%d "%s"\n user_crypto_src_%d "%s"\n' %
+                          (i, aov, i, src) for i, (aov, src) in enumerate(user_cryptomattes))
+    f.write(_OPTIONS.format(num_outputs=len(outputs), outputs="\n".join(outputs),
+                            transmission_depth=transparency_depth,
+                            transparency_depth=transparency_depth, center=side * 0.5,
+                            half_width=side * 0.5, user_cryptomattes=user_params))
+
+
+def _write_material(f, name, index, opacity=1.0):
+    # golden ratio hues, so neighbouring materials differ in the beauty
+    hue = (index * 0.618033988749895) % 1.0
+    f.write(_MATERIAL.format(name=name, r=hue, g=1.0 - hue, b=0.5, opacity=opacity))
+
+
+def _declare_string(name, value):
+    return ' declare %s constant STRING\n %s "%s"\n' % (name, name, value)
+
+
+def _write_instances(f, size, material_per_instance=False, user_data=False):
+    side = _grid_side(size)
+    user_cryptomattes = [("crypto_user", "crypto_user"), ("crypto_shot", "shot")]
+    _write_header(f, side, user_cryptomattes if user_data else ())
+    f.write(_QUAD.format(name="quad", visibility=0, extra=""))
+    if not material_per_instance:
+        _write_material(f, "material", 0)
+    for i in range(size):
+        shader = "material"
+        if material_per_instance:
+            shader = "/materials/material_%d" % i
+            _write_material(f, shader, i)
+        # ten instances per asset, as in sets dressed from a library
+        extra = _declare_string("crypto_asset", "asset_%d" % (i // 10))
+        if user_data:
+            extra += _declare_string("crypto_user", "/shot/layout/element_%d" % i)
+            extra += _declare_string("shot", "shot_%03d" % (i % USER_DATA_SHOTS))
+        f.write(_INSTANCE.format(name="/set/asset_%d/geo_%d" % (i // 10, i), x=i % side,
+                                 y=i // side, z=0, shader=shader, extra=extra))
+
+
+def write_instances_scene(f, size):
+    _write_instances(f, size)
+
+
+def write_materials_scene(f, size):
+    _write_instances(f, size, material_per_instance=True)
+
+
+def write_user_data_scene(f, size):
+    _write_instances(f, size, user_data=True)
+
+
+def write_transparency_scene(f, size):
+    layers = TRANSPARENCY_LAYERS
+    stacks = max(size // layers, 1)
+    side = _grid_side(stacks)
+    _write_header(f, side, transparency_depth=layers + 1)
+    f.write(_QUAD.format(name="quad", visibility=0, extra=" opaque off\n"))
+    for layer in range(layers):
+        _write_material(f, "/materials/layer_%d" % layer, layer, opacity=0.15)
+    for i in range(stacks):
+        for layer in range(layers):
+            f.write(_INSTANCE.format(name="/set/stack_%d/layer_%d" % (i, layer), x=i % side,
+                                     y=i // side, z=-layer, shader="/materials/layer_%d" % layer,
+                                     extra=" opaque off\n"))
+
+
+def write_face_overrides_scene(f, size):
+    side = _grid_side(size)
+    _write_header(f, side)
+    _write_material(f, "material", 0)
+    num_faces = side * side
+
+    f.write("polymesh\n{\n name /set/grid\n shader \"material\"\n")
+    f.write(" nsides %d 1 UINT\n" % num_faces)
+    for row in range(side):
+        f.write(" %s\n" % " ".join(["4"] * side))
+    f.write(" vidxs %d 1 UINT\n" % (4 * num_faces))
+    verts = side + 1
+    for row in range(side):
+        quads = []
+        for col in range(side):
+            v = row * verts + col
+            quads.append("%d %d %d %d" % (v, v + 1, v + 1 + verts, v + verts))
+        f.write(" %s\n" % " ".join(quads))
+    f.write(" vlist %d 1 VECTOR\n" % (verts * verts))
+    for row in range(verts):
+        f.write(" %s\n" % " ".join(["%d %d 0" % (col, row) for col in range(verts)]))
+    # a hundred faces per object, and ten objects per material
+    for udata, per_name, pattern in (("crypto_object", 100, "/set/grid/part_%d"),
+                                     ("crypto_material", 1000, "/materials/face_material_%d")):
+        f.write(" declare %s uniform STRING\n %s %d 1 STRING\n" % (udata, udata, num_faces))
+        for start in range(0, num_faces, side):
+            names = ['"%s"' % (pattern % (face // per_name))
+                     for face in range(start, min(start + side, num_faces))]
+            f.write(" %s\n" % " ".join(names))
+    f.write("}\n\n")
+
+
+SCENES = {
+    "instances": (write_instances_scene, (10000, 100000, 1000000)),
+    "materials": (write_materials_scene, (10000, 100000)),
+    "transparency": (write_transparency_scene, (10000, )),
+    "face_overrides": (write_face_overrides_scene, (10000, 1000000)),
+    "user_data": (write_user_data_scene, (10000, 100000, 1000000)),
+}
+
+
+def generate_scene(scene, size, scene_dir):
+    """ Path of the .ass file of a scene at size, written unless it already exists """
+    path = os.path.join(scene_dir, "%s_%d.ass" % (scene, size))
+    if os.path.isfile(path):
+        return path
+    if not os.path.isdir(scene_dir):
+        os.makedirs(scene_dir)
+    write_scene = SCENES[scene][0]
+    # written to a temporary file, so an interrupted run does not leave a partial scene
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write("### Cryptomatte benchmark scene: %s, size %d\n\n" % (scene, size))
+        write_scene(f, size)
+    os.rename(temp_path, path)
+    return path
+
+
+#############################################
+# Rendering
+#############################################
+
+
+def parse_resolution(value):
+    """ (xres, yres) from "<xres>x<yres>" """
+    try:
+        xres, yres = value.lower().split("x")
+        return int(xres), int(yres)
+    except ValueError:
+        raise ValueError("Resolution should be <xres>x<yres>, not %s" % value)
+
+
+def arnold_version():
+    try:
+        proc = subprocess.Popen(["kick", "-av"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, _ = proc.communicate()
+    except OSError:
+        return None
+    return out.decode("utf-8", "replace").strip() or None
+
+
+def build_dir():
+    file_dir = os.path.abspath(os.path.dirname(__file__))
+    return os.path.normpath(os.path.join(file_dir, "..", "build")).replace("\\", "/")
+
+
+def kick(ass_path, run_dir, xres, yres, aa, depth, threads=0, verbosity=2):
+    """
+    Renders a scene into run_dir with the given settings. Returns the wall time in seconds and
+    the paths of the Arnold log and the render statistics file.
+    """
+    if not os.path.isdir(run_dir):
+        os.makedirs(run_dir)
+    log_path = os.path.join(run_dir, "log.txt")
+    stats_path = os.path.join(run_dir, "render_stats.json")
+    for path in (log_path, stats_path):
+        if os.path.isfile(path):
+            os.remove(path)
+    cmd = ["kick", "-i", os.path.abspath(ass_path), "-v", str(verbosity), "-t", str(threads),
+           "-dw", "-dp", "-nostdin", "-logfile", log_path,
+           "-set", "options.xres", str(xres), "-set", "options.yres", str(yres),
+           "-set", "options.AA_samples", str(aa),
+           "-set", "cryptomatte.cryptomatte_depth", str(depth),
+           "-set", "cryptomatte.render_stats_file", stats_path]
+    env = os.environ.copy()
+    env["ARNOLD_PLUGIN_PATH"] = os.pathsep.join([build_dir(), env.get("ARNOLD_PLUGIN_PATH", "")])
+    start = time.time()
+    # the log is written to log_path, so kick's own output is dropped
+    with open(os.devnull, "w") as devnull:
+        proc = subprocess.Popen(cmd, cwd=run_dir, env=env, stdout=devnull, stderr=subprocess.PIPE)
+        _, err = proc.communicate()
+    seconds = time.time() - start
+    if proc.returncode != 0:
+        raise RuntimeError("kick failed with return code %s: %s\n%s" %
+                           (proc.returncode, " ".join(cmd), err.decode("utf-8", "replace")))
+    return seconds, log_path, stats_path
+
+
+def run_benchmark(ass_path, run_dir, xres, yres, aa, depth, repeat=1, threads=0):
+    """ Renders a scene repeat times, returning the wall times and the last render's log """
+    result = {"wall_seconds": []}
+    for _ in range(repeat):
+        seconds, log_path, stats_path = kick(ass_path, run_dir, xres, yres, aa, depth, threads)
+        result["wall_seconds"].append(seconds)
+    result["arnold"] = timing.parse_arnold_log(log_path)
+    result["cryptomatte_stats"] = None
+    if os.path.isfile(stats_path):
+        result["cryptomatte_stats"] = render_stats.load(stats_path)
+    return result
+
+
+def run_benchmarks(output_dir, scenes=None, sizes=None, resolutions=DEFAULT_RESOLUTIONS,
+                   aa_samples=DEFAULT_AA, depths=DEFAULT_DEPTHS, repeat=1, threads=0,
+                   stream=sys.stdout):
+    """
+    Renders every combination of scene, size, resolution, AA samples and depth. sizes defaults
+    to each scene's own sizes. Results are written to <output_dir>/benchmarks.json after each
+    render, so an interrupted run keeps what it finished.
+    """
+    scene_dir = os.path.join(output_dir, "scenes")
+    results = {
+        "version": BENCHMARKS_VERSION,
+        "arnold": arnold_version(),
+        "host": platform.node(),
+        "build_dir": build_dir(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "runs": [],
+    }
+    results_path = os.path.join(output_dir, "benchmarks.json")
+    for scene in scenes or sorted(SCENES):
+        for size in sizes or SCENES[scene][1]:
+            start = time.time()
+            ass_path = generate_scene(scene, size, scene_dir)
+            stream.write("%s %d: scene written in %.1fs\n" % (scene, size, time.time() - start))
+            for resolution, aa, depth in itertools.product(resolutions, aa_samples, depths):
+                xres, yres = parse_resolution(resolution)
+                run = {"scene": scene, "size": size, "xres": xres, "yres": yres, "aa": aa,
+                       "depth": depth}
+                run_dir = os.path.join(output_dir, "renders", run_name(run))
+                run.update(run_benchmark(ass_path, run_dir, xres, yres, aa, depth, repeat,
+                                         threads))
+                results["runs"].append(run)
+                write_results(results, results_path)
+                stream.write("  %s: %.2fs, %s MB peak\n" %
+                             (run_name(run), min(run["wall_seconds"]), peak_memory_mb(run)))
+    return results
+
+
+def run_name(run):
+    return "%(scene)s_%(size)d_%(xres)dx%(yres)d_aa%(aa)d_depth%(depth)d" % run
+
+
+def peak_memory_mb(run):
+    memory = run["arnold"]["memory_mb"]
+    return memory.get("peak CPU memory used", memory.get("peak memory used"))
+
+
+def write_results(results, path):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    if os.path.isfile(path):
+        # rename does not replace existing files on Windows
+        os.remove(path)
+    os.rename(temp_path, path)
+
+
+def compare(baseline, results, threshold=0.1, stream=sys.stdout):
+    """
+    Reports runs whose best wall time is more than threshold (a fraction) slower than the same
+    run in baseline. Returns the names of the slower runs.
+    """
+    baseline_runs = dict((run_name(run), run) for run in baseline["runs"])
+    slower = []
+    for run in results["runs"]:
+        name = run_name(run)
+        if name not in baseline_runs:
+            continue
+        before = min(baseline_runs[name]["wall_seconds"])
+        after = min(run["wall_seconds"])
+        if before > 0 and after > before * (1.0 + threshold):
+            slower.append(name)
+            stream.write("Slower: %s: %.2fs -> %.2fs (%+.0f%%)\n" %
+                         (name, before, after, 100.0 * (after - before) / before))
+    stream.write("%d of %d runs slower than the baseline\n" % (len(slower), len(results["runs"])))
+    return slower
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmarks Cryptomatte on synthetic scenes.")
+    parser.add_argument("-o", "--output", required=True,
+                        help="directory for scenes, renders and benchmarks.json")
+    parser.add_argument("-s", "--scenes", nargs="+", choices=sorted(SCENES),
+                        help="scenes to render (default: all)")
+    parser.add_argument("--sizes", nargs="+", type=int,
+                        help="scene sizes, in instances or faces (default: per scene)")
+    parser.add_argument("--resolutions", nargs="+", default=DEFAULT_RESOLUTIONS,
+                        help="resolutions as <xres>x<yres> (default: %(default)s)")
+    parser.add_argument("--aa", nargs="+", type=int, default=DEFAULT_AA,
+                        help="AA_samples values (default: %(default)s)")
+    parser.add_argument("--depth", nargs="+", type=int, default=DEFAULT_DEPTHS,
+                        help="cryptomatte_depth values (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=1, help="renders per run")
+    parser.add_argument("-t", "--threads", type=int, default=0,
+                        help="kick threads, 0 for all cores")
+    parser.add_argument("--compare", metavar="BASELINE",
+                        help="earlier benchmarks.json to report slower runs against")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="fraction slower than the baseline that is reported")
+    args = parser.parse_args(argv)
+
+    for resolution in args.resolutions:
+        parse_resolution(resolution)
+    results = run_benchmarks(args.output, args.scenes, args.sizes, args.resolutions, args.aa,
+                             args.depth, args.repeat, args.threads)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results, args.threshold)
+
+
+if __name__ == "__main__":
+    main()
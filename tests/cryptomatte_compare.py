@@ -0,0 +1,244 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+"""
+Batched, NumPy based image comparisons used by the Cryptomatte tests.
+
+These replace per-pixel Python loops (getpixel and a dict per pixel) with whole-image array
+operations, so verification plates at 2K and 4K compare in seconds rather than minutes.
+"""
+import collections
+
+try:
+    from itertools import izip
+except ImportError:
+    izip = zip
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import OpenImageIO as oiio
+except ImportError:
+    oiio = None
+
+# Number of pixels reduced at once. Bounds the size of temporaries, not the result.
+PIXEL_CHUNK = 1 << 18
+# Scanlines read at once by streaming reads, rounded up to whole tiles for tiled images.
+BLOCK_ROWS = 64
+
+ChannelError = collections.namedtuple(
+    "ChannelError", ["name", "rms", "max_error", "worst_pixel", "squared_error", "count"])
+
+
+def rank_channel_range(ch_pair_idxs):
+    """ Returns (chbegin, chend) covering every channel in a list of (id, coverage) pairs """
+    flat = [idx for pair in ch_pair_idxs for idx in pair]
+    return min(flat), max(flat) + 1
+
+
+def image_roi(spec, chbegin=None, chend=None):
+    """ Returns the data window of an ImageSpec as an ROI, optionally limited to channels """
+    chbegin = 0 if chbegin is None else chbegin
+    chend = spec.nchannels if chend is None else chend
+    return oiio.ROI(spec.x, spec.x + spec.width, spec.y, spec.y + spec.height, spec.z,
+                    spec.z + max(spec.depth, 1), chbegin, chend)
+
+
+def read_rank_pairs(img, ch_pair_idxs):
+    """
+    Reads all rank channel pairs of one Cryptomatte stream with a single get_pixels call.
+
+    Returns (ids, coverages), float32 arrays of shape (num_pixels, num_ranks), in the order of
+    ch_pair_idxs.
+    """
+    chbegin, chend = rank_channel_range(ch_pair_idxs)
+    pixels = img.get_pixels(oiio.FLOAT, image_roi(img.spec(), chbegin, chend))
+    pixels = np.asarray(pixels, dtype=np.float32).reshape(-1, chend - chbegin)
+    ids = pixels[:, [x - chbegin for x, _ in ch_pair_idxs]]
+    coverages = pixels[:, [y - chbegin for _, y in ch_pair_idxs]]
+    return ids, coverages
+
+
+def _group_starts(pixels, ids):
+    """ Boolean mask of the first entry of each run of equal (pixel, id) keys in sorted arrays """
+    starts = np.ones(len(pixels), dtype=bool)
+    starts[1:] = (pixels[1:] != pixels[:-1]) | (ids[1:] != ids[:-1])
+    return starts
+
+
+def _flatten_last_wins(ids, coverages, first_pixel):
+    """
+    Flattens (num_pixels, num_ranks) arrays into (pixel, id, coverage) triples with one entry per
+    ID per pixel. Where an ID appears in several ranks of a pixel the last rank wins, as it does
+    when a pixel is turned into an {id: coverage} dict.
+    """
+    num_pixels, num_ranks = ids.shape
+    pixels = np.repeat(np.arange(first_pixel, first_pixel + num_pixels), num_ranks)
+    ranks = np.tile(np.arange(num_ranks), num_pixels)
+    ids = ids.ravel()
+    coverages = coverages.ravel()
+
+    order = np.lexsort((ranks, ids, pixels))
+    pixels, ids, coverages = pixels[order], ids[order], coverages[order]
+    last = np.empty(len(pixels), dtype=bool)
+    last[:-1] = _group_starts(pixels, ids)[1:]
+    last[-1:] = True
+    return pixels[last], ids[last], coverages[last]
+
+
+def coverage_errors(result_ids, result_covs, correct_ids, correct_covs, big_dif_tolerance):
+    """
+    Per-ID coverage error between two images of one Cryptomatte stream.
+
+    Inputs are (num_pixels, num_ranks) arrays as returned by read_rank_pairs. Each pixel is treated
+    as a set of IDs. IDs present in the correct pixel are compared against the result coverage of
+    the same ID (0.0 if missing), and IDs only present in the result count with their full coverage.
+
+    Returns (total_count, squared_error, very_different_count), where total_count is the number
+    of (pixel, ID) entries compared.
+    """
+    total_count = 0
+    squared_error = 0.0
+    very_different_count = 0
+    num_pixels = result_ids.shape[0]
+
+    for begin in range(0, num_pixels, PIXEL_CHUNK):
+        end = min(begin + PIXEL_CHUNK, num_pixels)
+        r_pix, r_ids, r_covs = _flatten_last_wins(result_ids[begin:end], result_covs[begin:end],
+                                                  begin)
+        c_pix, c_ids, c_covs = _flatten_last_wins(correct_ids[begin:end],
+                                                  correct_covs[begin:end], begin)
+
+        pixels = np.concatenate((r_pix, c_pix))
+        ids = np.concatenate((r_ids, c_ids))
+        covs = np.concatenate((r_covs, c_covs)).astype(np.float64)
+        is_correct = np.concatenate((np.zeros(len(r_pix), bool), np.ones(len(c_pix), bool)))
+
+        order = np.lexsort((is_correct, ids, pixels))
+        pixels, ids, covs, is_correct = pixels[order], ids[order], covs[order], is_correct[order]
+
+        # segmented reduction: one group per (pixel, id), holding at most one entry per image.
+        group = np.cumsum(_group_starts(pixels, ids)) - 1
+        num_groups = int(group[-1]) + 1 if len(group) else 0
+        correct_cov = np.zeros(num_groups)
+        result_cov = np.zeros(num_groups)
+        has_correct = np.zeros(num_groups, dtype=bool)
+        correct_cov[group[is_correct]] = covs[is_correct]
+        has_correct[group[is_correct]] = True
+        result_cov[group[~is_correct]] = covs[~is_correct]
+
+        deltas = np.where(has_correct, np.abs(correct_cov - result_cov), result_cov)
+        total_count += num_groups
+        squared_error += float(np.dot(deltas, deltas))
+        very_different_count += int(np.count_nonzero(deltas > big_dif_tolerance))
+
+    return total_count, squared_error, very_different_count
+
+
+#############################################
+# Streaming reads and comparisons
+#############################################
+
+def read_rows(image_input, ybegin, yend, chbegin, chend):
+    """
+    Reads rows [ybegin, yend) of channels [chbegin, chend) from an open ImageInput, as float32 of
+    shape (rows, width, channels). Tiled images must be read in whole tile rows, or to the end.
+    """
+    spec = image_input.spec()
+    if spec.tile_width:
+        pixels = image_input.read_tiles(0, 0, spec.x, spec.x + spec.width, ybegin, yend, spec.z,
+                                        spec.z + max(spec.depth, 1), chbegin, chend, oiio.FLOAT)
+    else:
+        pixels = image_input.read_scanlines(0, 0, ybegin, yend, spec.z, chbegin, chend,
+                                            oiio.FLOAT)
+    if pixels is None:
+        raise IOError("Could not read rows %s to %s: %s" % (ybegin, yend, image_input.geterror()))
+    return np.asarray(pixels, dtype=np.float32).reshape(yend - ybegin, spec.width,
+                                                        chend - chbegin)
+
+
+def aligned_block_rows(block_rows, *specs):
+    """ block_rows rounded up to a whole number of tiles of every tiled spec """
+    step = 1
+    for spec in specs:
+        if spec.tile_height:
+            a, b = step, spec.tile_height
+            while b:
+                a, b = b, a % b
+            step = step * spec.tile_height // a
+    return -(-block_rows // step) * step
+
+
+def iter_row_blocks(image_input, chbegin, chend, block_rows=BLOCK_ROWS):
+    """
+    Yields (ybegin, pixels) blocks of the data window, as read by read_rows. block_rows is rounded
+    up to whole tiles; images read in lockstep should be given aligned_block_rows of both.
+    """
+    spec = image_input.spec()
+    block_rows = aligned_block_rows(block_rows, spec)
+    for ybegin in range(spec.y, spec.y + spec.height, block_rows):
+        yend = min(ybegin + block_rows, spec.y + spec.height)
+        yield ybegin, read_rows(image_input, ybegin, yend, chbegin, chend)
+
+
+def open_image_input(path):
+    image_input = oiio.ImageInput.open(path)
+    if not image_input:
+        raise IOError("Could not open %s: %s" % (path, oiio.geterror()))
+    return image_input
+
+
+def channel_errors(result_path, correct_path, channels, block_rows=BLOCK_ROWS):
+    """
+    Compares channels (indices) of two images with the same data window and channel layout,
+    reading both a block of rows at a time, so memory is bounded by the block size.
+
+    Returns a ChannelError per channel, in the order given. worst_pixel is the (x, y) of the
+    largest absolute error, or None if the images have no pixels.
+    """
+    channels = list(channels)
+    if not channels:
+        return []
+    result_input = open_image_input(result_path)
+    correct_input = open_image_input(correct_path)
+    try:
+        spec = result_input.spec()
+        correct_spec = correct_input.spec()
+        window = (spec.x, spec.y, spec.width, spec.height)
+        if window != (correct_spec.x, correct_spec.y, correct_spec.width, correct_spec.height):
+            raise ValueError("Data windows of %s and %s differ" % (result_path, correct_path))
+        block_rows = aligned_block_rows(block_rows, spec, correct_spec)
+        chbegin, chend = min(channels), max(channels) + 1
+        idxs = [ch - chbegin for ch in channels]
+        squared_errors = np.zeros(len(channels))
+        max_errors = np.zeros(len(channels))
+        worst_pixels = [None] * len(channels)
+
+        blocks = izip(iter_row_blocks(result_input, chbegin, chend, block_rows),
+                      iter_row_blocks(correct_input, chbegin, chend, block_rows))
+        for (ybegin, result_pixels), (_, correct_pixels) in blocks:
+            deltas = np.abs(result_pixels[..., idxs] - correct_pixels[..., idxs], dtype=np.float64)
+            deltas = deltas.reshape(-1, len(channels))
+            squared_errors += np.einsum("ij,ij->j", deltas, deltas)
+            worst = deltas.argmax(axis=0)
+            for i, pixel in enumerate(worst):
+                if worst_pixels[i] is None or deltas[pixel, i] > max_errors[i]:
+                    max_errors[i] = deltas[pixel, i]
+                    worst_pixels[i] = (spec.x + int(pixel) % spec.width,
+                                       ybegin + int(pixel) // spec.width)
+    finally:
+        result_input.close()
+        correct_input.close()
+
+    count = spec.width * spec.height
+    return [
+        ChannelError(spec.channelnames[ch], float(squared_errors[i] / count)**0.5 if count else 0.0,
+                     float(max_errors[i]), worst_pixels[i], float(squared_errors[i]), count)
+        for i, ch in enumerate(channels)
+    ]
@@ -0,0 +1,387 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+"""
+Matte extraction from Cryptomatte EXRs.
+
+Only the rank channels of the requested stream are read, a block of scanlines (or a row of tiles)
+at a time, so memory is bounded by the block size rather than the image size. Names are turned
+into IDs through the stream's manifest, and the coverage of every rank holding one of those IDs is
+summed into a float32 mask.
+
+Batch mode decodes the rank channels once and keeps the coverage of every ID sparsely
+(SparseMattes), so all mattes of a stream can be written without rereading the image.
+
+Usage:
+    python cryptomatte_extract.py image.exr crypto_asset heroCharacter -o hero_matte.exr
+    python cryptomatte_extract.py image.exr crypto_asset --all -o matte_dir/
+    python cryptomatte_extract.py image.exr crypto_asset --list
+"""
+import os
+import re
+import sys
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import OpenImageIO as oiio
+except ImportError:
+    oiio = None
+
+import cryptomatte_compare
+import cryptomatte_manifest
+
+# Scanlines read at once, rounded up to whole tiles for tiled images.
+DEFAULT_CHUNK_ROWS = cryptomatte_compare.BLOCK_ROWS
+
+
+class CryptomatteStream(object):
+    """
+    One Cryptomatte stream of an image.
+
+    name: stream name, e.g. "crypto_asset"
+    prefix: metadata key prefix, "cryptomatte/<id>/"
+    ch_pair_idxs: (id, coverage) channel index pairs, by rank
+    """
+
+    def __init__(self, name, prefix, ch_pair_idxs, metadata, image_path):
+        self.name = name
+        self.prefix = prefix
+        self.ch_pair_idxs = ch_pair_idxs
+        self.metadata = metadata
+        self.image_path = image_path
+        self._manifest = None
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = cryptomatte_manifest.Manifest.from_metadata(
+                self.metadata, self.prefix, self.image_path)
+        return self._manifest
+
+    def target_hashes(self, names):
+        """ uint32 array of the manifest hashes of names. Raises KeyError for unknown names. """
+        names = [name if isinstance(name, type(u"")) else name.decode("utf-8") for name in names]
+        hashes = [self.manifest.hash_of(name) for name in names]
+        missing = [name for name, hash_value in zip(names, hashes) if hash_value is None]
+        if missing:
+            raise KeyError("Names not in manifest of %s: %s" % (self.name, missing))
+        return np.array(hashes, dtype=np.uint32)
+
+
+def rank_channel_pairs(channel_names, stream_name):
+    """
+    (id, coverage) channel index pairs of a stream, ordered by rank. Rank channels are
+    <stream>00.R, <stream>00.G, <stream>00.B, <stream>00.A, <stream>01.R, ...
+    """
+    rank_re = re.compile(re.escape(stream_name) + r"(\d\d)\.R\Z")
+    channel_idxs = dict((ch, i) for i, ch in enumerate(channel_names))
+    pairs = []
+    for level in sorted(m.group(1) for m in map(rank_re.match, channel_names) if m):
+        base = stream_name + level
+        r, g, b, a = (channel_idxs[base + "." + c] for c in "RGBA")
+        pairs.extend(((r, g), (b, a)))
+    return pairs
+
+
+def find_streams(spec, image_path):
+    """ Returns {stream name: CryptomatteStream} from an ImageSpec """
+    metadata = dict((a.name, a.value) for a in spec.extra_attribs
+                    if a.name.startswith("cryptomatte/"))
+    streams = {}
+    for key, value in metadata.items():
+        if key.endswith("/name"):
+            prefix = key[:-len("name")]
+            pairs = rank_channel_pairs(spec.channelnames, value)
+            streams[value] = CryptomatteStream(value, prefix, pairs, metadata, image_path)
+    return streams
+
+
+def open_stream(image_input, image_path, stream_name):
+    """ Finds a stream in an open ImageInput, raising KeyError if it is not there """
+    streams = find_streams(image_input.spec(), image_path)
+    if stream_name not in streams:
+        raise KeyError("No Cryptomatte stream %s in %s, found: %s" %
+                       (stream_name, image_path, sorted(streams)))
+    stream = streams[stream_name]
+    if not stream.ch_pair_idxs:
+        raise KeyError("No rank channels for stream %s in %s" % (stream_name, image_path))
+    return stream
+
+
+def iter_rank_chunks(image_input, stream, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Reads the rank channels of a stream in blocks of rows. Yields (ybegin, ids, coverages) where
+    ids are the uint32 hashes and coverages float32, both of shape (rows, width, num_ranks).
+    Only the channel range holding the stream's ranks is read.
+    """
+    chbegin, chend = cryptomatte_compare.rank_channel_range(stream.ch_pair_idxs)
+    id_idxs = [x - chbegin for x, _ in stream.ch_pair_idxs]
+    coverage_idxs = [y - chbegin for _, y in stream.ch_pair_idxs]
+
+    for ybegin, pixels in cryptomatte_compare.iter_row_blocks(image_input, chbegin, chend,
+                                                              chunk_rows):
+        yield ybegin, pixels[..., id_idxs].view(np.uint32), pixels[..., coverage_idxs]
+
+
+def iter_matte_chunks(image_input, stream, names, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """ Yields (ybegin, mask) blocks of the matte of names, mask being float32 (rows, width) """
+    targets = stream.target_hashes(names)
+    for ybegin, ids, coverages in iter_rank_chunks(image_input, stream, chunk_rows):
+        selected = np.isin(ids, targets)
+        yield ybegin, np.where(selected, coverages, np.float32(0.0)).sum(axis=-1,
+                                                                         dtype=np.float32)
+
+
+def _require_modules():
+    if np is None or oiio is None:
+        raise ImportError("NumPy and OpenImageIO are required for matte extraction")
+
+
+def extract_matte(image_path, stream_name, names, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Returns the matte of names (a sequence of manifest names) in a stream as a float32 array of
+    shape (height, width), covering the data window.
+    """
+    _require_modules()
+    image_input = cryptomatte_compare.open_image_input(image_path)
+    try:
+        spec = image_input.spec()
+        stream = open_stream(image_input, image_path, stream_name)
+        mask = np.empty((spec.height, spec.width), dtype=np.float32)
+        for ybegin, rows in iter_matte_chunks(image_input, stream, names, chunk_rows):
+            mask[ybegin - spec.y:ybegin - spec.y + len(rows)] = rows
+        return mask
+    finally:
+        image_input.close()
+
+
+def _matte_spec(in_spec):
+    """ Single channel ("A") float spec with the windows of in_spec """
+    out_spec = oiio.ImageSpec(in_spec.width, in_spec.height, 1, oiio.FLOAT)
+    out_spec.x, out_spec.y = in_spec.x, in_spec.y
+    out_spec.full_x, out_spec.full_y = in_spec.full_x, in_spec.full_y
+    out_spec.full_width, out_spec.full_height = in_spec.full_width, in_spec.full_height
+    out_spec.channelnames = ("A",)
+    out_spec.alpha_channel = 0
+    out_spec.attribute("compression", "zip")
+    return out_spec
+
+
+def _open_output(output_path, out_spec):
+    output = oiio.ImageOutput.create(output_path)
+    if not output or not output.open(output_path, out_spec):
+        raise IOError("Could not open %s for writing: %s" % (output_path, oiio.geterror()))
+    return output
+
+
+def write_matte(image_path, stream_name, names, output_path, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Writes the matte of names to a single channel ("A") float image, block by block, so neither
+    the input nor the matte is ever held whole.
+    """
+    _require_modules()
+    image_input = cryptomatte_compare.open_image_input(image_path)
+    try:
+        in_spec = image_input.spec()
+        stream = open_stream(image_input, image_path, stream_name)
+        output = _open_output(output_path, _matte_spec(in_spec))
+        try:
+            for ybegin, rows in iter_matte_chunks(image_input, stream, names, chunk_rows):
+                yend = ybegin + len(rows)
+                if not output.write_scanlines(ybegin, yend, in_spec.z, rows[..., None]):
+                    raise IOError("Could not write %s: %s" % (output_path, output.geterror()))
+        finally:
+            output.close()
+    finally:
+        image_input.close()
+
+
+#############################################
+# Batch extraction
+#############################################
+
+class SparseMattes(object):
+    """
+    Mattes of every ID in a stream, stored sparsely in compressed sparse row (CSR) form keyed by
+    ID. Memory is proportional to the number of (pixel, ID) entries with coverage, not to
+    IDs x pixels.
+
+    hashes: sorted uint32 IDs with coverage anywhere in the image
+    indptr: entries of hashes[i] are [indptr[i], indptr[i + 1])
+    pixel_idxs: flat pixel index into the data window of each entry, ascending per ID
+    coverages: float32 coverage of each entry, summed over ranks
+    """
+
+    def __init__(self, stream, width, height, hashes, indptr, pixel_idxs, coverages):
+        self.stream = stream
+        self.width = width
+        self.height = height
+        self.hashes = hashes
+        self.indptr = indptr
+        self.pixel_idxs = pixel_idxs
+        self.coverages = coverages
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _id_index(self, hash_value):
+        i = int(np.searchsorted(self.hashes, np.uint32(hash_value)))
+        if i < len(self.hashes) and self.hashes[i] == hash_value:
+            return i
+        return None
+
+    def matte_of_hash(self, hash_value):
+        """ Dense float32 (height, width) matte of an ID. IDs without coverage give zeros. """
+        matte = np.zeros(self.width * self.height, dtype=np.float32)
+        i = self._id_index(hash_value)
+        if i is not None:
+            begin, end = self.indptr[i], self.indptr[i + 1]
+            matte[self.pixel_idxs[begin:end]] = self.coverages[begin:end]
+        return matte.reshape(self.height, self.width)
+
+    def matte(self, names):
+        """ Dense float32 (height, width) matte of a sequence of manifest names """
+        matte = np.zeros((self.height, self.width), dtype=np.float32)
+        for hash_value in self.stream.target_hashes(names):
+            matte += self.matte_of_hash(hash_value)
+        return matte
+
+    def iter_mattes(self):
+        """ Yields (name, hash, dense matte) of each ID, one matte at a time. name may be None. """
+        for hash_value in self.hashes:
+            yield self.stream.manifest.name_of(hash_value), hash_value, self.matte_of_hash(
+                hash_value)
+
+
+def _sum_duplicates(ids, pixel_idxs, coverages):
+    """ Sorts entries by (id, pixel), summing the coverage of an ID over ranks of one pixel """
+    order = np.lexsort((pixel_idxs, ids))
+    ids, pixel_idxs, coverages = ids[order], pixel_idxs[order], coverages[order]
+    starts = np.ones(len(ids), dtype=bool)
+    starts[1:] = (ids[1:] != ids[:-1]) | (pixel_idxs[1:] != pixel_idxs[:-1])
+    start_idxs = np.flatnonzero(starts)
+    if not len(start_idxs):
+        return ids, pixel_idxs, coverages
+    return ids[start_idxs], pixel_idxs[start_idxs], np.add.reduceat(coverages, start_idxs)
+
+
+def read_sparse_mattes(image_input, stream, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Decodes the rank channels of a stream once, into SparseMattes. Ranks with zero coverage or
+    the zero (background) ID are skipped.
+    """
+    spec = image_input.spec()
+    chunk_entries = []
+    for ybegin, ids, coverages in iter_rank_chunks(image_input, stream, chunk_rows):
+        keep = (coverages != 0.0) & (ids != 0)
+        pixel_idxs = np.arange((ybegin - spec.y) * spec.width,
+                               (ybegin - spec.y + len(ids)) * spec.width, dtype=np.int64)
+        pixel_idxs = np.broadcast_to(pixel_idxs.reshape(ids.shape[:2] + (1,)), ids.shape)
+        chunk_entries.append(_sum_duplicates(ids[keep], pixel_idxs[keep], coverages[keep]))
+
+    if chunk_entries:
+        ids, pixel_idxs, coverages = (np.concatenate(x) for x in zip(*chunk_entries))
+    else:
+        ids, pixel_idxs, coverages = (np.zeros(0, np.uint32), np.zeros(0, np.int64),
+                                      np.zeros(0, np.float32))
+    # entries are in pixel order across chunks, so a stable sort by ID keeps them so per ID.
+    order = np.argsort(ids, kind="mergesort")
+    ids, pixel_idxs, coverages = ids[order], pixel_idxs[order], coverages[order]
+
+    hashes, starts = np.unique(ids, return_index=True)
+    indptr = np.append(starts, len(ids)).astype(np.int64)
+    return SparseMattes(stream, spec.width, spec.height, hashes, indptr, pixel_idxs, coverages)
+
+
+def extract_all_mattes(image_path, stream_name, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """ Returns SparseMattes of every ID in a stream, reading the image once """
+    _require_modules()
+    image_input = cryptomatte_compare.open_image_input(image_path)
+    try:
+        stream = open_stream(image_input, image_path, stream_name)
+        return read_sparse_mattes(image_input, stream, chunk_rows)
+    finally:
+        image_input.close()
+
+
+def write_all_mattes(image_path, stream_name, output_dir, chunk_rows=DEFAULT_CHUNK_ROWS):
+    """
+    Writes the matte of every ID in a stream to output_dir as <stream>.<hash>.exr, decoding the
+    image once. Also writes <stream>.mattes.json, mapping each name (or the hex hash of IDs
+    missing from the manifest) to its file. Returns that mapping.
+    """
+    import json
+    _require_modules()
+    image_input = cryptomatte_compare.open_image_input(image_path)
+    try:
+        in_spec = image_input.spec()
+        stream = open_stream(image_input, image_path, stream_name)
+        mattes = read_sparse_mattes(image_input, stream, chunk_rows)
+    finally:
+        image_input.close()
+
+    out_spec = _matte_spec(in_spec)
+    index = {}
+    for name, hash_value, matte in mattes.iter_mattes():
+        file_name = "%s.%08x.exr" % (stream_name, hash_value)
+        output_path = os.path.join(output_dir, file_name)
+        output = _open_output(output_path, out_spec)
+        try:
+            if not output.write_image(matte[..., None]):
+                raise IOError("Could not write %s: %s" % (output_path, output.geterror()))
+        finally:
+            output.close()
+        index[name if name is not None else "%08x" % hash_value] = file_name
+
+    with open(os.path.join(output_dir, "%s.mattes.json" % stream_name), "w") as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    return index
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Extracts mattes from Cryptomatte EXRs.")
+    parser.add_argument("image", help="Cryptomatte EXR")
+    parser.add_argument("stream", help="Cryptomatte stream, e.g. crypto_asset")
+    parser.add_argument("names", nargs="*", help="manifest names to include in the matte")
+    parser.add_argument("-o", "--output",
+                        help="image to write the matte to, or directory with --all")
+    parser.add_argument("--all", action="store_true",
+                        help="write the matte of every ID in the stream, reading the image once")
+    parser.add_argument("--list", action="store_true", help="print the names in the manifest")
+    parser.add_argument("--chunk-rows", type=int, default=DEFAULT_CHUNK_ROWS,
+                        help="scanlines read at once (default %s)" % DEFAULT_CHUNK_ROWS)
+    args = parser.parse_args(argv)
+
+    if args.list:
+        _require_modules()
+        image_input = cryptomatte_compare.open_image_input(args.image)
+        try:
+            stream = open_stream(image_input, args.image, args.stream)
+            for name, hash_value in stream.manifest:
+                print("%08x %s" % (hash_value, name))
+        finally:
+            image_input.close()
+        return 0
+
+    if args.all:
+        if not args.output or not os.path.isdir(args.output):
+            parser.error("--all requires --output to be an existing directory")
+        write_all_mattes(args.image, args.stream, args.output, args.chunk_rows)
+        return 0
+
+    if not args.names or not args.output:
+        parser.error("names and --output are required, unless listing")
+    write_matte(args.image, args.stream, args.names, args.output, args.chunk_rows)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
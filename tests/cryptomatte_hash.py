@@ -0,0 +1,276 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+"""
+Cryptomatte ID hashing, bit for bit the same as hash_name_rgb and hash_to_float in cryptomatte.h.
+
+A name is hashed with MurmurHash3_x86_32 (seed 0) over its UTF-8 bytes. The float ID stored in
+rank channels is that hash with the exponent bits fixed so it is never denormal, inf or NaN, and
+the manifest hash is the bit pattern of the float ID. The preview G and B channels are scaled from
+the low 24 and 16 bits of the raw hash.
+
+hash_names hashes many names at once with NumPy uint32 arithmetic. Names are bucketed by length,
+and each bucket is hashed as a (num_names, length) byte array, one 4 byte block column at a time.
+
+Usage:
+    python cryptomatte_hash.py name [name ...]
+    python cryptomatte_hash.py --benchmark 1000000
+"""
+import collections
+import struct
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+C1 = 0xcc9e2d51
+C2 = 0x1b873593
+MASK32 = 0xffffffff
+# (float)std::numeric_limits<uint32_t>::max(), which rounds up to 2^32.
+PREVIEW_SCALE = 4294967295.0
+
+
+class NameHashes(collections.namedtuple(
+        "NameHashes", ["float_ids", "hashes", "murmur_hashes", "preview_g", "preview_b"])):
+    """
+    Hashes of a sequence of names, as aligned NumPy arrays.
+
+    float_ids: float32 IDs, as written to rank channels
+    hashes: uint32 bit patterns of float_ids, as written to manifests
+    murmur_hashes: uint32 MurmurHash3_x86_32 of each name
+    preview_g, preview_b: float32 preview colors, as written to the "<stream>" G and B channels
+    """
+    __slots__ = ()
+
+
+def _encode(name):
+    return name if isinstance(name, bytes) else name.encode("utf-8")
+
+
+#############################################
+# Pure Python reference
+#############################################
+
+def _rotl32(x, r):
+    return ((x << r) | (x >> (32 - r))) & MASK32
+
+
+def _fmix32(h):
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & MASK32
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & MASK32
+    h ^= h >> 16
+    return h
+
+
+def murmur3_32(name, seed=0):
+    """ MurmurHash3_x86_32 of a name's UTF-8 bytes, one name at a time """
+    data = bytearray(_encode(name))
+    length = len(data)
+    nblocks = length // 4
+    h1 = seed
+
+    for k1 in struct.unpack("<%dI" % nblocks, bytes(data[:nblocks * 4])):
+        k1 = (k1 * C1) & MASK32
+        k1 = _rotl32(k1, 15)
+        k1 = (k1 * C2) & MASK32
+        h1 ^= k1
+        h1 = _rotl32(h1, 13)
+        h1 = (h1 * 5 + 0xe6546b64) & MASK32
+
+    tail = data[nblocks * 4:]
+    k1 = 0
+    for i in reversed(range(len(tail))):
+        k1 ^= tail[i] << (8 * i)
+    if tail:
+        k1 = (k1 * C1) & MASK32
+        k1 = _rotl32(k1, 15)
+        k1 = (k1 * C2) & MASK32
+        h1 ^= k1
+
+    h1 ^= length
+    return _fmix32(h1)
+
+
+def fix_exponent(hash_value):
+    """ The hash_to_float exponent fix, returning the uint32 bit pattern of the float ID """
+    exponent = hash_value >> 23 & 255
+    if exponent == 0 or exponent == 255:
+        hash_value ^= 1 << 23
+    return hash_value
+
+
+def hash_to_float(hash_value):
+    """ Float ID of a raw MurmurHash3 value, as hash_to_float in cryptomatte.h """
+    return struct.unpack("<f", struct.pack("<I", fix_exponent(hash_value)))[0]
+
+
+def hash_name(name):
+    """ (float_id, hash, murmur_hash, preview_g, preview_b) of one name, without NumPy """
+    murmur_hash = murmur3_32(name)
+    hash_value = fix_exponent(murmur_hash)
+    float_id = struct.unpack("<f", struct.pack("<I", hash_value))[0]
+    preview = []
+    for shift in (8, 16):
+        # float32 rounding of the integer, and of the quotient, as the C++ does
+        channel = struct.unpack("<f", struct.pack("<f", (murmur_hash << shift) & MASK32))[0]
+        channel = struct.unpack("<f", struct.pack("<f", channel / 4294967296.0))[0]
+        preview.append(channel)
+    return float_id, hash_value, murmur_hash, preview[0], preview[1]
+
+
+#############################################
+# Vectorized
+#############################################
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("NumPy is required for batched hashing")
+
+
+def _rotl32_array(x, r):
+    return (x << np.uint32(r)) | (x >> np.uint32(32 - r))
+
+
+def _mix_k1(k1):
+    k1 *= np.uint32(C1)
+    k1 = _rotl32_array(k1, 15)
+    k1 *= np.uint32(C2)
+    return k1
+
+
+def _murmur3_32_same_length(data, length):
+    """ MurmurHash3_x86_32 of each row of a (num_names, length) uint8 array """
+    nblocks = length // 4
+    h1 = np.zeros(len(data), dtype=np.uint32)
+    if nblocks:
+        blocks = np.ascontiguousarray(data[:, :nblocks * 4]).view("<u4").astype(np.uint32)
+        for i in range(nblocks):
+            h1 ^= _mix_k1(blocks[:, i].copy())
+            h1 = _rotl32_array(h1, 13)
+            h1 *= np.uint32(5)
+            h1 += np.uint32(0xe6546b64)
+
+    tail_length = length & 3
+    if tail_length:
+        k1 = np.zeros(len(data), dtype=np.uint32)
+        for i in reversed(range(tail_length)):
+            k1 ^= data[:, nblocks * 4 + i].astype(np.uint32) << np.uint32(8 * i)
+        h1 ^= _mix_k1(k1)
+
+    h1 ^= np.uint32(length)
+    h1 ^= h1 >> np.uint32(16)
+    h1 *= np.uint32(0x85ebca6b)
+    h1 ^= h1 >> np.uint32(13)
+    h1 *= np.uint32(0xc2b2ae35)
+    h1 ^= h1 >> np.uint32(16)
+    return h1
+
+
+def _join_encoded(names):
+    """
+    UTF-8 bytes of all names, NUL separated. Names are C strings, so cannot contain NUL, and
+    encoding them joined is much faster than one at a time.
+    """
+    try:
+        joined = b"\0".join(names)
+    except TypeError:
+        try:
+            joined = u"\0".join(names)
+        except TypeError:
+            joined = b"\0".join(_encode(name) for name in names)
+    except UnicodeDecodeError:
+        joined = b"\0".join(_encode(name) for name in names)
+    return joined if isinstance(joined, bytes) else joined.encode("utf-8")
+
+
+def murmur3_32_batch(names):
+    """ uint32 array of the MurmurHash3_x86_32 of each name, hashing names of a length together """
+    _require_numpy()
+    names = list(names)
+    hashes = np.empty(len(names), dtype=np.uint32)
+    if not names:
+        return hashes
+
+    data = np.frombuffer(_join_encoded(names), dtype=np.uint8)
+    separators = np.flatnonzero(data == 0)
+    if len(separators) != len(names) - 1:
+        raise ValueError("Names cannot contain NUL characters")
+    offsets = np.concatenate(([0], separators + 1))
+    lengths = np.concatenate((separators, [len(data)])) - offsets
+
+    for length in np.unique(lengths):
+        idxs = np.flatnonzero(lengths == length)
+        rows = data[offsets[idxs][:, None] + np.arange(length)]
+        hashes[idxs] = _murmur3_32_same_length(rows, int(length))
+    return hashes
+
+
+def fix_exponent_batch(murmur_hashes):
+    """ The hash_to_float exponent fix over a uint32 array, returning the manifest hashes """
+    exponent = (murmur_hashes >> np.uint32(23)) & np.uint32(255)
+    toggle = (exponent == 0) | (exponent == 255)
+    return np.where(toggle, murmur_hashes ^ np.uint32(1 << 23), murmur_hashes).astype(np.uint32)
+
+
+def hash_names(names):
+    """ Hashes a sequence of names (unicode or UTF-8 bytes), returning NameHashes """
+    murmur_hashes = murmur3_32_batch(names)
+    hashes = fix_exponent_batch(murmur_hashes)
+    scale = np.float32(PREVIEW_SCALE)
+    preview_g = (murmur_hashes << np.uint32(8)).astype(np.float32) / scale
+    preview_b = (murmur_hashes << np.uint32(16)).astype(np.float32) / scale
+    return NameHashes(hashes.view(np.float32), hashes, murmur_hashes, preview_g, preview_b)
+
+
+#############################################
+# Benchmark
+#############################################
+
+def benchmark(num_names=1000000, python_names=20000, stream=sys.stdout):
+    """
+    Times hash_names against the pure Python hash over generated names, and checks they agree.
+    The pure Python loop is timed on a subset and scaled, as it is slow.
+    """
+    _require_numpy()
+    names = ["/asset_%d/geo/mesh_%d" % (i // 100, i) for i in range(num_names)]
+
+    start = time.time()
+    batched = hash_names(names)
+    batched_seconds = time.time() - start
+
+    subset = names[:python_names]
+    start = time.time()
+    reference = [murmur3_32(name) for name in subset]
+    python_seconds = (time.time() - start) * len(names) / float(len(subset))
+
+    assert list(batched.murmur_hashes[:len(subset)]) == reference, "Batched hashes do not match"
+    stream.write("%d names: batched %.2fs, pure Python %.2fs (estimated), %.0fx\n" %
+                 (len(names), batched_seconds, python_seconds, python_seconds / batched_seconds))
+    return batched_seconds, python_seconds
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Cryptomatte IDs of names.")
+    parser.add_argument("names", nargs="*", help="names to hash")
+    parser.add_argument("--benchmark", type=int, metavar="N",
+                        help="time batched against pure Python hashing of N names")
+    args = parser.parse_args(argv)
+
+    if args.benchmark:
+        benchmark(args.benchmark)
+    for name in args.names:
+        float_id, hash_value, _, preview_g, preview_b = hash_name(name)
+        print("%s\t%08x\t%.9g\t%.9g\t%.9g" % (name, hash_value, float_id, preview_g, preview_b))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+"""
+Parsing and lookups for Cryptomatte manifests.
+
+Reads the format written by write_manifest_to_string in cryptomatte.h, either embedded in EXR
+metadata (cryptomatte/<id>/manifest) or in a sidecar file (cryptomatte/<id>/manif_file):
+
+    {"name":"3f800000","other\\/name":"4a3b2c1d"}
+
+Entries are parsed in a single pass over the raw bytes, with sidecars memory-mapped rather than
+read, and stored in a compact index: a sorted table of names with their hashes, and the hashes
+sorted with the positions of their names. Both hash->name and name->hash lookups are binary
+searches.
+
+Binary sidecar manifests (cryptomatte/<id>/manif_bin_file), written by encode_binary_manifest in
+manifest_writer.h, are read by BinaryManifest. They are memory-mapped and searched in place, so
+opening one costs the same whatever its size.
+
+Example:
+    manifest = Manifest.from_file("beauty.crypto_asset.json")
+    manifest.hash_of(u"heroCharacter")  # -> 0x6c6a3bd4
+    manifest.name_of(0x6c6a3bd4)         # -> u"heroCharacter"
+
+    with BinaryManifest.from_file("beauty.crypto_asset.bin") as binary_manifest:
+        binary_manifest.name_of(0x6c6a3bd4)  # -> u"heroCharacter"
+"""
+import array
+import binascii
+import bisect
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+
+# A quoted name (which may contain escaped quotes) and a quoted 8 digit hex hash.
+_NAME = br'"([^"\\]*(?:\\.[^"\\]*)*)"'
+_HASH = br'"([0-9a-fA-F]{8})"'
+_PAIR = _NAME + br'\s*:\s*' + _HASH
+_PAIR_RE = re.compile(_PAIR, re.DOTALL)
+# One pair and the separator after it.
+_ENTRY_RE = re.compile(br'\s*' + _PAIR + br'\s*([,}])', re.DOTALL)
+# A whole manifest. Groups are dropped, as only the structure is checked with this.
+_BARE_PAIR = _PAIR.replace(b"(", b"(?:").replace(b"(?:?:", b"(?:")
+_MANIFEST_RE = re.compile(
+    br'\s*\{\s*(?:(?:' + _BARE_PAIR + br'\s*,\s*)*' + _BARE_PAIR + br'\s*)?\}\s*\Z', re.DOTALL)
+_LENIENT_MANIFEST_RE = re.compile(
+    br'\s*\{\s*(?:' + _BARE_PAIR + br'\s*,\s*)*(?:' + _BARE_PAIR + br'\s*)?\}\s*\Z', re.DOTALL)
+_OPEN_RE = re.compile(br'\s*\{\s*')
+_CLOSE_RE = re.compile(br'\s*\}')
+_SPACE_RE = re.compile(br'\s*')
+_CONTROL_RE = re.compile(br'[\x00-\x1f]')
+_ESCAPE_RE = re.compile(br'\\(.)', re.DOTALL)
+_WRITER_ESCAPES = {b'"', b'\\', b'/'}
+
+
+def _uint32_array(values=()):
+    """ array of unsigned 32 bit ints, whichever typecode that is on this platform """
+    typecode = "I" if array.array("I").itemsize == 4 else "L"
+    return array.array(typecode, values)
+
+
+class ManifestError(ValueError):
+    """ Raised when a manifest is not in the Cryptomatte manifest format """
+    pass
+
+
+def _decode_name(raw, strict):
+    if b"\\" not in raw:
+        return raw.decode("utf-8")
+    return json.loads(b'"'.join((b"", raw, b"")).decode("utf-8"), strict=strict)
+
+
+def parse_entries(data, strict=False):
+    """
+    Returns (names, hashes) lists from manifest bytes, in file order. Equivalent to iter_entries,
+    but the structure is checked and the pairs extracted with whole-buffer regular expressions,
+    and names are decoded together.
+    """
+    manifest_re = _MANIFEST_RE if strict else _LENIENT_MANIFEST_RE
+    pairs = _PAIR_RE.findall(data) if manifest_re.match(data) else None
+    # names are C strings, so cannot contain NUL, which makes it a safe separator.
+    joined_names = b"\0".join(raw_name for raw_name, _ in pairs) if pairs else b""
+    if pairs is None or (strict and _CONTROL_RE.search(joined_names.replace(b"\0", b""))):
+        # find and report the problem
+        for _ in iter_entries(data, strict):
+            pass
+        raise ManifestError("Malformed manifest")
+
+    if b"\\" not in joined_names:
+        names = joined_names.decode("utf-8").split(u"\0") if pairs else []
+    elif set(_ESCAPE_RE.findall(joined_names)) <= _WRITER_ESCAPES:
+        # only the escapes write_manifest_to_string produces, which can be undone in bulk.
+        # Splitting on escaped backslashes first keeps "\\\\/" from being read as "\\/".
+        pieces = [
+            piece.replace(b"\\/", b"/").replace(b'\\"', b'"')
+            for piece in joined_names.split(b"\\\\")
+        ]
+        names = b"\\".join(pieces).decode("utf-8").split(u"\0")
+    else:
+        names = [_decode_name(raw_name, strict) for raw_name, _ in pairs]
+
+    hashes = _uint32_array()
+    if pairs:
+        hash_bytes = binascii.unhexlify(b"".join(hex_hash for _, hex_hash in pairs))
+        getattr(hashes, "frombytes", getattr(hashes, "fromstring", None))(hash_bytes)
+        if sys.byteorder == "little":
+            hashes.byteswap()
+    return names, hashes
+
+
+def iter_entries(data, strict=False):
+    """
+    Yields (name, hash) pairs from manifest bytes in file order, validating the structure as it
+    goes. name is unicode and hash is the uint32 bit pattern of the float ID.
+
+    With strict, only valid JSON is accepted. Otherwise, raw control characters in names and the
+    trailing comma written before "}" by truncated manifests are allowed.
+    """
+    match = _OPEN_RE.match(data, 0)
+    if not match:
+        raise ManifestError("Manifest does not start with '{'")
+    pos = match.end()
+
+    match = _CLOSE_RE.match(data, pos)
+    if match:
+        pos = match.end()
+    else:
+        while True:
+            match = _ENTRY_RE.match(data, pos)
+            if not match:
+                close = _CLOSE_RE.match(data, pos)
+                if close and not strict and pos > 0 and data[pos - 1:pos] == b",":
+                    pos = close.end()
+                    break
+                raise ManifestError("Malformed manifest entry at byte %s" % pos)
+            raw_name, hex_hash, separator = match.groups()
+            if strict and _CONTROL_RE.search(raw_name):
+                raise ManifestError("Unescaped control character in name at byte %s" % pos)
+            pos = match.end()
+            yield _decode_name(raw_name, strict), int(hex_hash, 16)
+            if separator == b"}":
+                break
+
+    if _SPACE_RE.match(data, pos).end() != len(data):
+        raise ManifestError("Unexpected data after manifest at byte %s" % pos)
+
+
+class Manifest(object):
+    """
+    Index of a parsed manifest.
+
+    names: sorted list of unique names
+    hashes: uint32 hashes, aligned with names
+    sorted_hashes: hashes in ascending order
+    hash_name_idxs: index into names of each entry of sorted_hashes
+    """
+
+    def __init__(self, names=(), hashes=()):
+        """ names and hashes are aligned sequences, in any order """
+        names = list(names)
+        hashes = _uint32_array(hashes)
+        if len(names) != len(hashes):
+            raise ManifestError("Got %s names and %s hashes" % (len(names), len(hashes)))
+
+        # manifests are written from a std::map, so are usually sorted already.
+        if any(names[i] >= names[i + 1] for i in range(len(names) - 1)):
+            by_name = sorted(range(len(names)), key=names.__getitem__)
+            names = [names[i] for i in by_name]
+            hashes = _uint32_array(hashes[i] for i in by_name)
+            for i in range(len(names) - 1):
+                if names[i] == names[i + 1]:
+                    raise ManifestError("Duplicate name in manifest: %s" % names[i])
+        self.names = names
+        self.hashes = hashes
+
+        by_hash = sorted(range(len(self.names)), key=self.hashes.__getitem__)
+        self.sorted_hashes = _uint32_array(self.hashes[i] for i in by_hash)
+        self.hash_name_idxs = _uint32_array(by_hash)
+
+    @classmethod
+    def from_entries(cls, entries):
+        """ Builds a manifest from (name, hash) pairs """
+        entries = list(entries)
+        return cls([name for name, _ in entries], [hash_value for _, hash_value in entries])
+
+    @classmethod
+    def from_string(cls, data, strict=False):
+        """ Parses a manifest from a string, as found in EXR metadata """
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        return cls(*parse_entries(data, strict))
+
+    @classmethod
+    def from_file(cls, path, strict=False):
+        """ Parses a sidecar manifest file, memory-mapping it instead of reading it """
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ManifestError("Manifest file is empty: %s" % path)
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return cls(*parse_entries(mapped, strict))
+            finally:
+                mapped.close()
+
+    @classmethod
+    def from_metadata(cls, metadata, prefix, image_path, strict=False):
+        """
+        Parses the manifest of one stream from image metadata, either embedded or in the sidecar
+        it points to. prefix is the "cryptomatte/<id>/" key prefix of the stream, and sidecars
+        are relative to image_path.
+        """
+        if prefix + "manifest" in metadata:
+            return cls.from_string(metadata[prefix + "manifest"], strict)
+        if prefix + "manif_file" in metadata:
+            sidecar = os.path.join(os.path.dirname(image_path), metadata[prefix + "manif_file"])
+            return cls.from_file(sidecar, strict)
+        raise ManifestError("No manifest in metadata for %s" % prefix)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return self._name_index(name) is not None
+
+    def __iter__(self):
+        """ Yields (name, hash) pairs, sorted by name """
+        for i, name in enumerate(self.names):
+            yield name, self.hashes[i]
+
+    def _name_index(self, name):
+        i = bisect.bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            return i
+        return None
+
+    def hash_of(self, name):
+        """ Returns the uint32 hash of a name, or None """
+        i = self._name_index(name)
+        return None if i is None else self.hashes[i]
+
+    def float_id_of(self, name):
+        """ Returns the float ID of a name, as stored in rank channels, or None """
+        hash_value = self.hash_of(name)
+        return None if hash_value is None else hash_to_float_id(hash_value)
+
+    def name_of(self, hash_value):
+        """ Returns the name for a uint32 hash, or None. With collisions, the first name. """
+        i = bisect.bisect_left(self.sorted_hashes, hash_value)
+        if i < len(self.sorted_hashes) and self.sorted_hashes[i] == hash_value:
+            return self.names[self.hash_name_idxs[i]]
+        return None
+
+    def name_of_float_id(self, float_id):
+        """ Returns the name for a float ID read from a rank channel, or None """
+        return self.name_of(float_id_to_hash(float_id))
+
+
+BINARY_MAGIC = b"CRYPTMNF"
+BINARY_VERSION = 1
+_BINARY_HEADER = struct.Struct("<8sII")
+_UINT32 = struct.Struct("<I")
+_UINT32_PAIR = struct.Struct("<II")
+
+
+def encode_binary_manifest(entries):
+    """
+    Bytes of a binary manifest of (name, hash) pairs, as encode_binary_manifest in
+    manifest_writer.h writes them: a header, then the hashes in ascending order (ties by name),
+    the offsets of the names, and the UTF-8 names.
+    """
+    encoded = sorted((hash_value, name.encode("utf-8")) for name, hash_value in entries)
+    offsets = [0]
+    for _, name in encoded:
+        offsets.append(offsets[-1] + len(name))
+    return b"".join([
+        _BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(encoded)),
+        struct.pack("<%sI" % len(encoded), *(hash_value for hash_value, _ in encoded)),
+        struct.pack("<%sI" % len(offsets), *offsets),
+        b"".join(name for _, name in encoded),
+    ])
+
+
+class BinaryManifest(object):
+    """
+    Reader of a binary manifest, searched in place in a buffer (usually a memory-mapped file).
+    Only the header is read up front. Lookups are binary searches over the hash array.
+    """
+
+    def __init__(self, data):
+        if len(data) < _BINARY_HEADER.size:
+            raise ManifestError("Binary manifest is too short")
+        magic, version, count = _BINARY_HEADER.unpack_from(data, 0)
+        if magic != BINARY_MAGIC:
+            raise ManifestError("Not a binary manifest")
+        if version != BINARY_VERSION:
+            raise ManifestError("Unsupported binary manifest version %s" % version)
+        self._data = data
+        self._count = count
+        self._hashes_pos = _BINARY_HEADER.size
+        self._offsets_pos = self._hashes_pos + 4 * count
+        self._names_pos = self._offsets_pos + 4 * (count + 1)
+        if (len(data) < self._names_pos or
+                self._names_pos + self._offset(count) != len(data)):
+            raise ManifestError("Binary manifest is truncated or corrupt")
+
+    @classmethod
+    def from_file(cls, path):
+        """ Memory-maps a binary manifest file. close() it, or use it as a context manager. """
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ManifestError("Manifest file is empty: %s" % path)
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return cls(mapped)
+        except ManifestError:
+            mapped.close()
+            raise
+
+    @classmethod
+    def from_metadata(cls, metadata, prefix, image_path):
+        """
+        Opens the binary manifest of one stream, or returns None if the image metadata does not
+        point to one. prefix and image_path are as for Manifest.from_metadata.
+        """
+        if prefix + "manif_bin_file" not in metadata:
+            return None
+        return cls.from_file(
+            os.path.join(os.path.dirname(image_path), metadata[prefix + "manif_bin_file"]))
+
+    def close(self):
+        if hasattr(self._data, "close"):
+            self._data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        """ Yields (name, hash) pairs, sorted by hash """
+        for i in range(self._count):
+            yield self._name(i), self._hash(i)
+
+    def _hash(self, i):
+        return _UINT32.unpack_from(self._data, self._hashes_pos + 4 * i)[0]
+
+    def _offset(self, i):
+        return _UINT32.unpack_from(self._data, self._offsets_pos + 4 * i)[0]
+
+    def _name(self, i):
+        start, end = _UINT32_PAIR.unpack_from(self._data, self._offsets_pos + 4 * i)
+        return self._data[self._names_pos + start:self._names_pos + end].decode("utf-8")
+
+    def name_of(self, hash_value):
+        """ Returns the name for a uint32 hash, or None. With collisions, the first name. """
+        low, high = 0, self._count
+        while low < high:
+            mid = (low + high) // 2
+            if self._hash(mid) < hash_value:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self._count and self._hash(low) == hash_value:
+            return self._name(low)
+        return None
+
+    def name_of_float_id(self, float_id):
+        """ Returns the name for a float ID read from a rank channel, or None """
+        return self.name_of(float_id_to_hash(float_id))
+
+    def to_manifest(self):
+        """ Reads every entry into a Manifest, for name lookups """
+        return Manifest.from_entries(self)
+
+
+def hash_to_float_id(hash_value):
+    """ Reinterprets the bits of a uint32 manifest hash as a float32 ID """
+    return struct.unpack("<f", struct.pack("<I", hash_value))[0]
+
+
+def float_id_to_hash(float_id):
+    """ Reinterprets a float32 ID as the uint32 hash written in manifests """
+    return struct.unpack("<I", struct.pack("<f", float_id))[0]
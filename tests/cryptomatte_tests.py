@@ -5,8 +5,14 @@
 #
 #
 import tests
+import cryptomatte_compare
+import cryptomatte_extract
+import cryptomatte_hash
+import cryptomatte_manifest
 import os
-import json
+import render_cache
+import render_stats
+import shutil
 import tempfile
 import unittest
 
@@ -15,7 +21,10 @@ import arnold as ai
 def get_all_cryptomatte_tests():
     return [
         Cryptomatte000, Cryptomatte001, Cryptomatte002, Cryptomatte003,
-        Cryptomatte010, Cryptomatte020, Cryptomatte030, CryptomatteSetup
+        Cryptomatte010, Cryptomatte020, Cryptomatte030, CryptomatteSetup,
+        CryptomatteInstanceOverrides,
+        CryptomatteHashing, CryptomatteExtraction, CryptomatteBinaryManifest,
+        CryptomatteRenderCache
     ]
 
 
@@ -30,6 +39,7 @@ class CryptomatteTestBase(tests.KickAndCompareTestCase):
         self._result_images = []
         self._exr_result_images = []
 
+    @tests.timed
     def load_results(self):
         for file_name in self.correct_file_names:
             img, correct_img = self.load_images(file_name)
@@ -50,23 +60,14 @@ class CryptomatteTestBase(tests.KickAndCompareTestCase):
             self.load_results()
         return self._exr_result_images
 
+    @tests.timed
+    def image_metadata(self, img):
+        """Returns the cached metadata_cache.ImageMetadata of an image"""
+        return tests.get_metadata_cache().get(img.name, img.spec())
 
     def crypto_metadata(self, ibuf):
         """Returns dictionary of key, value of cryptomatte metadata"""
-        metadata = {
-            a.name: a.value
-            for a in ibuf.spec().extra_attribs
-            if a.name.startswith("cryptomatte")
-        }
-
-        for key in metadata.keys():
-            if key.endswith("/manif_file"):
-                sidecar_path = os.path.join(
-                    os.path.dirname(ibuf.name), metadata[key])
-                with open(sidecar_path) as f:
-                    metadata[key.replace("manif_file", "manifest")] = f.read()
-
-        return metadata
+        return self.image_metadata(ibuf).crypto_metadata
 
     def sorted_crypto_metadata(self, img):
         """
@@ -77,63 +78,27 @@ class CryptomatteTestBase(tests.KickAndCompareTestCase):
 
         Also includes ID coverage pairs in subkeys, "ch_pair_idxs" and "ch_pair_names".
         """
-        img_md = self.crypto_metadata(img)
-        cryptomatte_streams = {}
-        for key, value in img_md.iteritems():
-            prefix, cryp_key, cryp_md_key = key.split("/")
-            name = img_md["/".join((prefix, cryp_key, "name"))]
-            cryptomatte_streams[name] = cryptomatte_streams.get(name, {})
-            cryptomatte_streams[name][cryp_md_key] = value
-
-        for cryp_key in cryptomatte_streams:
-            name = cryptomatte_streams[cryp_key]["name"]
-            ch_id_coverages = []
-            ch_id_coverage_names = []
-            channels_dict = {
-                ch: i
-                for i, ch in enumerate(img.spec().channelnames)
-            }
-            for i, ch in enumerate(img.spec().channelnames):
-                if not ch.startswith(name):
-                    continue
-                if ch.startswith("%s." % name):
-                    continue
-                if ch.endswith(".R"):
-                    red_name = ch
-                    green_name = "%s.G" % ch[:-2]
-                    blue_name = "%s.B" % ch[:-2]
-                    alpha_name = "%s.A" % ch[:-2]
-
-                    red_idx = i
-                    green_idx = channels_dict[green_name]
-                    blue_idx = channels_dict[blue_name]
-                    alpha_idx = channels_dict[alpha_name]
-
-                    ch_id_coverages.append((red_idx, green_idx))
-                    ch_id_coverages.append((blue_idx, alpha_idx))
-                    ch_id_coverage_names.append((red_name, green_name))
-                    ch_id_coverage_names.append((blue_name, alpha_name))
-            cryptomatte_streams[cryp_key]["ch_pair_idxs"] = ch_id_coverages
-            cryptomatte_streams[cryp_key]["ch_pair_names"] = ch_id_coverage_names
-        return cryptomatte_streams
-
-    def assertManifestsAreValidAndMatch(self, result_md, correct_md, key):
+        return self.image_metadata(img).streams
+
+    @tests.timed
+    def assertManifestsAreValidAndMatch(self, result_meta, correct_meta, key):
         """ Does a comparison between two manifests. Order is not important, but contents are.
-        Checks both are parsable with json
+        result_meta and correct_meta are the ImageMetadata of the images.
+        Checks both are parsable as strict json in the writer's format
         Checks that there are no extra names in either manifest
         """
         try:
-            correct_manifest = json.loads(correct_md[key])
+            correct_manifest = correct_meta.manifest(key, strict=True)
         except Exception, e:
             raise RuntimeError("Correct manifest could not be loaded. %s" % e)
         try:
-            result_manifest = json.loads(result_md[key])
+            result_manifest = result_meta.manifest(key, strict=True)
         except Exception, e:
             self.fail("Result manifest could not be loaded. %s" % e)
 
         # test manifest hashes?
-        correct_names = set(correct_manifest.keys())
-        result_names = set(result_manifest.keys())
+        correct_names = set(correct_manifest.names)
+        result_names = set(result_manifest.names)
 
         if not result_manifest:
             self.fail("%s - Result manifest is empty. " % key)
@@ -144,6 +109,7 @@ class CryptomatteTestBase(tests.KickAndCompareTestCase):
                 "%s - Missing manifest names: %s, Extra manifest names: %s" %
                 (key, list(extra_in_correct), list(extra_in_result)))
 
+    @tests.timed
     def assertCryptoCompressionValid(self):
         for result_img, correct_img in self.exr_result_images:
             result_compression = next(x.value
@@ -160,6 +126,12 @@ class CryptomatteTestBase(tests.KickAndCompareTestCase):
                 result_compression, {'none', 'zip', 'zips'},
                 "Compression not of an allowed type: %s" % result_compression)
 
+    def assertNoPartialSidecars(self):
+        """ Sidecars are written to temp files and renamed, so none should be left behind """
+        leftovers = [x for x in os.listdir(self.result_dir) if x.endswith(".tmp")]
+        self.assertFalse(leftovers, "Temporary sidecar files left behind: %s" % leftovers)
+
+    @tests.timed
     def assertAllManifestsValidAndMatch(self):
         """
         Tests manifests match and are valid, and tests that all other cryptomatte
@@ -167,8 +139,10 @@ class CryptomatteTestBase(tests.KickAndCompareTestCase):
         """
         for result_img, correct_img in self.exr_result_images:
             self.assertSameChannels(result_img, correct_img)
-            result_md = self.crypto_metadata(result_img)
-            correct_md = self.crypto_metadata(correct_img)
+            result_meta = self.image_metadata(result_img)
+            correct_meta = self.image_metadata(correct_img)
+            result_md = result_meta.crypto_metadata
+            correct_md = correct_meta.crypto_metadata
 
             for key in correct_md:
                 self.assertIn(key, result_md,
@@ -181,7 +155,7 @@ class CryptomatteTestBase(tests.KickAndCompareTestCase):
             for key in correct_md:
                 if key.endswith("/manifest"):
                     self.assertManifestsAreValidAndMatch(
-                        result_md, correct_md, key)
+                        result_meta, correct_meta, key)
                     found_manifest = True
                 else:
                     self.assertEqual(correct_md[key], result_md[key],
@@ -189,6 +163,7 @@ class CryptomatteTestBase(tests.KickAndCompareTestCase):
                                      (result_md[key], correct_md[key]))
             self.assertTrue(found_manifest, "No manifest found")
 
+    @tests.timed
     def assertCryptomattePixelsMatch(self,
                                      rms_tolerance=0.01,
                                      very_different_num_tolerance=4,
@@ -197,49 +172,33 @@ class CryptomatteTestBase(tests.KickAndCompareTestCase):
         Tests pixels match in terms of coverage per ID. Normal image diff doesn't work here with any
         tolerance, because reshuffled IDs (for different sampling) cause giant errors. As a result,
         comparison is more costly, but better geared for Cryptomatte.
+
+        Compares the full data window of each image. Rank channels are read into arrays once per
+        stream, and errors are reduced per (pixel, ID) by cryptomatte_compare.coverage_errors.
         """
         import math
 
-        def get_id_coverage_dict(pixel_values, ch_pair_idxs):
-            return {
-                pixel_values[x]: pixel_values[y]
-                for x, y, in ch_pair_idxs if (x != 0.0 or y != 0.0)
-            }
-
+        self.fail_test_if_no_numpy()
         big_dif_tolerance = 0.3
 
         for result_img, correct_img in self.exr_result_images:
             result_nested_md = self.sorted_crypto_metadata(result_img)
             correct_nested_md = self.sorted_crypto_metadata(correct_img)
+            self.assertSameResolution(result_img, correct_img)
 
             total_count = 0
             very_different_count = 0
             squared_error = 0.0
-            for row in range(0, 128):
-                for column in range(0, 128):
-                    result_pixel = result_img.getpixel(row, column)
-                    correct_pixel = correct_img.getpixel(row, column)
-
-                    for cryp_key in result_nested_md:
-                        result_id_cov = get_id_coverage_dict(
-                            result_pixel,
-                            result_nested_md[cryp_key]["ch_pair_idxs"])
-                        correct_id_cov = get_id_coverage_dict(
-                            correct_pixel,
-                            correct_nested_md[cryp_key]["ch_pair_idxs"])
-                        for id_val, cov in correct_id_cov.iteritems():
-                            total_count += 1
-                            delta = abs(cov - (result_id_cov.get(id_val, 0.0)))
-                            squared_error += delta * delta
-                            if delta > big_dif_tolerance:
-                                very_different_count += 1
-                        for id_val, cov in result_id_cov.iteritems():
-                            if id_val not in correct_id_cov:
-                                total_count += 1
-                                delta = cov
-                                squared_error += delta * delta
-                                if delta > big_dif_tolerance:
-                                    very_different_count += 1
+            for cryp_key in result_nested_md:
+                result_ids, result_covs = cryptomatte_compare.read_rank_pairs(
+                    result_img, result_nested_md[cryp_key]["ch_pair_idxs"])
+                correct_ids, correct_covs = cryptomatte_compare.read_rank_pairs(
+                    correct_img, correct_nested_md[cryp_key]["ch_pair_idxs"])
+                count, error, very_different = cryptomatte_compare.coverage_errors(
+                    result_ids, result_covs, correct_ids, correct_covs, big_dif_tolerance)
+                total_count += count
+                squared_error += error
+                very_different_count += very_different
 
             self.assertTrue(total_count, "No values in %s" % result_img.name)
 
@@ -257,15 +216,23 @@ class CryptomatteTestBase(tests.KickAndCompareTestCase):
                 rms < rms_tolerance,
                 "Root mean square error was greater than %s. " % rms_tolerance)
 
+    @tests.timed
     def assertNonCryptomattePixelsMatch(self, rms_tolerance=0.01):
         """
         Very simple tolerance test for non-cryptomatte pixels.
+
+        Both images are streamed a block of rows at a time by cryptomatte_compare.channel_errors,
+        over the full data window. As before, each channel's squared error is normalized by the
+        number of values compared over all checked channels. Failures report the true per-channel
+        RMS, max error and worst pixel.
         """
         import math
 
+        self.fail_test_if_no_numpy()
         for result_img, correct_img in self.result_images:
             result_nested_md = self.sorted_crypto_metadata(result_img)
             correct_nested_md = self.sorted_crypto_metadata(correct_img)
+            self.assertSameResolution(result_img, correct_img)
 
             result_channels = []
             for cryp_key in result_nested_md:
@@ -283,28 +250,16 @@ class CryptomatteTestBase(tests.KickAndCompareTestCase):
                 x for x in range(len(result_img.spec().channelnames))
                 if x not in result_channels
             ]
-            squared_errors = [
-                0.0 for x in range(len(result_img.spec().channelnames))
-            ]
-            total_count = 0
-            squared_error = 0.0
-            for row in range(0, 128):
-                for column in range(0, 128):
-                    result_pixel = result_img.getpixel(row, column)
-                    correct_pixel = correct_img.getpixel(row, column)
-
-                    for i in channels_to_check:
-                        delta = abs(result_pixel[i] - correct_pixel[i])
-                        squared_errors[i] += delta * delta
-                        total_count += 1
-
-            for i in channels_to_check:
-                squared_error = squared_errors[i]
-                rms = math.sqrt(squared_error / float(total_count))
+            errors = cryptomatte_compare.channel_errors(result_img.name, correct_img.name,
+                                                        channels_to_check)
+            total_count = sum(error.count for error in errors)
+            for error in errors:
+                rms = math.sqrt(error.squared_error / float(total_count))
                 self.assertTrue(
                     rms < rms_tolerance,
-                    "Root mean square error was greater than %s. (Channel: %s)" %
-                    (rms_tolerance, result_img.spec().channelnames[i]))
+                    "Root mean square error was greater than %s. (Channel: %s, RMS: %s, "
+                    "max error: %s at %s)" % (rms_tolerance, error.name, error.rms,
+                                              error.max_error, error.worst_pixel))
 
 #############################################
 # Cryptomatte test cases themselves
@@ -350,6 +305,32 @@ class Cryptomatte000(CryptomatteTestBase):
     def test_cryptomatte_pixels(self):
         self.assertCryptomattePixelsMatch()
 
+    def test_render_stats(self):
+        """
+        render_stats is on for both shaders, so one report covering both is logged, whichever
+        shader sets up first, with each stream's manifest.
+        """
+        reports = render_stats.parse_log(self.result_log)
+        self.assertEqual(len(reports), 1, "Expected one render statistics report in the log.")
+        stats = reports[0]
+        for timer in render_stats.TIMERS:
+            self.assertGreater(stats["timers"][timer]["calls"], 0, "%s was not timed." % timer)
+        self.assertEqual(stats["timers"]["write_metadata_to_driver"]["calls"], 3)
+        self.assertGreater(stats["counters"]["filter_pixels"], 0)
+        self.assertIn("name_hash_misses", stats["counters"])
+
+        for result_img, _ in self.exr_result_images:
+            meta = self.image_metadata(result_img)
+            for key, value in meta.crypto_metadata.items():
+                if not key.endswith("/manifest"):
+                    continue
+                name = meta.crypto_metadata[key.replace("/manifest", "/name")]
+                self.assertIn(name, stats["streams"])
+                stream = stats["streams"][name]
+                self.assertFalse(stream["sidecar"])
+                self.assertEqual(stream["manifest_entries"], len(meta.manifest(key)))
+                self.assertEqual(stream["manifest_bytes"], len(value))
+
     def test_unit_tests_ran(self):
         with open(self.result_log) as f:
             log_contents = f.read()
@@ -396,6 +377,9 @@ class Cryptomatte001(CryptomatteTestBase):
     def test_results_all_present(self):
         self.assertAllResultFilesPresent()
 
+    def test_no_partial_sidecars(self):
+        self.assertNoPartialSidecars()
+
     def test_cryptomatte_pixels(self):
         self.assertCryptomattePixelsMatch()
 
@@ -440,6 +424,9 @@ class Cryptomatte003(CryptomatteTestBase):
     def test_results_all_present(self):
         self.assertAllResultFilesPresent()
 
+    def test_no_partial_sidecars(self):
+        self.assertNoPartialSidecars()
+
     def test_cryptomatte_pixels(self):
         self.assertCryptomattePixelsMatch()
 
@@ -624,6 +611,64 @@ class CryptomatteSetup(unittest.TestCase):
         ]
         self._test_setup(outputs_init, correct_outputs)
 
+    def test_filter_rank_groups(self):
+        """ Rank filters share rankings with single_pass_filter on, and not with it off """
+        outputs_init = [
+            "RGBA RGBA my_filter my_driver",
+            "crypto_asset RGBA my_filter my_driver",
+        ]
+        options = ai.AiUniverseGetOptions()
+        ai.AiNodeSetArray(options, "outputs", self.list_to_array(outputs_init))
+        ai.AiRender()
+
+        for i in range(3):
+            rank_filter = ai.AiNodeLookUpByName("crypto_asset_filter%02d" % i)
+            self.assertEqual(ai.AiNodeGetInt(rank_filter, "rank"), i * 2)
+            self.assertEqual(ai.AiNodeGetStr(rank_filter, "rank_group"), "crypto_asset")
+            self.assertEqual(ai.AiNodeGetInt(rank_filter, "rank_group_size"), 3)
+
+    def test_filter_no_rank_groups(self):
+        """ Rank filters do not share rankings with single_pass_filter off """
+        ai.AiNodeSetBool(self.my_cryptomatte, "single_pass_filter", False)
+        outputs_init = [
+            "RGBA RGBA my_filter my_driver",
+            "crypto_asset RGBA my_filter my_driver",
+        ]
+        options = ai.AiUniverseGetOptions()
+        ai.AiNodeSetArray(options, "outputs", self.list_to_array(outputs_init))
+        ai.AiRender()
+
+        for i in range(3):
+            rank_filter = ai.AiNodeLookUpByName("crypto_asset_filter%02d" % i)
+            self.assertEqual(ai.AiNodeGetStr(rank_filter, "rank_group"), "")
+
+    def test_render_stats_file(self):
+        """ Render statistics are written to render_stats_file when the shader is destroyed """
+        stats_file = os.path.join(tempfile.gettempdir(), "cryptomatte_render_stats.json")
+        if os.path.exists(stats_file):
+            os.remove(stats_file)
+        ai.AiNodeSetStr(self.my_cryptomatte, "render_stats_file", stats_file)
+        outputs_init = [
+            "RGBA RGBA my_filter my_driver",
+            "crypto_asset RGBA my_filter my_driver",
+        ]
+        options = ai.AiUniverseGetOptions()
+        ai.AiNodeSetArray(options, "outputs", self.list_to_array(outputs_init))
+        ai.AiRender()
+        # reports through node_finish, leaving the session to tearDown
+        ai.AiNodeDestroy(self.my_cryptomatte)
+
+        try:
+            stats = render_stats.load(stats_file)
+        finally:
+            if os.path.exists(stats_file):
+                os.remove(stats_file)
+        self.assertEqual(stats["timers"]["compile_standard_manifests"]["calls"], 1)
+        self.assertEqual(stats["timers"]["write_metadata_to_driver"]["calls"], 1)
+        self.assertGreater(stats["timers"]["filter_pixel"]["calls"], 0)
+        self.assertEqual(stats["streams"]["crypto_asset"],
+                         {"manifest_entries": 0, "manifest_bytes": 2, "sidecar": False})
+
     def _test_setup(self, outputs_init, correct_outputs):
         """ Tests setup of outputs occurs correctly with a full precision driver 
         HALF aovs should be preserved, but no new AOVs should be set to HALF.
@@ -641,3 +686,347 @@ class CryptomatteSetup(unittest.TestCase):
         self.assertEqual(correct_outputs[:orig_num], found_outputs[:orig_num])
         # check addutional aovs
         self.assertEqual(correct_outputs[orig_num:], found_outputs[orig_num:])
+
+
+class CryptomatteHashing(unittest.TestCase):
+    """ Checks the Python name hashing in cryptomatte_hash against the plugin's. """
+
+    hash_vectors = [
+        ("hello", 6.0705627102400005616e-17),
+        ("cube", -4.08461912519e+15),
+        ("sphere", 2.79018604383e+15),
+        ("plane", 3.66557617593e-11),
+        (u"\u0440\u0430\u0432\u043d\u0438\u043d\u0430", -1.3192631212399999468e-25),
+        (u"m\u00e4dchen", 6.2361298211599995797e+25),
+    ]
+
+    def setUp(self):
+        if tests.np is None:
+            self.fail("NumPy not loaded.")
+
+    @staticmethod
+    def correct_manifests():
+        """ Yields (path, Manifest) for every manifest of the correct results """
+        test_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), "cryptomatte")
+        for dir_name in sorted(os.listdir(test_dir)):
+            correct_dir = os.path.join(test_dir, dir_name)
+            if not dir_name.endswith("_correct") or not os.path.isdir(correct_dir):
+                continue
+            for file_name in sorted(os.listdir(correct_dir)):
+                path = os.path.join(correct_dir, file_name)
+                if file_name.endswith(".json"):
+                    yield path, cryptomatte_manifest.Manifest.from_file(path)
+                elif file_name.endswith(".exr") and tests.oiio:
+                    for attrib in tests.ImageBuf(path).spec().extra_attribs:
+                        if attrib.name.endswith("/manifest"):
+                            yield path, cryptomatte_manifest.Manifest.from_string(attrib.value)
+
+    def test_hash_vectors(self):
+        """ Float IDs of the names hashed by the C++ unit tests """
+        names = [name for name, _ in self.hash_vectors]
+        expected = tests.np.array([float_id for _, float_id in self.hash_vectors], "float32")
+        batched = cryptomatte_hash.hash_names(names)
+        self.assertEqual(list(batched.float_ids), list(expected))
+        for name, float_id in zip(names, expected):
+            self.assertEqual(tests.np.float32(cryptomatte_hash.hash_name(name)[0]), float_id)
+
+    def test_batched_matches_reference(self):
+        """ hash_names against the pure Python hash, over every name length bucket up to 40 """
+        chars = u"ab/\\\":. \u00e4\u0440"
+        names = [u"".join(chars[(i * 7 + j) % len(chars)] for j in range(i % 41))
+                 for i in range(500)]
+        batched = cryptomatte_hash.hash_names(names)
+        for i, name in enumerate(names):
+            float_id, hash_value, murmur_hash, preview_g, preview_b = (
+                cryptomatte_hash.hash_name(name))
+            self.assertEqual(batched.murmur_hashes[i], murmur_hash, name)
+            self.assertEqual(batched.hashes[i], hash_value, name)
+            self.assertEqual(batched.preview_g[i], preview_g, name)
+            self.assertEqual(batched.preview_b[i], preview_b, name)
+
+    def test_correct_manifests(self):
+        """ Every manifest hash of the correct results is the hash of its name """
+        num_manifests = 0
+        for path, manifest in self.correct_manifests():
+            batched = cryptomatte_hash.hash_names(manifest.names)
+            mismatched = [
+                name for name, hash_value, expected in zip(manifest.names, batched.hashes,
+                                                           manifest.hashes)
+                if hash_value != expected
+            ]
+            self.assertFalse(mismatched, "%s - Hash mismatch for names: %s" % (path, mismatched))
+            num_manifests += 1
+        self.assertTrue(num_manifests, "No manifests found")
+
+
+class CryptomatteInstanceOverrides(unittest.TestCase):
+    """
+    Renders 040_instanced_procedural.ass, a ginstance of a procedural with crypto_asset and
+    crypto_object_offset user data. The procedural's shape does not have that user data, so its
+    names must not come from the name hash cache filled when manifests are compiled.
+    """
+
+    def setUp(self):
+        if tests.oiio is None or tests.np is None:
+            self.fail("OIIO and NumPy are required.")
+        test_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), "cryptomatte")
+        self.output_file_name = os.path.join(tempfile.gettempdir(), "instance_overrides.exr")
+
+        ai.AiBegin()
+        ai.AiMsgSetConsoleFlags(ai.AI_LOG_WARNINGS | ai.AI_LOG_ERRORS)
+        ai.AiASSLoad(os.path.join(test_dir, "040_instanced_procedural.ass"))
+        options = ai.AiUniverseGetOptions()
+        ai.AiNodeSetBool(options, "skip_license_check", True)
+        ai.AiNodeSetStr(options, "procedural_searchpath", test_dir)
+        ai.AiNodeSetStr(ai.AiNodeLookUpByName("driver"), "filename", self.output_file_name)
+        ai.AiRender()
+        ai.AiEnd()
+
+    def tearDown(self):
+        if os.path.exists(self.output_file_name):
+            os.remove(self.output_file_name)
+
+    def center_ids(self, stream_name):
+        """ Rank 0 ID of the center pixel, and the stream's manifest names """
+        image_input = tests.oiio.ImageInput.open(self.output_file_name)
+        try:
+            stream = cryptomatte_extract.open_stream(image_input, self.output_file_name,
+                                                     stream_name)
+            ids = tests.np.concatenate(
+                [chunk for _, chunk, _ in cryptomatte_extract.iter_rank_chunks(image_input,
+                                                                               stream)])
+            height, width = ids.shape[:2]
+            return ids[height // 2, width // 2, 0], stream.manifest.names
+        finally:
+            image_input.close()
+
+    def test_instance_name_override(self):
+        """ crypto_asset on the ginstance replaces the asset name """
+        center_id, _ = self.center_ids("crypto_asset")
+        self.assertEqual(center_id, cryptomatte_hash.hash_name("instanced_asset")[1])
+
+    def test_instance_offset_override(self):
+        """ crypto_object_offset on the ginstance is appended to the object name """
+        center_id, names = self.center_ids("crypto_object")
+        offset_hashes = [cryptomatte_hash.hash_name(name + "_7")[1] for name in names]
+        self.assertIn(center_id, offset_hashes,
+                      "Object ID is not an offset name of %s" % list(names))
+
+
+class CryptomatteExtraction(unittest.TestCase):
+    """ Checks cryptomatte_extract against the correct results. """
+
+    def setUp(self):
+        if tests.oiio is None or tests.np is None:
+            self.fail("OIIO and NumPy are required.")
+        test_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), "cryptomatte")
+        self.tiled_exr = os.path.join(test_dir, "001_correct", "crypto_asset.exr")
+        self.scanline_exr = os.path.join(test_dir, "000_correct", "crypto_asset.exr")
+        self.instances_exr = os.path.join(test_dir, "010_correct", "result.exr")
+
+    def all_coverage(self, image_path, stream_name):
+        """ Sum of the coverage of every rank with a nonzero (not background) ID """
+        image_input = tests.oiio.ImageInput.open(image_path)
+        stream = cryptomatte_extract.open_stream(image_input, image_path, stream_name)
+        total = sum(tests.np.where(ids != 0, coverages, 0.0).sum(axis=-1, dtype="float32")
+                    for _, ids, coverages in cryptomatte_extract.iter_rank_chunks(
+                        image_input, stream, 1 << 16))
+        image_input.close()
+        return total, stream.manifest.names
+
+    def test_all_names_matte(self):
+        """ The matte of every name in the manifest is the sum of all object coverages """
+        for image_path in (self.tiled_exr, self.scanline_exr):
+            total, names = self.all_coverage(image_path, "crypto_asset")
+            matte = cryptomatte_extract.extract_matte(image_path, "crypto_asset", names)
+            self.assertTrue(tests.np.allclose(matte, total, atol=1e-5), image_path)
+
+    def test_chunking(self):
+        """ Mattes do not depend on the number of rows read at once """
+        for image_path in (self.tiled_exr, self.scanline_exr):
+            _, names = self.all_coverage(image_path, "crypto_asset")
+            whole = cryptomatte_extract.extract_matte(image_path, "crypto_asset", names[:2],
+                                                      1 << 16)
+            for chunk_rows in (1, 7, 64):
+                matte = cryptomatte_extract.extract_matte(image_path, "crypto_asset", names[:2],
+                                                          chunk_rows)
+                self.assertTrue((matte == whole).all(), "%s, %s rows" % (image_path, chunk_rows))
+
+    def test_batch(self):
+        """ Batch mattes match single mattes, and hold all object coverage """
+        for image_path, stream_name in ((self.tiled_exr, "crypto_asset"),
+                                        (self.instances_exr, "crypto_object")):
+            total, names = self.all_coverage(image_path, stream_name)
+            mattes = cryptomatte_extract.extract_all_mattes(image_path, stream_name, 7)
+            summed = tests.np.zeros_like(total)
+            for _, _, matte in mattes.iter_mattes():
+                summed += matte
+            self.assertTrue(tests.np.allclose(summed, total, atol=1e-5), image_path)
+
+            for name in names[::20]:
+                matte = cryptomatte_extract.extract_matte(image_path, stream_name, [name])
+                self.assertTrue(tests.np.allclose(mattes.matte([name]), matte, atol=1e-6),
+                                "%s, %s" % (image_path, name))
+
+    def test_unknown_names(self):
+        with self.assertRaises(KeyError):
+            cryptomatte_extract.extract_matte(self.scanline_exr, "crypto_asset", ["not_a_name"])
+        with self.assertRaises(KeyError):
+            cryptomatte_extract.extract_matte(self.scanline_exr, "not_a_stream", ["name"])
+
+
+class CryptomatteBinaryManifest(unittest.TestCase):
+    """ Checks the binary manifest reader in cryptomatte_manifest. """
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for file_name in os.listdir(self.temp_dir):
+            os.remove(os.path.join(self.temp_dir, file_name))
+        os.rmdir(self.temp_dir)
+
+    def write_binary(self, data, file_name="manifest.bin"):
+        path = os.path.join(self.temp_dir, file_name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_matches_correct_manifests(self):
+        """ Binary manifests of the correct results resolve every hash as the JSON ones do """
+        for path, manifest in CryptomatteHashing.correct_manifests():
+            binary_path = self.write_binary(cryptomatte_manifest.encode_binary_manifest(manifest))
+            with cryptomatte_manifest.BinaryManifest.from_file(binary_path) as binary_manifest:
+                self.assertEqual(len(binary_manifest), len(manifest), path)
+                self.assertEqual(binary_manifest.to_manifest().names, manifest.names, path)
+                for name, hash_value in manifest:
+                    self.assertEqual(binary_manifest.name_of(hash_value),
+                                     manifest.name_of(hash_value), path)
+
+    def test_large(self):
+        """ Manifests past the 100000 entry limit of JSON manifests """
+        num_entries = 250000
+        # distinct hashes, in the range of float IDs as real hashes are
+        entries = [(u"agent_%s" % i, 0x3f800000 | (i * 2654435761) & 0x7fffff)
+                   for i in range(num_entries)]
+        path = self.write_binary(cryptomatte_manifest.encode_binary_manifest(entries))
+        with cryptomatte_manifest.BinaryManifest.from_file(path) as binary_manifest:
+            self.assertEqual(len(binary_manifest), num_entries)
+            for name, hash_value in entries[::997] + entries[-1:]:
+                self.assertEqual(binary_manifest.name_of(hash_value), name)
+                self.assertEqual(binary_manifest.name_of_float_id(
+                    cryptomatte_manifest.hash_to_float_id(hash_value)), name)
+            self.assertIsNone(binary_manifest.name_of(1))
+
+    def test_invalid(self):
+        data = cryptomatte_manifest.encode_binary_manifest([(u"cube", 0x3f800000)])
+        other_version = data[:8] + b"\x02" + data[9:]
+        for invalid in (b"", data[:10], b"NOTMANIF" + data[8:], other_version, data[:-1]):
+            path = self.write_binary(invalid)
+            with self.assertRaises(cryptomatte_manifest.ManifestError):
+                cryptomatte_manifest.BinaryManifest.from_file(path).close()
+        empty = cryptomatte_manifest.BinaryManifest(
+            cryptomatte_manifest.encode_binary_manifest([]))
+        self.assertEqual(len(empty), 0)
+        self.assertIsNone(empty.name_of(0))
+
+
+class CryptomatteRenderCache(unittest.TestCase):
+    """ Checks render_cache keys, restores and eviction, without rendering. """
+
+    class FakeCase(object):
+        arnold_v = 1
+        arnold_t = 4
+        arnold_nw = 20
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.case = self.FakeCase()
+        self.case.build_dir = os.path.join(self.temp_dir, "build")
+        self.case.ass_file = os.path.join(self.temp_dir, "scene.ass")
+        os.mkdir(self.case.build_dir)
+        self.write(os.path.join(self.case.build_dir, "cryptomatte.so"), "plugin")
+        self.write(self.case.ass_file, "options {}")
+        self.result_dir = os.path.join(self.temp_dir, "result")
+        os.mkdir(self.result_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    @staticmethod
+    def write(path, contents):
+        with open(path, "w") as f:
+            f.write(contents)
+
+    def make_cache(self, max_bytes=1 << 20, fresh=False):
+        cache = render_cache.RenderCache(os.path.join(self.temp_dir, "cache"), max_bytes, fresh)
+        # kick -av is not run
+        cache._arnold_version = b"Arnold 5.0.0.0"
+        return cache
+
+    def store_result(self, cache, key, contents):
+        """ Stores a result of one 10 byte file, and returns the entry directory """
+        self.write(os.path.join(self.result_dir, "result.txt"), contents.ljust(10))
+        cache.store(key, self.result_dir)
+        os.remove(os.path.join(self.result_dir, "result.txt"))
+        return cache.entry_dir(key)
+
+    def restored(self, cache, key):
+        """ Contents of the restored result, or None on a miss """
+        result_file = os.path.join(self.result_dir, "result.txt")
+        if os.path.exists(result_file):
+            os.remove(result_file)
+        if not cache.restore(key, self.result_dir):
+            return None
+        with open(result_file) as f:
+            return f.read().strip()
+
+    def test_key(self):
+        """ Keys change with the scene, the plugin binaries and the kick arguments """
+        cache = self.make_cache()
+        key = cache.key(self.case)
+        self.assertEqual(cache.key(self.case), key)
+        self.write(self.case.ass_file, "options { AA_samples 2 }")
+        scene_key = cache.key(self.case)
+        self.assertNotEqual(scene_key, key)
+        self.write(os.path.join(self.case.build_dir, "cryptomatte.so"), "rebuilt plugin")
+        binary_key = cache.key(self.case)
+        self.assertNotEqual(binary_key, scene_key)
+        self.case.arnold_t = 8
+        self.assertNotEqual(cache.key(self.case), binary_key)
+
+    def test_hit_and_miss(self):
+        cache = self.make_cache()
+        self.assertIsNone(self.restored(cache, "missing"))
+        self.store_result(cache, "stored", "render")
+        self.assertEqual(self.restored(cache, "stored"), "render")
+        self.assertIsNone(self.restored(cache, "missing"))
+
+    def test_fresh(self):
+        """ A fresh cache restores nothing, but still stores """
+        cache = self.make_cache()
+        self.store_result(cache, "stored", "render")
+        fresh_cache = self.make_cache(fresh=True)
+        self.assertIsNone(self.restored(fresh_cache, "stored"))
+        self.store_result(fresh_cache, "stored", "fresh")
+        self.assertEqual(self.restored(cache, "stored"), "fresh")
+
+    def test_eviction_order(self):
+        """ Least recently used entries are evicted first, never the one just stored """
+        cache = self.make_cache(max_bytes=25)
+        first = self.store_result(cache, "first", "first")
+        second = self.store_result(cache, "second", "second")
+        os.utime(first, (1000, 1000))
+        os.utime(second, (2000, 2000))
+        # restoring touches first, so second is now the least recently used
+        self.assertEqual(self.restored(cache, "first"), "first")
+        self.store_result(cache, "third", "third")
+        self.assertIsNone(self.restored(cache, "second"))
+        self.assertEqual(self.restored(cache, "first"), "first")
+        self.assertEqual(self.restored(cache, "third"), "third")
+
+        # a single entry over the limit is kept
+        small_cache = self.make_cache(max_bytes=5)
+        self.store_result(small_cache, "fourth", "fourth")
+        self.assertEqual(self.restored(small_cache, "fourth"), "fourth")
+        self.assertIsNone(self.restored(small_cache, "first"))
@@ -0,0 +1,160 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+"""
+Cache of parsed Cryptomatte metadata per image.
+
+Parsing an image's metadata walks its extra attributes, reads its sidecar manifests, and finds
+the rank channels of each stream. The result is cached by image path and is reused while the
+image and its sidecars keep the same mtime and size, so every test method shares one parse.
+
+The cache lives in memory for a run, and can optionally be saved to a file between runs.
+"""
+import os
+import pickle
+import threading
+import uuid
+
+import cryptomatte_manifest
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.abspath(os.path.dirname(__file__)), ".metadata_cache")
+# Bumped whenever ImageMetadata changes, so stale cache files are ignored.
+CACHE_VERSION = 1
+
+
+def file_signature(path):
+    """ (mtime, size) of a file, or None if it does not exist """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+class ImageMetadata(object):
+    """
+    Parsed Cryptomatte metadata of one image. Treat as read only, it is shared between tests.
+
+    crypto_metadata: {key: value} of all "cryptomatte/..." attributes, with the contents of
+        sidecar manifests added as "cryptomatte/<id>/manifest"
+    streams: {stream name: {metadata key: value}}, with the rank channels of each stream in
+        "ch_pair_idxs" and "ch_pair_names"
+    signatures: {path: (mtime, size)} of the image and its sidecars, when parsed
+    """
+
+    def __init__(self, image_path, spec):
+        self.image_path = image_path
+        self.signatures = {image_path: file_signature(image_path)}
+        self.crypto_metadata = self._parse_crypto_metadata(spec)
+        self.streams = self._parse_streams(spec)
+        self._manifests = {}
+
+    def _parse_crypto_metadata(self, spec):
+        metadata = {
+            a.name: a.value
+            for a in spec.extra_attribs
+            if a.name.startswith("cryptomatte")
+        }
+        for key in list(metadata.keys()):
+            if key.endswith("/manif_file"):
+                sidecar_path = os.path.join(os.path.dirname(self.image_path), metadata[key])
+                self.signatures[sidecar_path] = file_signature(sidecar_path)
+                with open(sidecar_path) as f:
+                    metadata[key.replace("manif_file", "manifest")] = f.read()
+        return metadata
+
+    def _parse_streams(self, spec):
+        streams = {}
+        for key, value in self.crypto_metadata.items():
+            prefix, cryp_key, cryp_md_key = key.split("/")
+            name = self.crypto_metadata["/".join((prefix, cryp_key, "name"))]
+            streams.setdefault(name, {})[cryp_md_key] = value
+
+        channel_names = list(spec.channelnames)
+        channels_dict = {ch: i for i, ch in enumerate(channel_names)}
+        for stream in streams.values():
+            name = stream["name"]
+            ch_id_coverages = []
+            ch_id_coverage_names = []
+            for i, ch in enumerate(channel_names):
+                if not ch.startswith(name) or ch.startswith("%s." % name):
+                    continue
+                if ch.endswith(".R"):
+                    red_name = ch
+                    green_name = "%s.G" % ch[:-2]
+                    blue_name = "%s.B" % ch[:-2]
+                    alpha_name = "%s.A" % ch[:-2]
+                    ch_id_coverages.append((i, channels_dict[green_name]))
+                    ch_id_coverages.append((channels_dict[blue_name], channels_dict[alpha_name]))
+                    ch_id_coverage_names.append((red_name, green_name))
+                    ch_id_coverage_names.append((blue_name, alpha_name))
+            stream["ch_pair_idxs"] = ch_id_coverages
+            stream["ch_pair_names"] = ch_id_coverage_names
+        return streams
+
+    def is_current(self):
+        """ True if the image and its sidecars are unchanged since parsing """
+        return all(file_signature(path) == signature
+                   for path, signature in self.signatures.items())
+
+    def manifest(self, key, strict=False):
+        """
+        Parsed manifest of a "cryptomatte/<id>/manifest" key, as a cryptomatte_manifest.Manifest.
+        Raises cryptomatte_manifest.ManifestError if it cannot be parsed.
+        """
+        if (key, strict) not in self._manifests:
+            self._manifests[(key, strict)] = cryptomatte_manifest.Manifest.from_string(
+                self.crypto_metadata[key], strict)
+        return self._manifests[(key, strict)]
+
+
+class MetadataCache(object):
+    """ ImageMetadata by absolute image path, optionally persisted to cache_file. """
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+        if cache_file and os.path.isfile(cache_file):
+            self._entries = self._load(cache_file)
+
+    @staticmethod
+    def _load(cache_file):
+        """ Entries of a cache file. Unreadable or outdated files are ignored. """
+        try:
+            with open(cache_file, "rb") as f:
+                version, entries = pickle.load(f)
+        except Exception:
+            return {}
+        return entries if version == CACHE_VERSION else {}
+
+    def get(self, image_path, spec):
+        """ ImageMetadata of an image, parsing it from spec (its ImageSpec) if not cached """
+        image_path = os.path.abspath(image_path)
+        with self._lock:
+            entry = self._entries.get(image_path)
+            if entry is not None and entry.is_current():
+                self.hits += 1
+                return entry
+            self.misses += 1
+            entry = ImageMetadata(image_path, spec)
+            self._entries[image_path] = entry
+            return entry
+
+    def save(self):
+        """ Writes current entries to cache_file, if set. Written to a temp file, then renamed. """
+        if not self.cache_file:
+            return
+        with self._lock:
+            entries = {path: entry for path, entry in self._entries.items() if entry.is_current()}
+            temp_file = "%s.tmp_%s" % (self.cache_file, uuid.uuid4().hex)
+            with open(temp_file, "wb") as f:
+                pickle.dump((CACHE_VERSION, entries), f, pickle.HIGHEST_PROTOCOL)
+            if os.path.exists(self.cache_file):
+                os.remove(self.cache_file)
+            os.rename(temp_file, self.cache_file)
@@ -0,0 +1,141 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+"""
+Content-addressed cache of kick render results.
+
+A render is identified by the bytes of its .ass file, the cryptomatte plugin binaries under
+build/, the kick arguments and the Arnold version. When none of those changed, the result
+directory of a previous render is restored instead of rendering again.
+
+Entries are directories named by key. Restoring an entry touches it, and storing one evicts the
+least recently used entries until the cache fits within its size limit.
+"""
+import hashlib
+import os
+import shutil
+import subprocess
+import threading
+import uuid
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), ".render_cache")
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+PLUGIN_EXTENSIONS = (".so", ".dll", ".dylib")
+
+
+def hash_file(path, hasher):
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+
+
+def find_plugin_binaries(build_dir):
+    """ Returns sorted paths of all cryptomatte plugin binaries under build_dir """
+    binaries = []
+    for dir_path, _, file_names in os.walk(build_dir):
+        for file_name in file_names:
+            name, ext = os.path.splitext(file_name)
+            if name == "cryptomatte" and ext in PLUGIN_EXTENSIONS:
+                binaries.append(os.path.join(dir_path, file_name))
+    return sorted(binaries)
+
+
+def directory_size(path):
+    total = 0
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            total += os.path.getsize(os.path.join(dir_path, file_name))
+    return total
+
+
+class RenderCache(object):
+    """ Size-bounded LRU cache of result directories, keyed by render inputs. """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, fresh=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fresh = fresh
+        self._arnold_version = None
+        self._lock = threading.Lock()
+
+    def arnold_version(self):
+        if self._arnold_version is None:
+            proc = subprocess.Popen("kick -av", shell=True, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            out, _ = proc.communicate()
+            assert proc.returncode == 0, "Could not get Arnold version from kick -av"
+            self._arnold_version = out.strip()
+        return self._arnold_version
+
+    def key(self, case):
+        """ Key for the render of a KickAndCompareTestCase class, after setup_paths """
+        binaries = find_plugin_binaries(case.build_dir)
+        assert binaries, "No cryptomatte plugin binary found under %s" % case.build_dir
+
+        hasher = hashlib.sha1()
+        hash_file(case.ass_file, hasher)
+        for binary in binaries:
+            hash_file(binary, hasher)
+        args = "-v %s -t %s -nw %s" % (case.arnold_v, case.arnold_t, case.arnold_nw)
+        hasher.update(args.encode("utf-8"))
+        hasher.update(self.arnold_version())
+        return hasher.hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def restore(self, key, result_dir):
+        """ Copies a cached result into result_dir. Returns False on a miss, or if fresh. """
+        if self.fresh:
+            return False
+        # under the lock, so another render's store() cannot evict the entry mid-copy
+        with self._lock:
+            entry = self.entry_dir(key)
+            if not os.path.isdir(entry):
+                return False
+            for file_name in os.listdir(entry):
+                shutil.copy2(os.path.join(entry, file_name), os.path.join(result_dir, file_name))
+            os.utime(entry, None)
+        return True
+
+    def store(self, key, result_dir):
+        """ Adds the files of result_dir to the cache, then evicts down to max_bytes. """
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                assert os.path.isdir(self.cache_dir), "Could not create %s" % self.cache_dir
+
+        # copy into a temporary entry first, so a partial entry is never seen as a hit.
+        temp_entry = self.entry_dir("tmp_%s" % uuid.uuid4().hex)
+        os.mkdir(temp_entry)
+        for file_name in os.listdir(result_dir):
+            result_file = os.path.join(result_dir, file_name)
+            if os.path.isfile(result_file):
+                shutil.copy2(result_file, os.path.join(temp_entry, file_name))
+
+        with self._lock:
+            entry = self.entry_dir(key)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(temp_entry, entry)
+            self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """ Removes least recently used entries until the cache fits in max_bytes. Call locked. """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = self.entry_dir(name)
+            if os.path.isdir(path) and not name.startswith("tmp_"):
+                entries.append((os.path.getmtime(path), name, directory_size(path)))
+        total = sum(size for _, _, size in entries)
+        for _, name, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(self.entry_dir(name))
+            total -= size
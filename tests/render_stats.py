@@ -0,0 +1,85 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+"""
+Reading the render statistics of the Cryptomatte plugin.
+
+With render_stats on, the cryptomatte shader logs its statistics at the end of each render,
+after a "[Cryptomatte] Render statistics:" line, as one line per entry (see RenderStats in
+render_stats.h):
+
+    [Cryptomatte] stats timer do_cryptomattes: 98304 calls, 0.012345 seconds, 125.6 ns/call
+    [Cryptomatte] stats counter filter_pixels: 16384
+    [Cryptomatte] stats stream crypto_asset: 12 manifest entries, 345 bytes, embedded
+
+With render_stats_file set, the same statistics are also written as JSON:
+
+    {"version": 1,
+     "timers": {"do_cryptomattes": {"calls": 98304, "seconds": 0.012345}, ...},
+     "counters": {"filter_pixels": 16384, ...},
+     "streams": {"crypto_asset": {"manifest_entries": 12, "manifest_bytes": 345,
+                                  "sidecar": false}}}
+
+Both are read into that JSON layout.
+"""
+import json
+import re
+
+RENDER_STATS_VERSION = 1
+TIMERS = ("do_cryptomattes", "filter_pixel", "compile_standard_manifests",
+          "write_metadata_to_driver")
+
+_HEADER = "[Cryptomatte] Render statistics:"
+_TIMER_RE = re.compile(r"\[Cryptomatte\] stats timer (\S+): (\d+) calls, ([\d.]+) seconds")
+_COUNTER_RE = re.compile(r"\[Cryptomatte\] stats counter (\S+): (\d+)")
+_STREAM_RE = re.compile(r"\[Cryptomatte\] stats stream (.+): (\d+) manifest entries, (\d+) bytes, "
+                        r"(sidecar|embedded)")
+
+
+class RenderStatsError(ValueError):
+    pass
+
+
+def empty_stats():
+    return {"version": RENDER_STATS_VERSION, "timers": {}, "counters": {}, "streams": {}}
+
+
+def parse_log(log_path):
+    """ Render statistics reported in an Arnold log, one dict per report, oldest first """
+    reports = []
+    with open(log_path) as f:
+        for line in f:
+            if _HEADER in line:
+                reports.append(empty_stats())
+                continue
+            if not reports or "[Cryptomatte] stats " not in line:
+                continue
+            stats = reports[-1]
+            timer = _TIMER_RE.search(line)
+            counter = _COUNTER_RE.search(line)
+            stream = _STREAM_RE.search(line)
+            if timer:
+                stats["timers"][timer.group(1)] = {"calls": int(timer.group(2)),
+                                                   "seconds": float(timer.group(3))}
+            elif counter:
+                stats["counters"][counter.group(1)] = int(counter.group(2))
+            elif stream:
+                stats["streams"][stream.group(1)] = {"manifest_entries": int(stream.group(2)),
+                                                     "manifest_bytes": int(stream.group(3)),
+                                                     "sidecar": stream.group(4) == "sidecar"}
+    return reports
+
+
+def load(stats_path):
+    """ Render statistics from a render_stats_file """
+    with open(stats_path) as f:
+        stats = json.load(f)
+    if stats.get("version") != RENDER_STATS_VERSION:
+        raise RenderStatsError("Unsupported render statistics version: %s" % stats.get("version"))
+    for key in ("timers", "counters", "streams"):
+        if not isinstance(stats.get(key), dict):
+            raise RenderStatsError("Render statistics have no %s" % key)
+    return stats
@@ -6,13 +6,21 @@
 #
 
 import os
+import functools
+import time
 import unittest
 import subprocess
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 try:
     import OpenImageIO as oiio
     from OpenImageIO import ImageBuf, ImageSpec, ImageBufAlgo
 except:
     oiio = None
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 
@@ -27,6 +35,74 @@ def get_all_cryptomatte_tests():
     return cryptomatte_tests.get_all_cryptomatte_tests()
 
 
+#############################################
+# Render scheduling
+#############################################
+
+_render_scheduler = None
+_render_cache = None
+_metadata_cache = None
+_timings = None
+
+
+def timed(method):
+    """
+    Decorator for TestCase helpers (assertions, image loading, metadata parsing). Adds the time
+    spent in them to the timing.Timings of the current run, if any, by test and method name.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if _timings is None:
+            return method(self, *args, **kwargs)
+        with _timings.timed(self.id(), method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+
+class RenderScheduler(object):
+    """
+    Starts the kick renders of all given KickAndCompareTestCase classes up front, on a pool
+    capped by the core count. Cores are split between concurrent kicks. Test classes then
+    only wait for their own render in setUpClass.
+    """
+
+    def __init__(self, test_cases, max_jobs=0):
+        cores = multiprocessing.cpu_count()
+        cases = []
+        for case in test_cases:
+            if issubclass(case, KickAndCompareTestCase) and case.ass and case not in cases:
+                cases.append(case)
+
+        self.jobs = max(1, min(max_jobs or cores, cores, len(cases) or 1))
+        self.threads_per_kick = max(1, cores // self.jobs)
+        self._pool = ThreadPool(self.jobs)
+        self._renders = {}
+        for case in cases:
+            self._renders[case] = self._pool.apply_async(case.render, (self.kick_threads(case),))
+
+    def kick_threads(self, case):
+        """ arnold_t of 0 or less means all cores, which here means this kick's share. """
+        if case.arnold_t <= 0:
+            return self.threads_per_kick
+        return min(case.arnold_t, self.threads_per_kick)
+
+    def wait(self, case):
+        """
+        Waits for the render of a test case, re-raising any error from it.
+        Returns False if the case was not scheduled.
+        """
+        pending = self._renders.pop(case, None)
+        if pending is None:
+            return False
+        pending.get()
+        return True
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+
 #############################################
 # KickAndCompare base class
 #############################################
@@ -39,20 +115,25 @@ class KickAndCompareTestCase(unittest.TestCase):
 
     @classmethod
     def setUpClass(self):
+        self.setup_paths()
+        if not (_render_scheduler and _render_scheduler.wait(self)):
+            self.render()
+
+    @classmethod
+    def setup_paths(self):
         assert self.ass, "No test name specified on test."
 
         file_dir = os.path.abspath(os.path.dirname(__file__))
 
-        build_dir = os.path.normpath(os.path.join(file_dir, "..", "build")).replace("\\", "/")
-        print build_dir
-        if not os.path.exists(build_dir):
-            raise RuntimeError("could not find %s ", build_dir)
+        self.build_dir = os.path.normpath(os.path.join(file_dir, "..", "build")).replace("\\", "/")
+        if not os.path.exists(self.build_dir):
+            raise RuntimeError("could not find %s ", self.build_dir)
         self.ass_file = os.path.join(file_dir, self.ass)
         ass_file_name = os.path.basename(self.ass_file)
-        test_dir = os.path.abspath(os.path.dirname(self.ass_file))
+        self.test_dir = os.path.abspath(os.path.dirname(self.ass_file))
 
-        self.result_dir = os.path.join(test_dir, "%s_result" % ass_file_name[:3]).replace("\\", "/")
-        self.correct_result_dir = os.path.join(test_dir, "%s_correct" % ass_file_name[:3]).replace("\\", "/")
+        self.result_dir = os.path.join(self.test_dir, "%s_result" % ass_file_name[:3]).replace("\\", "/")
+        self.correct_result_dir = os.path.join(self.test_dir, "%s_correct" % ass_file_name[:3]).replace("\\", "/")
         self.result_log = os.path.join(self.result_dir, "log.txt").replace("\\", "/")
         self.correct_file_names = [
             x for x in os.listdir(self.correct_result_dir)
@@ -60,10 +141,35 @@ class KickAndCompareTestCase(unittest.TestCase):
         ]
 
         assert os.path.isfile(self.ass_file), "No test ass file found. %s" % (self.ass_file)
-        assert os.path.isdir(test_dir), "No test dir found. %s" % (test_dir)
+        assert os.path.isdir(self.test_dir), "No test dir found. %s" % (self.test_dir)
         assert os.path.isdir(self.correct_result_dir), "No correct result dir found. %s" % (
             self.correct_result_dir)
 
+    @classmethod
+    def render(self, threads=None):
+        """
+        Clears the result directory and renders the test's ass file into it with kick, or
+        restores the result from the render cache if its inputs have not changed.
+        threads overrides arnold_t, and is used when several renders share the machine.
+        """
+        self.setup_paths()
+        self.clear_result_dir()
+
+        start = time.time()
+        cache_key = _render_cache.key(self) if _render_cache else None
+        if cache_key and _render_cache.restore(cache_key, self.result_dir):
+            print "Restored cached render: %s" % self.result_dir
+            cached = True
+        else:
+            self.kick(threads)
+            if cache_key:
+                _render_cache.store(cache_key, self.result_dir)
+            cached = False
+        if _timings:
+            _timings.record_render(self.__name__, time.time() - start, cached, self.result_log)
+
+    @classmethod
+    def clear_result_dir(self):
         # only remove previous results after it's confirmed everything else exists, to
         # mitigate odds we're looking at the wrong dir or something.
         if os.path.exists(self.result_dir):
@@ -82,14 +188,22 @@ class KickAndCompareTestCase(unittest.TestCase):
         ]
         assert not remaining_files, "Files were not cleaned up: %s " % remaining_files
 
+    @classmethod
+    def kick(self, threads=None):
+        print self.build_dir
         cmd = 'kick -v {v} -t {t} -nw {nw} -dp -dw -sl -nostdin -logfile {log} -i {ass}'.format(
-            v=self.arnold_v, t=self.arnold_t, nw=self.arnold_nw, log=self.result_log, ass=ass_file_name)
-        cwd = test_dir.replace("\\", "/")
+            v=self.arnold_v,
+            t=self.arnold_t if threads is None else threads,
+            nw=self.arnold_nw,
+            log=self.result_log,
+            ass=os.path.basename(self.ass_file))
+        cwd = self.test_dir.replace("\\", "/")
         print cmd, cwd
         env = os.environ.copy()
-        env["ARNOLD_PLUGIN_PATH"] = "%s;%s" % (build_dir, env.get("ARNOLD_PLUGIN_PATH", ""))
+        env["ARNOLD_PLUGIN_PATH"] = "%s;%s" % (self.build_dir, env.get("ARNOLD_PLUGIN_PATH", ""))
         proc = subprocess.Popen(cmd, cwd=cwd, env=env, shell=True, stderr=subprocess.PIPE)
-        rc = proc.wait()
+        proc.communicate()
+        rc = proc.returncode
         assert rc == 0, "Render return code indicates a failure: %s " % rc
 
     #
@@ -100,6 +214,11 @@ class KickAndCompareTestCase(unittest.TestCase):
         if oiio is None:
             self.fail("OIIO not loaded.")
 
+    def fail_test_if_no_numpy(self):
+        if np is None:
+            self.fail("NumPy not loaded.")
+
+    @timed
     def load_images(self, file_name):
         self.fail_test_if_no_oiio()
         allowed_exts = {".exr", ".tif", ".png", ".jpg"}
@@ -118,6 +237,15 @@ class KickAndCompareTestCase(unittest.TestCase):
                          "Channels mismatch between result and correct. %s vs %s" % (r_channels,
                                                                                      c_channels))
 
+    def assertSameResolution(self, result_image, correct_image):
+        r_spec, c_spec = result_image.spec(), correct_image.spec()
+        r_window = (r_spec.x, r_spec.y, r_spec.width, r_spec.height)
+        c_window = (c_spec.x, c_spec.y, c_spec.width, c_spec.height)
+        self.assertEqual(r_window, c_window,
+                         "Data window mismatch between result and correct. %s vs %s" % (r_window,
+                                                                                       c_window))
+
+    @timed
     def compare_image_pixels(self, result_image, correct_result_image, threshold):
         self.fail_test_if_no_oiio()
         """ 
@@ -133,6 +261,7 @@ class KickAndCompareTestCase(unittest.TestCase):
     # Assertions, for use in other test cases
     #
 
+    @timed
     def assertAllResultFilesPresent(self):
         """ Checks there are no files in result not in correct, and vice versa """
         for file_name in os.listdir(self.correct_result_dir):
@@ -148,6 +277,7 @@ class KickAndCompareTestCase(unittest.TestCase):
                 'Correct answer "%s" not found for result file. %s' % (file_name,
                                                                        self.correct_result_dir))
 
+    @timed
     def assertResultImageEqual(self, file_name, threshold, msg, print_results=True):
         """ 
         Given a file name to find it results, compare it against the correct result. 
@@ -182,20 +312,68 @@ class KickAndCompareTestCase(unittest.TestCase):
 #############################################
 
 
-def run_arnold_tests(test_filter=""):
-    """ Utility function for manually running tests inside Nuke
-    Returns unittest results if there are failures, otherwise None """
-    return run_tests(get_all_arnold_tests(), test_filter)
+def get_metadata_cache():
+    """ The metadata_cache.MetadataCache of the current run, or an in-memory one outside runs """
+    global _metadata_cache
+    if _metadata_cache is None:
+        import metadata_cache
+        _metadata_cache = metadata_cache.MetadataCache()
+    return _metadata_cache
 
 
-def run_tests(test_cases, test_filter=""):
+def run_arnold_tests(test_filter="", jobs=0, use_render_cache=True, fresh_render=False,
+                     render_cache_mb=None, persist_metadata=False, timings_file=None,
+                     profile_dir=None):
+    """ Utility function for manually running tests inside Nuke
+    Returns unittest results if there are failures, otherwise None
+
+    timings_file is a JSON file to write render, test and helper timings to. profile_dir is a
+    directory to write a cProfile dump of each test method to. With either, a summary table of
+    the timings is printed.
+    """
+    import metadata_cache
+    cache = None
+    if use_render_cache:
+        import render_cache
+        max_bytes = render_cache.DEFAULT_MAX_BYTES
+        if render_cache_mb is not None:
+            max_bytes = render_cache_mb * 1024 * 1024
+        cache = render_cache.RenderCache(max_bytes=max_bytes, fresh=fresh_render)
+    md_cache = metadata_cache.MetadataCache(
+        metadata_cache.DEFAULT_CACHE_FILE if persist_metadata else None)
+    timings = None
+    if timings_file or profile_dir:
+        import timing
+        timings = timing.Timings(profile_dir)
+    result = run_tests(get_all_arnold_tests(), test_filter, jobs, cache, md_cache, timings)
+    if timings_file:
+        timings.write_json(timings_file)
+        print "Timings written to %s" % timings_file
+    return result
+
+
+def run_tests(test_cases, test_filter="", jobs=0, render_cache=None, metadata_cache=None,
+              timings=None):
     """ Utility function for manually running tests. 
     Returns results if there are failures, otherwise None 
 
     test_filter will be matched fnmatch style (* wildcards) to either the name of the TestCase 
     class or test method. 
 
+    jobs is the number of kick renders run at once. 0 means one per core (up to the number of
+    renders), 1 renders each test case in its setUpClass, one after another.
+
+    render_cache is an optional render_cache.RenderCache. Renders whose inputs are unchanged are
+    restored from it instead of rendered.
+
+    metadata_cache is an optional metadata_cache.MetadataCache, shared by all tests of the run
+    and saved at the end of it. By default, a new in-memory one is used.
+
+    timings is an optional timing.Timings, which collects render times, the timings in Arnold
+    logs, and the time of each test and timed helper. Its summary table is printed at the end.
+
     """
+    global _render_scheduler, _render_cache, _metadata_cache, _timings
     import fnmatch
 
     def find_test_method(traceback):
@@ -204,7 +382,11 @@ def run_tests(test_cases, test_filter=""):
         match = re.search('", line \d+, in (test[a-z_0-9]+)', traceback)
         return match.group(1) if match else ""
 
-    result = unittest.TestResult()
+    if timings:
+        import timing
+        result = timing.TimingTestResult(timings)
+    else:
+        result = unittest.TestResult()
     suite = unittest.TestSuite()
     for case in test_cases:
         suite.addTests(unittest.TestLoader().loadTestsFromTestCase(case))
@@ -220,7 +402,27 @@ def run_tests(test_cases, test_filter=""):
             raise RuntimeError("Filter %s selected no tests. " % test_filter)
         suite = filtered_suite
 
-    suite.run(result)
+    _render_cache = render_cache
+    _metadata_cache = metadata_cache
+    _timings = timings
+    if jobs != 1:
+        _render_scheduler = RenderScheduler([type(test) for test in suite], jobs)
+    try:
+        suite.run(result)
+    finally:
+        if _render_scheduler:
+            _render_scheduler.close()
+            _render_scheduler = None
+        _render_cache = None
+        if _metadata_cache:
+            _metadata_cache.save()
+        _metadata_cache = None
+        _timings = None
+
+    if timings:
+        print "---------"
+        print timings.summary_table()
+
     print "---------"
     for test_instance, traceback in result.failures:
         print "Failed: %s.%s" % (type(test_instance).__name__, find_test_method(traceback))
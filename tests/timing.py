@@ -0,0 +1,191 @@
+#
+#
+#  Copyright (c) 2014, 2015, 2016, 2017 Psyop Media Company, LLC
+#  See license.txt
+#
+#
+"""
+Timing of test runs: where time goes between rendering, image loading, metadata parsing and
+pixel comparison.
+
+A Timings object collects, per test class, the wall time of its kick render (or cache restore)
+and the timings Arnold and the Cryptomatte render statistics report in the render's log.txt, and
+per test method, its duration and the time spent in each timed helper (assertions, image loading,
+metadata parsing). It writes them as JSON and prints a summary table. Optionally, each test
+method is run under cProfile and its stats dumped to <profile_dir>/<test id>.prof.
+"""
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+import unittest
+
+import render_stats
+
+# "00:00:02    58MB         |  render time:   ..." -> "render time:   ..."
+_LOG_LINE_RE = re.compile(r"^[\d:]+\s+\d+MB\s+\|(.*)$")
+_LOG_ENTRY_RE = re.compile(r"^\s*(\S.*?)\s{2,}(-?[\d:.]+)(?:\s.*)?$")
+_LOG_SECTIONS = {
+    "scene creation time:": "scene_creation",
+    "render time:": "render",
+    "memory consumed in MB:": "memory_mb",
+}
+_MANIFEST_TIME_RE = re.compile(r"Cryptomatte manifest created - ([\d.]+) seconds")
+_BUCKET_WORKERS_RE = re.compile(r"bucket workers done in ([\d:.]+)")
+
+
+def parse_duration(value):
+    """ Seconds from an Arnold log duration, such as "0:02.25" or "1:00:02.25" """
+    seconds = 0.0
+    for part in value.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def parse_arnold_log(log_path):
+    """
+    Parses the timing and memory summaries at the end of an Arnold log.
+
+    Returns {"scene_creation": {entry: seconds}, "render": {entry: seconds},
+    "memory_mb": {entry: MB}, "manifest_seconds": [seconds, ...], "bucket_seconds": seconds}.
+    Nested entries such as "pixel rendering" are flattened into their section. The summaries are
+    only logged at higher verbosity, so sections may be empty; bucket_seconds is None if the
+    "bucket workers done" line is missing.
+    """
+    result = {section: {} for section in _LOG_SECTIONS.values()}
+    result["manifest_seconds"] = []
+    result["bucket_seconds"] = None
+    section = None
+    with open(log_path) as f:
+        for line in f:
+            match = _LOG_LINE_RE.match(line.rstrip())
+            if not match:
+                continue
+            text = match.group(1)
+            manifest_match = _MANIFEST_TIME_RE.search(text)
+            if manifest_match:
+                result["manifest_seconds"].append(float(manifest_match.group(1)))
+            bucket_match = _BUCKET_WORKERS_RE.search(text)
+            if bucket_match:
+                result["bucket_seconds"] = parse_duration(bucket_match.group(1))
+
+            header = next((h for h in _LOG_SECTIONS if text.strip().startswith(h)), None)
+            if header:
+                section = _LOG_SECTIONS[header]
+                continue
+            if text.strip().startswith("---") or not text.strip():
+                section = None
+                continue
+            entry = _LOG_ENTRY_RE.match(text) if section else None
+            if entry:
+                name, value = entry.groups()
+                if section == "memory_mb":
+                    result[section][name] = float(value)
+                else:
+                    result[section][name] = parse_duration(value)
+    return result
+
+
+class Timings(object):
+    """ Timings collected over one test run. Thread safe, as renders run in a pool. """
+
+    def __init__(self, profile_dir=None):
+        self.profile_dir = profile_dir
+        self.renders = {}
+        self.tests = {}
+        self._lock = threading.Lock()
+        if profile_dir and not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+
+    def record_render(self, case_name, seconds, cached, log_path=None):
+        """ Records the render of a test class, and the timings in its Arnold log if present """
+        render = {"wall_seconds": seconds, "cached": cached}
+        if log_path and os.path.isfile(log_path):
+            render["arnold"] = parse_arnold_log(log_path)
+            # reported if the scene turns on render_stats
+            render["cryptomatte_stats"] = render_stats.parse_log(log_path)
+        with self._lock:
+            self.renders[case_name] = render
+
+    def _test_entry(self, test_id):
+        return self.tests.setdefault(test_id, {"seconds": None, "timed": {}})
+
+    def record_test(self, test_id, seconds):
+        with self._lock:
+            self._test_entry(test_id)["seconds"] = seconds
+
+    @contextlib.contextmanager
+    def timed(self, test_id, name):
+        """ Adds the time spent in the block to the total for name in a test """
+        start = time.time()
+        try:
+            yield
+        finally:
+            seconds = time.time() - start
+            with self._lock:
+                timed = self._test_entry(test_id)["timed"].setdefault(name, {"seconds": 0.0,
+                                                                             "calls": 0})
+                timed["seconds"] += seconds
+                timed["calls"] += 1
+
+    def to_dict(self):
+        with self._lock:
+            return {"renders": dict(self.renders), "tests": dict(self.tests)}
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+
+    def summary_table(self):
+        """ Text table of render times per class, and test and helper times per test method """
+        data = self.to_dict()
+        lines = ["%-40s %10s %10s %10s %10s  %s" % ("render", "wall (s)", "arnold (s)",
+                                                     "buckets (s)", "peak (MB)", "cached")]
+        for name, render in sorted(data["renders"].items()):
+            arnold = render.get("arnold", {})
+            lines.append("%-40s %10.2f %10s %10s %10s  %s" % (
+                name, render["wall_seconds"], _format(arnold.get("render", {}).get("total")),
+                _format(arnold.get("bucket_seconds")),
+                _format(arnold.get("memory_mb", {}).get("total peak")), render["cached"]))
+
+        lines.append("")
+        lines.append("%-60s %10s  %s" % ("test", "time (s)", "slowest helpers"))
+        for test_id, test in sorted(data["tests"].items()):
+            helpers = sorted(test["timed"].items(), key=lambda x: -x[1]["seconds"])[:3]
+            lines.append("%-60s %10s  %s" % (test_id.split(".", 1)[-1], _format(test["seconds"]),
+                                             ", ".join("%s %.2f" % (helper, timed["seconds"])
+                                                       for helper, timed in helpers)))
+        return "\n".join(lines)
+
+
+def _format(value):
+    return "-" if value is None else "%.2f" % value
+
+
+class TimingTestResult(unittest.TestResult):
+    """ TestResult recording the duration of each test, optionally under cProfile. """
+
+    def __init__(self, timings, *args, **kwargs):
+        super(TimingTestResult, self).__init__(*args, **kwargs)
+        self.timings = timings
+        self._start = None
+        self._profile = None
+
+    def startTest(self, test):
+        super(TimingTestResult, self).startTest(test)
+        if self.timings.profile_dir:
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._start = time.time()
+
+    def stopTest(self, test):
+        seconds = time.time() - self._start
+        if self._profile:
+            self._profile.disable()
+            self._profile.dump_stats(os.path.join(self.timings.profile_dir, "%s.prof" % test.id()))
+            self._profile = None
+        self.timings.record_test(test.id(), seconds)
+        super(TimingTestResult, self).stopTest(test)